@@ -0,0 +1,709 @@
+from multiprocessing.pool import ThreadPool
+from threading import Lock, current_thread
+from os import path, remove, rename, makedirs, listdir, stat, getpid
+from hashlib import md5, sha1
+from musicgen import MusicGen
+from jobs import run_inline
+from metrics import metrics
+from io import BytesIO
+from PIL import Image
+from contextlib import contextmanager
+import fcntl
+import json
+import time
+import re
+
+class ArtworkCache(object):
+	"""
+	Extracts album artwork from audio files and stores it in the covers directory,
+	along with resized versions of the artwork in several sizes and formats
+	to reduce bandwidth. Clients choose between the versions with `srcset`.
+
+	Artwork is stored under a hash of the image data, so songs which share
+	the same artwork, such as the tracks of an album, share the same files.
+	Since a file's contents never change under the same name, artwork URLs
+	can be cached by clients forever, and changed artwork gets a new URL.
+	An index in the covers directory maps each song to the hash of its artwork,
+	and records the size and last access time of each stored image. Each change
+	to the index is appended to a journal, and the index is only rewritten once
+	the journal has grown as large as the index, so recording a song costs the
+	same however many songs are stored.
+
+	When the stored artwork exceeds the configured budget, the least recently
+	used images are evicted and will be generated again when next requested.
+
+	Properties:
+		stats (dict): Counters for the cache, with the following keys:
+		              hits:      Lookups of songs which had been generated.
+		              misses:    Lookups of songs which had not been generated.
+		              evictions: Images which were removed to stay within budget.
+		              entries:   Images currently stored.
+		              bytes:     Total size of the images currently stored.
+	"""
+
+	# The filename of the index in the covers directory
+	INDEX_FILENAME = 'index.json'
+
+	# The filename of the journal of changes since the index was written
+	JOURNAL_FILENAME = 'index.log'
+
+	# The fewest changes in the journal before the index is rewritten
+	MIN_JOURNAL_ENTRIES = 1000
+
+	# Seconds between recording accesses of the same image in the journal
+	ACCESS_RESOLUTION = 3600
+
+	# The extensions to store original images with, by Pillow format, where other formats use the format's name
+	ORIGINAL_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'BMP': '.bmp', 'TIFF': '.tif'}
+
+	# Matches the filenames of stored artwork, which begin with the image hash
+	_ARTWORK_FILENAME = re.compile(r'^([0-9a-f]{40})[._]')
+
+	# Matches the whole filename of an original or resized artwork file
+	_ARTWORK_FILE = re.compile(r'^[0-9a-f]{40}(_\d+_\d+)?\.[a-z0-9]+$')
+
+	def __init__(self, config):
+		"""
+		Arguments:
+			config (dict): A dictionary of config values.
+			               This is expected to include the following keys:
+						   MUSIC_DIR:                The directory that MPD looks for music in.
+						   COVERS_DIR:               The directory to save album covers to.
+						   COVERS_URL:               The path album covers are served from, ending in a slash.
+						                             Defaults to '/covers/'.
+						   COVERS_SIZE:              The maximum (width, height) of resized album covers.
+						   COVERS_FILETYPE:          The file format to save album covers in.
+						   COVERS_SIZES:             List of (width, height) sizes to resize album covers to.
+						                             Defaults to COVERS_SIZE.
+						   COVERS_FORMATS:           List of file formats to save resized album covers in,
+						                             in order of preference. Formats which can't be saved
+						                             by Pillow are skipped. Defaults to COVERS_FILETYPE.
+						   COVERS_CACHE_MAX_BYTES:   The maximum total size of stored album covers,
+						                             or None for no limit. Defaults to None.
+						   COVERS_CACHE_MAX_ENTRIES: The maximum number of stored album covers,
+						                             or None for no limit. Defaults to None.
+		"""
+		self._config = config
+		self._musicgen = MusicGen()
+		self._lock = Lock()
+		self._max_bytes = config.get('COVERS_CACHE_MAX_BYTES', None)
+		self._max_entries = config.get('COVERS_CACHE_MAX_ENTRIES', None)
+		self._index_file = path.join(config['COVERS_DIR'], self.INDEX_FILENAME)
+		self._journal_path = path.join(config['COVERS_DIR'], self.JOURNAL_FILENAME)
+
+		# Sizes are resized from largest to smallest, so each is resized from the last
+		self._sizes = sorted(set(map(tuple, config.get('COVERS_SIZES', [config['COVERS_SIZE']]))), reverse=True)
+
+		# The default filetype is always generated, for clients without `srcset` support
+		formats = config.get('COVERS_FORMATS', [config['COVERS_FILETYPE']])
+		self._formats = [extension for extension in formats if self._can_save(extension)]
+		if config['COVERS_FILETYPE'] not in self._formats:
+			self._formats.append(config['COVERS_FILETYPE'])
+
+		if not path.isdir(config['COVERS_DIR']):
+			makedirs(config['COVERS_DIR'])
+
+		self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'entries': 0, 'bytes': 0}
+
+		# Songs as {song key: image hash} and images as {image hash: [size, last access time, widths, extension]},
+		# where the extension is that of the original image
+		self._songs, self._images = {}, {}
+
+		# The stat of the index as last read, and how much of the journal has been read since
+		self._index_stat = False
+		self._journal_offset = 0
+		self._journal_entries = 0
+		self._journal_file = open(self._journal_path, 'a')
+
+		with self._lock_files():
+			self._sync()
+
+	@contextmanager
+	def _lock_files(self):
+		"""
+		Locks the index and journal against other processes, such as prewarm_covers.py
+		running alongside the server, while they're read or changed.
+		"""
+		fcntl.flock(self._journal_file, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(self._journal_file, fcntl.LOCK_UN)
+
+	def _sync(self):
+		"""
+		Reads the changes which other processes have made to the index since it was last read.
+		If another process has rewritten the index, the whole index is read again. Must be called
+		with the files locked.
+		"""
+		try:
+			info = stat(self._index_file)
+			index_stat = (info.st_ino, info.st_mtime, info.st_size)
+		except OSError:
+			index_stat = None
+
+		if index_stat != self._index_stat:
+			self._load_index(index_stat is not None)
+			self._index_stat = index_stat
+			self._journal_offset = 0
+			self._journal_entries = 0
+
+		try:
+			journal_file = open(self._journal_path)
+		except IOError:
+			return
+
+		with journal_file:
+			journal_file.seek(self._journal_offset)
+
+			while True:
+				line = journal_file.readline()
+				if not line.endswith('\n'):
+					# The last line is incomplete while another process is writing it
+					break
+
+				self._journal_offset = journal_file.tell()
+				self._journal_entries += 1
+
+				try:
+					self._apply(json.loads(line))
+				except (ValueError, KeyError, IndexError, TypeError):
+					# A line is cut short if a process stopped while writing it
+					continue
+
+	def _load_index(self, exists):
+		"""
+		Reads the index stored in the covers directory, replacing the index in memory. Last
+		access times which haven't been written yet are kept. If there is no index, the images
+		are rebuilt from the files in the covers directory.
+
+		Arguments:
+			exists (bool): Whether there is an index in the covers directory.
+		"""
+		try:
+			if not exists:
+				raise IOError('No index')
+			with open(self._index_file) as index_file:
+				index = json.load(index_file)
+			songs, images = index['songs'], index['images']
+		except (IOError, ValueError, KeyError):
+			songs, images = {}, self._scan_images()
+
+		for image_hash, image in images.items():
+			if image_hash in self._images:
+				image[1] = max(image[1], self._images[image_hash][1])
+
+		self._songs, self._images = songs, images
+		self.stats['entries'] = len(images)
+		self.stats['bytes'] = sum(image[0] for image in images.values())
+
+	def _scan_images(self):
+		"""
+		Returns:
+			The images stored in the covers directory as {image hash: [size, last access time, widths, extension]},
+			where the last access time is the time the image was last modified. The widths
+			of the resized images are unknown, so they're found when the image is next generated.
+		"""
+		images = {}
+
+		for filename in listdir(self._config['COVERS_DIR']):
+			match = self._ARTWORK_FILENAME.match(filename)
+			if not match:
+				continue
+
+			info  = stat(path.join(self._config['COVERS_DIR'], filename))
+			image = images.setdefault(match.group(1), [0, 0, None, self._config['COVERS_FILETYPE']])
+			image[0] += info.st_size
+			image[1] = max(image[1], info.st_mtime)
+
+			# The original image is the only file without a size in its name
+			if self._ARTWORK_FILE.match(filename) and filename[40] == '.':
+				image[3] = filename[40:]
+
+		return images
+
+	def _apply(self, entry):
+		"""
+		Applies a change to the index, as written to the journal. The change is a list of its kind,
+		then the kind's fields, and applying the same change again has no further effect.
+
+		Arguments:
+			entry (list): One of the following changes:
+			              ['song', song key, image hash]: Sets the artwork of a song.
+			              ['forget', song key]: Removes a song.
+			              ['image', image hash, size, last access time, widths, extension]: Adds or replaces an image.
+			              ['touch', image hash, last access time]: Records an access of an image.
+			              ['remove', image hash]: Removes an image, along with the songs using it.
+		"""
+		kind = entry[0]
+
+		if kind == 'song':
+			self._songs[entry[1]] = entry[2]
+		elif kind == 'forget':
+			self._songs.pop(entry[1], None)
+		elif kind == 'image':
+			if entry[1] in self._images:
+				self.stats['bytes'] -= self._images[entry[1]][0]
+			else:
+				self.stats['entries'] += 1
+
+			self._images[entry[1]] = list(entry[2:6])
+			self.stats['bytes'] += entry[2]
+		elif kind == 'touch':
+			if entry[1] in self._images:
+				self._images[entry[1]][1] = max(self._images[entry[1]][1], entry[2])
+		elif kind == 'remove':
+			if entry[1] in self._images:
+				self.stats['entries'] -= 1
+				self.stats['bytes'] -= self._images.pop(entry[1])[0]
+
+			for song_key in [key for key, value in self._songs.items() if value == entry[1]]:
+				del self._songs[song_key]
+
+	def _change(self, *entries):
+		"""
+		Applies changes to the index and appends them to the journal, rewriting
+		the index instead once the journal has grown as large as the index.
+		Changes made by other processes are read first, so none are lost.
+
+		Arguments:
+			entries (list): Each change, as described by `_apply`.
+		"""
+		with self._lock_files():
+			self._sync()
+
+			for entry in entries:
+				self._apply(list(entry))
+				self._journal_file.write(json.dumps(entry) + '\n')
+
+			self._journal_file.flush()
+			self._journal_offset = self._journal_file.tell()
+			self._journal_entries += len(entries)
+
+			if self._journal_entries > max(self.MIN_JOURNAL_ENTRIES, len(self._songs) + len(self._images)):
+				self._save_index()
+
+	def _save_index(self):
+		"""
+		Writes the index to the covers directory, replacing the previous index at once,
+		then empties the journal. Must be called with the files locked.
+		"""
+		tmp_file = self._index_file + '.tmp'
+		with open(tmp_file, 'w') as index_file:
+			json.dump({'songs': self._songs, 'images': self._images}, index_file)
+		rename(tmp_file, self._index_file)
+
+		# Changes are applied again harmlessly if the journal isn't emptied
+		self._journal_file.seek(0)
+		self._journal_file.truncate()
+
+		info = stat(self._index_file)
+		self._index_stat = (info.st_ino, info.st_mtime, info.st_size)
+		self._journal_offset = 0
+		self._journal_entries = 0
+
+	def _get_song_key(self, song_file):
+		"""Returns the key for the given song in the index, which is a hash of its filename."""
+		return md5(song_file).hexdigest()
+
+	def _can_save(self, extension):
+		"""Returns True if Pillow is able to save images with the given file extension."""
+		Image.init()
+		return Image.EXTENSION.get(extension.lower()) in Image.SAVE
+
+	def _get_variant_file(self, image_hash, size, extension):
+		"""
+		Returns:
+			The path to the resized artwork with the given hash, size and file extension.
+		"""
+		# The resized image filename is {image_filename}_{width}_{height}
+		filename = '_'.join([image_hash] + list(map(str, size))) + extension
+		return path.join(self._config['COVERS_DIR'], filename)
+
+	def _get_variant_url(self, image_hash, size, extension):
+		"""
+		Returns:
+			The URL for the resized artwork with the given hash, size and file extension.
+		"""
+		return self._config.get('COVERS_URL', '/covers/') + path.basename(self._get_variant_file(image_hash, size, extension))
+
+	def get_file(self, filename):
+		"""
+		Returns the path to the artwork file with the given filename from an artwork URL,
+		or None if the filename isn't the name of an artwork file. The file may not exist.
+
+		Arguments:
+			filename (str): The filename of the artwork file.
+		"""
+		if not self._ARTWORK_FILE.match(filename):
+			return None
+		return path.join(self._config['COVERS_DIR'], filename)
+
+	def _get_files(self, image_hash, extension):
+		"""
+		Returns:
+			A list of the paths to the original and resized artwork with the given hash,
+			where the original image has the given extension.
+		"""
+		image_file = path.join(self._config['COVERS_DIR'], image_hash + extension)
+
+		return [image_file] + [
+			self._get_variant_file(image_hash, size, extension)
+			for size in self._sizes
+			for extension in self._formats]
+
+	def _get_artwork(self, image_hash):
+		"""
+		Returns:
+			A dict describing the resized artwork with the given hash, with the following keys:
+			src:     The URL for the largest artwork in the default filetype.
+			sources: A list of dicts for each format of artwork in order of preference,
+			         containing the `type` and `srcset` attributes for a <source> element.
+		"""
+		sources = []
+
+		# Images keep their aspect ratio when resized, so may be narrower than the configured width
+		widths = self._images[image_hash][2]
+
+		for extension in self._formats:
+			sources.append({
+				'type': Image.MIME.get(Image.EXTENSION[extension.lower()], 'image/' + extension[1:]),
+				'srcset': ', '.join(
+					'{} {}w'.format(self._get_variant_url(image_hash, size, extension), width)
+					for size, width in reversed(list(zip(self._sizes, widths))))
+			})
+
+		return {
+			'src':     self._get_variant_url(image_hash, self._sizes[0], self._config['COVERS_FILETYPE']),
+			'sources': sources
+		}
+
+	def lookup(self, song_file):
+		"""
+		Looks up the generated artwork of the given song.
+
+		Returns:
+			A tuple of whether the song has been generated, and a dict describing
+			its resized artwork as returned by `generate`, which is None if
+			the song has no artwork.
+		"""
+		with self._lock:
+			song_key = self._get_song_key(song_file)
+			image_hash = self._find(song_key)
+
+			if image_hash is None:
+				# Another process, such as prewarm_covers.py, may have generated it since the index was read
+				with self._lock_files():
+					self._sync()
+				image_hash = self._find(song_key)
+
+			if image_hash is None:
+				self.stats['misses'] += 1
+				return False, None
+
+			self.stats['hits'] += 1
+			if image_hash == '':
+				return True, None
+
+			# Accesses are written to the journal occasionally, as the least recently used order only needs to be rough
+			accessed_at = time.time()
+			if accessed_at - self._images[image_hash][1] > self.ACCESS_RESOLUTION:
+				self._change(('touch', image_hash, accessed_at))
+			else:
+				self._images[image_hash][1] = accessed_at
+
+			return True, self._get_artwork(image_hash)
+
+	def _find(self, song_key):
+		"""
+		Returns:
+			The hash of the stored artwork of the song with the given key, an empty string
+			if the song has no artwork, or None if the song's artwork hasn't been generated.
+		"""
+		image_hash = self._songs.get(song_key)
+
+		if image_hash == '':
+			return image_hash
+
+		if not self._has_widths(image_hash) or \
+		   not path.isfile(self._get_variant_file(image_hash, self._sizes[0], self._config['COVERS_FILETYPE'])):
+			return None
+		return image_hash
+
+	def generate(self, song_file, offload=run_inline):
+		"""
+		Extracts the artwork from the given song and resizes it to each size and format,
+		unless artwork with the same image data is already stored.
+
+		Arguments:
+			song_file (str): The filename of the song relative to the music directory.
+			offload (func): Runs `render` given it and the song file, and returns its result.
+			                Defaults to running it on the calling thread.
+
+		Returns:
+			A dict describing the resized artwork, or None if the song has no artwork.
+			The dict contains the following keys:
+			src:     The URL for the largest artwork in the default filetype.
+			sources: A list of dicts for each format of artwork in order of preference,
+			         containing the `type` and `srcset` attributes for a <source> element.
+		"""
+		result = offload(self.render, song_file)
+		self.record(song_file, *result)
+		image_hash = result[0]
+
+		return self._get_artwork(image_hash) if image_hash else None
+
+	def render(self, song_file):
+		"""
+		Extracts the artwork from the given song and writes it to the covers
+		directory in each size and format, without recording it in the index.
+		The artwork is decoded once, and each size is resized from the next largest.
+
+		Several processes may render artwork into the same covers directory at once,
+		as long as the results are only recorded by one of them.
+
+		Arguments:
+			song_file (str): The filename of the song relative to the music directory.
+
+		Returns:
+			A tuple of the image hash, the total size of the image files, the width of the resized
+			image for each size, and the extension of the original image, which is stored in its own
+			format. The image hash is an empty string if the song has no artwork.
+		"""
+		song_path = path.join(self._config['MUSIC_DIR'], song_file)
+		with metrics.timer('artwork_extract_seconds'):
+			artwork = self._musicgen.extract_cover_art(song_path)
+
+		if artwork is None:
+			return '', 0, [], None
+
+		# Only the header is read until the image is resized
+		image = Image.open(BytesIO(artwork))
+		original_extension = self.ORIGINAL_EXTENSIONS.get(image.format, '.' + image.format.lower())
+
+		image_hash = sha1(artwork).hexdigest()
+		image_file = self._get_files(image_hash, original_extension)[0]
+
+		if not path.isfile(image_file):
+			def write_image(tmp_file):
+				with open(tmp_file, 'wb') as out_file:
+					out_file.write(artwork)
+			self._write_file(image_file, write_image)
+
+		resized_at = time.time()
+		resize = None
+		widths = []
+		for size in self._sizes:
+			variants = [(extension, self._get_variant_file(image_hash, size, extension)) for extension in self._formats]
+			variants = [(extension, filename) for extension, filename in variants if not path.isfile(filename)]
+			if not variants:
+				# Only the header of the existing image is read
+				widths.append(Image.open(self._get_variant_file(image_hash, size, self._formats[-1])).size[0])
+				continue
+
+			if resize is None:
+				resize = image
+				# Allows JPEGs to be decoded at a reduced scale
+				resize.draft('RGB', self._sizes[0])
+
+			resize = resize.copy()
+			resize.thumbnail(size)
+			widths.append(resize.size[0])
+
+			for extension, filename in variants:
+				self._save_variant(resize, extension, filename)
+
+		metrics.observe('artwork_resize_seconds', time.time() - resized_at)
+
+		size = sum(path.getsize(f) for f in self._get_files(image_hash, original_extension) if path.isfile(f))
+		return image_hash, size, widths, original_extension
+
+	def record(self, song_file, image_hash, size, widths, extension, evict=True):
+		"""
+		Records rendered artwork in the index, evicting other artwork if over budget.
+
+		Arguments:
+			song_file (str): The filename of the song relative to the music directory.
+			image_hash, size, widths, extension: The artwork of the song, as returned by `render`.
+			evict (bool): Whether to evict other artwork if over budget. Filling the cache ahead
+			              of time shouldn't evict, as it would remove artwork it had just generated.
+		"""
+		entries = [('song', self._get_song_key(song_file), image_hash)]
+		if image_hash:
+			entries.insert(0, ('image', image_hash, size, time.time(), widths, extension))
+
+		with self._lock:
+			self._change(*entries)
+
+			if image_hash and evict:
+				self._evict(keep=image_hash)
+
+	def contains(self, song_file):
+		"""Returns True if the given song has been generated, without counting a lookup."""
+		image_hash = self._songs.get(self._get_song_key(song_file))
+		return image_hash == '' or self._has_widths(image_hash)
+
+	def is_full(self):
+		"""Returns True if the stored images have reached the maximum size or number of entries."""
+		return (
+			(self._max_bytes is not None and self.stats['bytes'] >= self._max_bytes) or
+			(self._max_entries is not None and self.stats['entries'] >= self._max_entries))
+
+	def save_index(self):
+		"""Writes the whole index to the covers directory, emptying the journal."""
+		with self._lock, self._lock_files():
+			self._sync()
+			self._save_index()
+
+	def _save_variant(self, image, extension, filename):
+		"""Saves a resized image in the format of the given extension."""
+		# JPEGs can't store transparency or palettes
+		if Image.EXTENSION[extension.lower()] == 'JPEG' and image.mode not in ('RGB', 'L'):
+			image = image.convert('RGB')
+
+		self._write_file(filename, image.save)
+
+	def _write_file(self, filename, write):
+		"""
+		Writes a file in the covers directory without exposing it half-written,
+		since threads and processes may generate the same artwork at the same time.
+
+		Arguments:
+			filename (str): The path of the file to write.
+			write (function): Writes the file to the temporary path it is given.
+		"""
+		# Keep the extension, which determines the format images are saved in
+		root, extension = path.splitext(filename)
+		tmp_file = '{}.{}.{}.tmp{}'.format(root, getpid(), current_thread().ident, extension)
+		write(tmp_file)
+		rename(tmp_file, filename)
+
+	def _remove_image(self, image_hash):
+		"""Removes an image from the index and the covers directory, along with the songs using it."""
+		artwork_files = self._get_files(image_hash, self._get_extension(image_hash))
+		self._change(('remove', image_hash))
+
+		for artwork_file in artwork_files:
+			if path.isfile(artwork_file):
+				remove(artwork_file)
+
+	def _has_widths(self, image_hash):
+		"""
+		Returns True if the image with the given hash is stored with the width of each configured size.
+		Images found by rebuilding the index, recorded before widths were stored, or recorded with
+		different sizes configured are missing their widths, and are generated again to find them.
+		"""
+		image = self._images.get(image_hash)
+		return image is not None and len(image) > 2 and image[2] is not None and len(image[2]) == len(self._sizes)
+
+	def _get_extension(self, image_hash):
+		"""Returns the extension of the original image with the given hash."""
+		image = self._images[image_hash]
+		# Images recorded before originals kept their own format were stored as the default filetype
+		return image[3] if len(image) > 3 and image[3] else self._config['COVERS_FILETYPE']
+
+	def _is_over_budget(self):
+		"""Returns True if the stored images exceed the maximum size or number of entries."""
+		return (
+			(self._max_bytes is not None and self.stats['bytes'] > self._max_bytes) or
+			(self._max_entries is not None and self.stats['entries'] > self._max_entries))
+
+	def _evict(self, keep=None):
+		"""
+		Removes the least recently used images until the cache is within budget.
+
+		Arguments:
+			keep (str): The hash of an image which should not be evicted.
+		"""
+		if not self._is_over_budget():
+			return
+
+		by_access = sorted(self._images, key=lambda image_hash: self._images[image_hash][1])
+
+		for image_hash in by_access:
+			if not self._is_over_budget():
+				break
+
+			# Another process may have removed the image while others were being evicted
+			if image_hash != keep and image_hash in self._images:
+				self._remove_image(image_hash)
+				self.stats['evictions'] += 1
+
+	def remove(self, song_file):
+		"""
+		Removes the given song from the index, along with its stored
+		artwork if no other song shares the same artwork.
+		"""
+		with self._lock:
+			song_key = self._get_song_key(song_file)
+			image_hash = self._songs.get(song_key)
+			self._change(('forget', song_key))
+
+			if image_hash in self._images and image_hash not in self._songs.values():
+				self._remove_image(image_hash)
+
+class ArtworkPipeline(object):
+	"""
+	Generates album artwork on a pool of worker threads,
+	so that cache misses never block the caller.
+	"""
+
+	def __init__(self, cache, workers=2, offload=run_inline):
+		"""
+		Arguments:
+			cache (ArtworkCache): The cache to look up and generate artwork with.
+			workers (int): The number of threads to generate artwork on.
+			offload (func): Runs the decoding and resizing of artwork, as `ArtworkCache.generate` takes it.
+		"""
+		self._cache = cache
+		self._offload = offload
+		self._pool = ThreadPool(workers)
+		self._pending = {}
+		self._lock = Lock()
+
+	def request(self, song_file, callback):
+		"""
+		Looks up the artwork for the given song, generating it in the background if needed.
+
+		Arguments:
+			song_file (str): The filename of the song relative to the music directory.
+			callback (function): Called with the song file and the artwork once generated.
+			                     The artwork is a dict as returned by `ArtworkCache.generate`,
+			                     which is None if the song has no artwork.
+
+		Returns:
+			The artwork dict if it is already cached, otherwise None.
+			None is also returned if the song is known to have no artwork,
+			in which case the callback is not called.
+		"""
+		generated, artwork = self._cache.lookup(song_file)
+		if generated:
+			return artwork
+
+		with self._lock:
+			# Only generate artwork once when requested several times
+			if song_file in self._pending:
+				self._pending[song_file].append(callback)
+				return None
+			self._pending[song_file] = [callback]
+
+		self._pool.apply_async(self._generate, (song_file,))
+		return None
+
+	def close(self):
+		"""Waits for the artwork being generated to finish, after which no more can be requested."""
+		self._pool.close()
+		self._pool.join()
+
+	def _generate(self, song_file):
+		"""Generates the artwork for a song and passes it to the waiting callbacks."""
+		try:
+			artwork = self._cache.generate(song_file, self._offload)
+		except Exception:
+			artwork = None
+
+		with self._lock:
+			callbacks = self._pending.pop(song_file, [])
+
+		for callback in callbacks:
+			callback(song_file, artwork)
@@ -1,19 +1,90 @@
-from musicgen import MusicGen
-from threading import Thread
-from os import path, remove
-from select import select
-from mpd import MPDClient
-from hashlib import md5
-from PIL import Image
+from artwork import ArtworkCache, ArtworkPipeline
+from mpd_multiplexer import MPDMultiplexer, CommandListError
+from library import LibraryIndex
+from jobs import JobQueue, run_inline
+from metrics import metrics
+from threading import Thread, Event, Lock
+from Queue import Queue, Empty
+from musicgen import MusicGen, InsufficientPaddingError
+from itertools import count
+from os import path, remove, rename
+import logging
+import shutil
 import time
+import os
+
+logger = logging.getLogger(__name__)
+
+def _get_monotonic_clock():
+	"""
+	Returns a function which gives the time in seconds on a clock which never goes backwards,
+	so playback timestamps aren't thrown off when the system time is changed.
+
+	Python 2 has no `time.monotonic`, so CLOCK_MONOTONIC is read through librt where it exists.
+	Elsewhere this falls back to the wall clock, which clients correct for each time they sync.
+	"""
+	if hasattr(time, 'monotonic'):
+		return time.monotonic
+
+	try:
+		import ctypes
+		import ctypes.util
+
+		class timespec(ctypes.Structure):
+			_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+		clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True).clock_gettime
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+	except (ImportError, OSError, AttributeError):
+		return time.time
+
+	# CLOCK_MONOTONIC on Linux
+	CLOCK_MONOTONIC = 1
+
+	def monotonic():
+		now = timespec()
+		if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(now)) != 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+		return now.tv_sec + now.tv_nsec / 1e9
+
+	return monotonic
+
+# Clock for playback timestamps
+clock = _get_monotonic_clock()
+
+def start_thread(target, name):
+	"""Runs a function in the background on a new daemon thread, returning the thread."""
+	thread = Thread(target=target, name=name, args=())
+	thread.setDaemon(True)
+	thread.start()
+	return thread
 
 class AudioManager(object):
 	"""
 	Provides an interface to a running MPD instance.
 
 	This class also accepts callbacks to be run after the following events are fired:
-		'song change': Currently playing song has changed.
-		               Callback should accept current song dict as its only argument.
+		'song change':     Currently playing song has changed.
+		                   Callback should accept current song dict as its only argument.
+		'artwork ready':   Artwork for the currently playing song has been generated.
+		                   Callback should accept current song dict as its only argument.
+		'artwork prefetch': Artwork for the upcoming songs in the playlist has been generated.
+		                   Callback should accept the `upcoming_artwork` list as its only argument.
+		'player change':   The MPD player subsystem has changed.
+		'playlist change': The MPD current playlist has changed.
+		'options change':  An MPD playback option (repeat, random, etc) has changed.
+		'mixer change':    The MPD volume has changed.
+		'database change': The MPD database has been updated.
+		'song added':      Songs from `add_new_songs` have been added to the playlist.
+		                   Callback should accept the job id, a list of the added songs'
+		                   MPD data, and a list of error messages for the songs which
+		                   couldn't be added.
+		'playlist patch':  The current playlist has changed.
+		                   Callback should accept a patch from `get_playlist_patch` as its only argument.
+		'artwork changed': Artwork from `change_album_artwork` has been embedded.
+		                   Callback should accept the job id, a list of the changed
+		                   songs' filenames, and a list of error messages.
 
 	Callbacks can be registered as per the following example:
 
@@ -26,20 +97,40 @@ class AudioManager(object):
 	Properties:
 		current_song (dict): Information on the currently playing song.
 		                     This dict includes the following keys:
-							 artwork:    The URL for the song's artwork.
+							 artwork:    The URL for the song's largest artwork.
+							 artwork_sources: A list of each format of the song's artwork in order of
+							                  preference, as dicts of `type` and `srcset` attributes.
+							 file:       The filename of the song relative to the music directory.
+							 id:         The MPD song id of the song in the playlist.
 							 title:      The title of the current song.
 							 artist:     The artist of the current song.
 							 album:      The album of the current song.
-							 length_sec: The length of the song in seconds.
-							 time_sec:   The amount of time into the song, in seconds.
-							 start_time: UNIX timestamp for when the song began playing.
-							 length:     The length of the song as a time string.
-							 time:       The amount of time into the song, as a time string.
-							 progress:   The percentage of the amount of time into the song.
-							 is_playing: True if the song is playing, False otherwise.
+							 duration:   The length of the song in seconds.
+							 elapsed:    The amount of time into the song in seconds, as of `updated_at`.
+							 updated_at: The time on the server's `clock` when `elapsed` was read.
+							 state:      The MPD player state, as 'play', 'pause' or 'stop'.
+		library (LibraryIndex): An index of the songs in the MPD library for searching,
+		                        which is updated when the database changes.
+		upcoming_artwork (list): The artwork of the next songs in the playlist which is ready,
+		                         as dicts of `src` and `sources` as described by ArtworkCache.
+		artwork_stats (dict):  Hit, miss and eviction counters for the album artwork cache,
+		                       as described by ArtworkCache.
+		embed_stats (dict):    The number of songs which had artwork embedded `in_place`,
+		                       and which were `rewritten` in full.
+		notify_latency (dict): The time in seconds taken to dispatch the most recent change
+		                       of each MPD subsystem, measured from when MPD reported the change.
 	"""
 
-	def __init__(self, config):
+	# MPD subsystems which are dispatched as events when they change
+	IDLE_SUBSYSTEMS = ('player', 'playlist', 'options', 'mixer', 'database')
+
+	# The most paths MPD queues for updating at once
+	MAX_UPDATE_PATHS = 32
+
+	# The most changed playlist positions to send, beyond which clients reload the playlist
+	MAX_PLAYLIST_CHANGES = 1000
+
+	def __init__(self, config, spawn=start_thread, offload=run_inline):
 		"""
 		Creates a new interface to a running MPD instance.
 
@@ -48,28 +139,72 @@ class AudioManager(object):
 			               This is expected to include the following keys:
 						   MPD_HOST:           The hostname of the MPD instance.
 						   MPD_PORT:           The port that the MPD instance is running on.
+						   MPD_IDLE_TIMEOUT:   Seconds to block waiting for MPD changes before
+						                       checking the connection again. Defaults to 5.
+						   MPD_POOL_SIZE:      The number of connections used to run MPD commands.
+						                       Defaults to 2.
 						   MUSIC_DIR:          The directory that MPD looks for music in.
 						   DEFAULT_ARTWORK:    The URL for default album artwork.
 						   COVERS_DIR:         The directory to save album covers to.
+						   COVERS_SIZE:        The maximum (width, height) of resized album covers.
 						   COVERS_FILETYPE:    The file format to save album covers in.
+						   COVERS_SIZES:       List of (width, height) sizes to resize album covers to.
+						   COVERS_FORMATS:     List of file formats to save resized album covers in.
+						   COVERS_WORKERS:     The number of threads to generate album covers on.
+						                       Defaults to 2.
+						   COVERS_CACHE_MAX_BYTES:   The maximum total size of stored album covers.
+						   COVERS_CACHE_MAX_ENTRIES: The maximum number of stored album covers.
+						   COVERS_PREFETCH:    The number of upcoming songs to generate album covers for.
+						                       Defaults to 3.
 						   AUDIO_EXTENSIONS:   List of allowed audio file extensions.
 						   ARTWORK_EXTENSIONS: List of allowed artwork file extensions.
+						   TMP_DIR:            The directory to save uploaded artwork and the
+						                       journal of artwork changes to.
+						   EMBED_ARTWORK_IN_PLACE: Whether to write changed artwork straight into
+						                       songs which MPD isn't playing, when it fits in the
+						                       padding after their tags. Defaults to False.
+			spawn (func): Starts a background task, given the function to run and a name for it.
+			              Defaults to a daemon thread for each task.
+			offload (func): Runs CPU or file work given the function and its arguments, and returns
+			                its result, so it can be moved off tasks which it would block.
+			                Defaults to running it on the calling task.
 		"""
-		self._locks = []
 		self._callbacks = {}
-		self._idling = False
+		self._update_changed = Event()
+		self._closing = Event()
+		self._add_queue = Queue()
+		self._add_job_ids = count(1)
+		self._idle_timeout = config.get('MPD_IDLE_TIMEOUT', 5)
 		self._config = config
-		self._mpd = MPDClient()
+		self._offload = offload
 		self._musicgen = MusicGen()
-
-		self._mpd.connect(config['MPD_HOST'], config['MPD_PORT'])
+		self._covers = ArtworkCache(config)
+		self._artwork = ArtworkPipeline(self._covers, config.get('COVERS_WORKERS', 2), offload)
+		self._artwork_jobs = JobQueue(
+			path.join(config['TMP_DIR'], 'artwork_jobs.json'),
+			self._embed_artwork,
+			name='artwork-embed-worker')
+
+		self._mpd = MPDMultiplexer(
+			config['MPD_HOST'],
+			config['MPD_PORT'],
+			pool_size=config.get('MPD_POOL_SIZE', 2))
 
 		self.current_song = None
+		self._song_lock = Lock()
+		self._playlist_version = None
+		self.library = LibraryIndex(self._mpd, offload)
+		self.upcoming_artwork = []
+		self._upcoming = []
+		self.artwork_stats = self._covers.stats
+		self.notify_latency = {}
+		self.embed_stats = {'in_place': 0, 'rewritten': 0}
 
-		# Spin off a thread to wait for changes in MPD subsystems
-		self._mpd_thread = Thread(target=self._mpd_idle, name='mpd-worker', args=())
-		self._mpd_thread.setDaemon(True)
-		self._mpd_thread.start()
+		# Spin off a task to wait for changes in MPD subsystems
+		self._mpd_thread = spawn(self._mpd_idle, 'mpd-worker')
+
+		# Spin off a task to add uploaded songs once MPD has found them
+		self._add_thread = spawn(self._add_songs_worker, 'mpd-add-worker')
 
 
 
@@ -105,127 +240,329 @@ class AudioManager(object):
 
 
 
-	def _mpd_acquire(self):
+	def _mpd_idle(self):
 		"""
-		Allows MPD commands to be executed by the main thread.
-		mpd_release() must be called afterwards to allow the idle
-		thread to continue polling.
+		Waits for a change in an MPD subsystem on the dedicated idle connection.
+		When a change is detected, connected clients are notified and
+		the idle thread waits again.
+
+		The MPD socket is blocked on until it becomes readable, so changes
+		are dispatched as soon as MPD reports them.
 		"""
-		self._locks.append(1)
-		if (self._idling):
-			self._mpd.noidle()
-			self._idling = False
+		self._update_current_song()
+		self._playlist_version = self.get_playlist_patch()['version']
+		self.library.request_update()
 
-	def _mpd_release(self):
-		"""Allows the idle thread to continue waiting for subsystem changes."""
-		self._locks.pop()
-		if (not self._locks and not self._idling):
-			self._mpd.send_idle()
-			self._idling = True
+		while not self._closing.is_set():
+			changes, changed_at = self._mpd.wait_for_changes(self._idle_timeout)
+			if changes and not self._closing.is_set():
+				self._dispatch_changes(changes, changed_at)
 
-	def _mpd_idle(self):
+	def close(self):
 		"""
-		Calls `mpd idle`, which waits for a change in an MPD subsystem.
-		When a change is detected, connected clients are notified and
-		`mpd idle` is called again.
+		Stops waiting for MPD changes, then waits for queued artwork changes and artwork
+		being generated to finish, so nothing is written to TMP_DIR or COVERS_DIR afterwards.
+		This can take up to MPD_IDLE_TIMEOUT, and the AudioManager can't be used again.
 		"""
-		self._update_current_song()
-		self._mpd.send_idle()
-		self._idling = True
+		self._closing.set()
+		self._mpd_thread.join()
+		self._artwork_jobs.join()
+		self._artwork.close()
 
-		while True:
-			can_read = select([self._mpd], [], [], 0)[0]
-			if can_read and not self._locks:
-				self._idling = False
-				changes = self._mpd.fetch_idle()
+	def _dispatch_changes(self, changes, changed_at):
+		"""
+		Fires the events for each changed MPD subsystem and records
+		how long each subsystem took to dispatch.
+
+		Arguments:
+			changes (list): The names of the changed MPD subsystems.
+			changed_at (float): UNIX timestamp for when MPD reported the change,
+			                    so the time taken to read it is counted too.
+		"""
+		metrics.trace('mpd change', changes=changes)
+
+		# A database update has started or finished
+		if 'update' in changes:
+			self._update_changed.set()
 
-				if 'player' in changes:
-					self._update_current_song()
+		for subsystem in self.IDLE_SUBSYSTEMS:
+			if subsystem not in changes:
+				continue
 
-				self._mpd.send_idle()
-				self._idling = True
+			if subsystem == 'player':
+				self._update_current_song()
+			elif subsystem == 'playlist':
+				self._update_playlist()
+			elif subsystem == 'database':
+				self.library.request_update()
 
-			time.sleep(1)
+			self.fire_event(subsystem + ' change')
+			self.notify_latency[subsystem] = time.time() - changed_at
+			metrics.observe('mpd_dispatch_seconds', self.notify_latency[subsystem], subsystem=subsystem)
 
+		if 'player' in changes or 'playlist' in changes:
+			self._prefetch_artwork()
 
 
-	def seconds_to_string(self, seconds):
+
+	def send_command(self, name, *args):
 		"""
-		Converts seconds into a time string.
+		Runs an MPD command and updates the current song in the same round trip.
 
 		Arguments:
-			seconds (int): The total number of seconds.
+			name (str): The name of the MPD command.
 
 		Returns:
-			A time string as hh:mm:ss, or mm:ss if there are no hours.
+			The result of the MPD command.
 		"""
-		m, s = divmod(int(float(seconds)), 60)
-		h, m = divmod(m, 60)
+		results, current, status = self.fetch_status((name,) + args)
+		self._update_current_song(current=current, status=status)
 
-		if h:
-			return '{:d}:{:02d}:{:02d}'.format(h, m, s)
-		return '{:d}:{:02d}'.format(m, s)
+		return results[0]
 
+	def fetch_status(self, *commands):
+		"""
+		Runs the given MPD commands followed by `currentsong` and `status`,
+		all within a single MPD command list.
 
+		Arguments:
+			commands (tuple): Each command as a tuple of (command name, arguments...).
 
-	def play(self):
-		"""Plays the current song"""
-		self._mpd_acquire()
+		Returns:
+			A tuple of (list of command results, current song dict, status dict).
+		"""
+		results = self._mpd.command_list(*(commands + (('currentsong',), ('status',))))
 
-		self._mpd.play()
-		self._update_current_song()
+		return results[:-2], results[-2], results[-1]
 
-		self._mpd_release()
+	def play(self):
+		"""Plays the current song"""
+		self.send_command('play')
 
 	def pause(self):
 		"""Pauses the current song"""
-		self._mpd_acquire()
-
-		self._mpd.pause()
-		self._update_current_song()
-
-		self._mpd_release()
+		self.send_command('pause')
 
 	def play_previous_song(self):
 		"""Plays the previous song."""
-		self._mpd_acquire()
-
-		self._mpd.previous()
-		self._update_current_song()
-
-		self._mpd_release()
+		self.send_command('previous')
 
 	def play_next_song(self):
 		"""Plays the next song."""
-		self._mpd_acquire()
+		self.send_command('next')
 
-		self._mpd.next()
-		self._update_current_song()
+	def play_song(self, song_id):
+		"""Plays the song in the playlist with the given MPD song id."""
+		self.send_command('playid', song_id)
+
+	def remove_song(self, song_id):
+		"""Removes the song with the given MPD song id from the playlist."""
+		self._mpd.deleteid(song_id)
+
+	def get_playlist_patch(self, from_version=None):
+		"""
+		Returns the positions in the current playlist which changed since the given version,
+		using `plchangesposid` so only the id of the song at each position is fetched.
+		The songs themselves can be fetched with `get_playlist_songs`.
+
+		Arguments:
+			from_version (int): The MPD playlist version to find changes since,
+			                    or None to only get the current version.
+
+		Returns:
+			A dict containing the following keys:
+			from_version: The given version, or None if every position should be reloaded
+			              because more than MAX_PLAYLIST_CHANGES positions changed.
+			version:      The current playlist version.
+			length:       The number of songs in the playlist. Positions past it have been removed.
+			changes:      A list of [position, song id] for each position which changed.
+		"""
+		if from_version is None:
+			changes, status = [], self._mpd.status()
+		else:
+			changes, status = self._mpd.command_list(('plchangesposid', from_version), ('status',))
+
+		if len(changes) > self.MAX_PLAYLIST_CHANGES:
+			changes, from_version = [], None
+
+		return {
+			'from_version': from_version,
+			'version':      int(status['playlist']),
+			'length':       int(status['playlistlength']),
+			'changes':      [[int(change['cpos']), int(change['id'])] for change in changes]
+		}
+
+	def get_playlist_songs(self, start, end):
+		"""
+		Returns the songs at a range of positions in the current playlist.
+
+		Arguments:
+			start (int): The position of the first song.
+			end (int): The position after the last song.
+
+		Returns:
+			A tuple of the playlist version, and a list of dicts of each song's
+			`id`, `title`, `artist`, `album` and `duration`, which is empty if `end` isn't after `start`.
+		"""
+		# MPD refuses an empty range
+		if end <= start:
+			return int(self._mpd.status()['playlist']), []
 
-		self._mpd_release()
+		songs, status = self._mpd.command_list(('playlistinfo', '{}:{}'.format(start, end)), ('status',))
 
+		return int(status['playlist']), [{
+			'id':       int(song['id']),
+			'title':    song.get('title', path.basename(song['file'])).decode('utf-8'),
+			'artist':   song.get('artist', 'Unknown Artist').decode('utf-8'),
+			'album':    song.get('album', '').decode('utf-8'),
+			'duration': float(song.get('time', 0))
+		} for song in songs]
+
+	def _update_playlist(self):
+		"""Fires the 'playlist patch' event with the changes since the last playlist change."""
+		patch = self.get_playlist_patch(self._playlist_version)
+		self._playlist_version = patch['version']
+
+		self.fire_event('playlist patch', patch)
 
 	def add_new_song(self, filename):
 		"""
-		Updates the database and add a new file to the current playlist.
+		Adds a new file to the current playlist once MPD has added it to its database.
 
 		Arguments:
 			filename (str): The name of the file relative to the music directory.
 
 		Returns:
-			A dict of song data for the added song.
+			The id of the job, which is passed to the 'song added' event.
 		"""
-		self._mpd_acquire()
+		return self.add_new_songs([filename])
 
-		self._mpd.update()
-		self._mpd.idle('database') # Wait for the database to be updated
-		self._mpd.add(filename)
+	def add_new_songs(self, filenames):
+		"""
+		Adds new files to the current playlist once MPD has added them to its database.
+		This returns immediately, and the 'song added' event is fired once they're added.
 
-		song = self._mpd.find('filename', filename)[0]
+		Only the paths of the new files are updated in the database, rather than rescanning
+		the whole music directory. Songs which are added while an update is running are
+		coalesced into the next update.
 
-		self._mpd_release()
+		Arguments:
+			filenames (list): The names of the files relative to the music directory.
 
-		return song
+		Returns:
+			The id of the job, which is passed to the 'song added' event.
+		"""
+		job_id = next(self._add_job_ids)
+		self._add_queue.put((job_id, list(filenames)))
+
+		return job_id
+
+	def _add_songs_worker(self):
+		"""
+		Waits for songs to be added, and adds every song which is waiting
+		with a single database update. If MPD fails, the songs of the affected
+		jobs are reported as errors, and later jobs are still added.
+		"""
+		while True:
+			jobs = [self._add_queue.get()]
+
+			while True:
+				try:
+					jobs.append(self._add_queue.get_nowait())
+				except Empty:
+					break
+
+			filenames = sorted(set(filename for job_id, filenames in jobs for filename in filenames))
+			errors = {}
+			try:
+				for i in range(0, len(filenames), self.MAX_UPDATE_PATHS):
+					errors.update(self._update_database(filenames[i:i + self.MAX_UPDATE_PATHS]))
+			except Exception as e:
+				logger.exception('Failed to update the database for %d songs', len(filenames))
+				errors = dict((filename, str(e)) for filename in filenames)
+
+			for job_id, filenames in jobs:
+				try:
+					self._add_to_playlist(job_id, filenames, errors)
+				except Exception as e:
+					logger.exception('Failed to add the songs of job %d', job_id)
+					self.fire_event('song added', job_id, [], ['{}: {}'.format(filename, e) for filename in filenames])
+
+	def _run_each(self, name, paths):
+		"""
+		Runs an MPD command for each path in a command list. When MPD refuses a path,
+		the commands for the paths after it are sent again in a new command list.
+
+		Arguments:
+			name (str): The name of the MPD command, which takes a path as its only argument.
+			paths (list): The paths to run the command for.
+
+		Returns:
+			A tuple of a list of (path, result) for each path the command was run for, and
+			a dict of error messages by path for the paths which MPD refused. The results
+			of the commands before a refused path are lost, so are None.
+		"""
+		results = []
+		errors = {}
+
+		while paths:
+			try:
+				results += zip(paths, self._mpd.command_list(*[(name, p) for p in paths]))
+				break
+			except CommandListError as e:
+				results += [(p, None) for p in paths[:e.index]]
+				errors[paths[e.index]] = str(e)
+				paths = paths[e.index + 1:]
+
+		return results, errors
+
+	def _update_database(self, paths):
+		"""
+		Updates the given paths in the MPD database with as few command lists as possible,
+		and waits for the update to finish.
+
+		Arguments:
+			paths (list): The paths to update, relative to the music directory.
+
+		Returns:
+			A dict of error messages by path, for the paths which couldn't be updated.
+		"""
+		results, errors = self._run_each('update', paths)
+		if not results:
+			return errors
+
+		# The last update has the highest id, and if its id was lost, every update is waited for instead
+		update_id = results[-1][1]
+
+		while True:
+			self._update_changed.clear()
+
+			# MPD runs updates in order, so it's finished once it has moved past the last one
+			updating_id = self._mpd.status().get('updating_db')
+			if updating_id is None or (update_id is not None and int(updating_id) > int(update_id)):
+				return errors
+
+			self._update_changed.wait(self._idle_timeout)
+
+	def _add_to_playlist(self, job_id, filenames, errors):
+		"""
+		Adds songs to the playlist and fires the 'song added' event.
+
+		Arguments:
+			job_id (int): The id of the job the songs were added with.
+			filenames (list): The names of the files relative to the music directory.
+			errors (dict): Error messages by filename, for files which couldn't be updated
+			               in the database, so can't be added.
+		"""
+		results, add_errors = self._run_each('add', [filename for filename in filenames if filename not in errors])
+		errors = dict(errors)
+		errors.update(add_errors)
+
+		added = [filename for filename, result in results]
+		found = self._mpd.command_list(*[('find', 'file', filename) for filename in added]) if added else []
+
+		self.fire_event('song added', job_id, [songs[0] for songs in found if songs], [
+			'{}: {}'.format(filename, errors[filename]) for filename in filenames if filename in errors])
 
 	def is_allowed_audio_file(self, filename):
 		"""Returns True if the filename has an allowed audio extension."""
@@ -235,101 +572,260 @@ class AudioManager(object):
 		"""Returns True if the filename has an allowed artwork extension."""
 		return '.' in filename and filename.rsplit('.', 1)[1] in self._config['ARTWORK_EXTENSIONS']
 
+	def get_artwork_file(self, filename):
+		"""
+		Returns the path to the album cover with the filename from an artwork URL,
+		or None if the filename isn't an album cover's. The file may have been evicted.
+		"""
+		return self._covers.get_file(filename)
 
 
-	def _get_album_artwork_url(self, song_file):
-		"""Returns the URL for the currently playing song's artwork.
+
+	def _request_album_artwork(self, song_file):
+		"""
+		Returns the artwork of the given song if it has already been generated.
 
 		If the artwork does not already exist on disk, it will be
-		extracted from the audio file. A resized version of the
-		artwork will be created and used to reduce bandwidth.
+		extracted from the audio file in the background and None is returned.
+		The 'artwork ready' event is fired once the artwork is available,
+		if the song is still playing.
 
 		Arguments:
 			song_file (str): The filename of the audio file.
 
 		Returns:
-			A string containing the URL for the resized artwork.
+			A dict of the `src` URL for the largest resized artwork and the `sources`
+			of each format of resized artwork, as described by ArtworkCache, or None.
+		"""
+		def on_artwork_ready(song_file, artwork):
+			if artwork is not None:
+				self._update_artwork(song_file, artwork['src'], artwork['sources'])
+
+		return self._artwork.request(song_file, on_artwork_ready)
+
+	def _update_artwork(self, song_file, url, sources):
 		"""
-		song_file        = current.get('file', None)
-		song_path        = path.join(self._config['MUSIC_DIR'], song_file)
+		Sets the artwork of the current song, if the given song is still playing.
 
-		# The image filename is a hash of the song's filename
-		file_hash        = md5(song_file).hexdigest()
-		file_hash_path   = path.join(self._config['COVERS_DIR'], file_hash)
-		image_file       = file_hash_path + self._config['COVERS_FILETYPE']
+		Arguments:
+			song_file (str): The filename of the song the artwork belongs to.
+			url (str): The URL for the song's largest artwork.
+			sources (list): Each format of the song's artwork, as dicts of `type` and `srcset` attributes.
+		"""
+		with self._song_lock:
+			current_song = self.current_song
+			if current_song is None or current_song['file'] != song_file:
+				return
+
+			self.current_song = dict(current_song, artwork=url, artwork_sources=sources)
+			self.fire_event('artwork ready', self.current_song)
+
+	def _prefetch_artwork(self):
+		"""
+		Generates the artwork of the next songs in the playlist in the background,
+		so it is ready as soon as they start playing.
+		The 'artwork prefetch' event is fired as the artwork becomes ready.
+		"""
+		count = self._config.get('COVERS_PREFETCH', 3)
+		status = self._mpd.status()
+
+		if not count or 'nextsong' not in status:
+			upcoming = []
+		else:
+			start = int(status['nextsong'])
+			# Only the next song is known in advance when playing in random order
+			end = start + (1 if status.get('random') == '1' else count)
+			upcoming = [song['file'] for song in self._mpd.playlistinfo('{}:{}'.format(start, end))]
+
+		artwork = {}
+		self._upcoming = upcoming
+
+		def on_artwork_ready(song_file, song_artwork):
+			if song_artwork is not None:
+				artwork[song_file] = song_artwork
+				self._update_upcoming_artwork(upcoming, artwork)
 
-		# The resized image filename is {image_filename}_{width}_{height}
-		resized_filename = file_hash_path + '_' + '_'.join(map(str, self._config['COVERS_SIZE']))
-		resized_file     = resized_filename + self._config['COVERS_FILETYPE']
+		for song_file in upcoming:
+			song_artwork = self._artwork.request(song_file, on_artwork_ready)
+			if song_artwork is not None:
+				artwork[song_file] = song_artwork
 
-		if not path.isfile(image_file):
-			self._musicgen.extract_cover_art(song_path, image_file)
+		self._update_upcoming_artwork(upcoming, artwork)
 
-			resize = Image.open(image_file)
-			resize.thumbnail(self._config['COVERS_SIZE'])
-			resize.save(resized_file)
+	def _update_upcoming_artwork(self, upcoming, artwork):
+		"""
+		Sets the artwork of the upcoming songs, if they are still the next songs in the playlist.
 
-		return resized_file
+		Arguments:
+			upcoming (list): The filenames of the upcoming songs in playlist order.
+			artwork (dict): The artwork of each upcoming song which is ready, by filename.
+		"""
+		if upcoming is not self._upcoming:
+			return
 
-	def change_album_artwork(self, song_file, artwork_file):
-		"""Embeds the given artwork in the given song file.
-		The artwork file will then be deleted once embedded.
+		upcoming_artwork = [artwork[song_file] for song_file in upcoming if song_file in artwork]
+		if upcoming_artwork != self.upcoming_artwork:
+			self.upcoming_artwork = upcoming_artwork
+			self.fire_event('artwork prefetch', upcoming_artwork)
+
+	def change_album_artwork(self, song_file, artwork_file, whole_album=False):
+		"""
+		Embeds the given artwork in the given song file, or every song in its album.
+		This returns immediately, and the artwork is embedded in the background.
+		The 'artwork changed' event is fired once it's embedded,
+		and the artwork file is then deleted.
 
 		Arguments:
 			song_file (str): The filename of the song to modify the cover art of.
 			artwork_file (str): The path to the artwork file to embed.
+			whole_album (bool): Whether to modify every song with the same album and album artist.
+
+		Returns:
+			The id of the job, which is passed to the 'artwork changed' event.
+		"""
+		song_files = [song_file]
+
+		if whole_album:
+			song = self._mpd.find('file', song_file)[0]
+			album_artist = song.get('albumartist', song.get('artist'))
+
+			song_files = [album_song['file'] for album_song in self._mpd.find('album', song.get('album', ''))
+				if album_song.get('albumartist', album_song.get('artist')) == album_artist] or song_files
+
+		return self._artwork_jobs.put({'songs': song_files, 'artwork': artwork_file})
+
+	def _embed_artwork(self, job):
 		"""
-		song_path = path.join(self._config['MUSIC_DIR'], song_file)
+		Embeds artwork in each song of a job from `change_album_artwork`,
+		then regenerates the songs' cached artwork.
 
-		# The image filename is a hash of the song's filename
-		file_hash      = md5(song_file).hexdigest()
-		file_hash_path = path.join(self._config['COVERS_DIR'], file_hash)
-		image_file     = file_hash_path + self._config['COVERS_FILETYPE']
+		The song is copied to a temporary file which the artwork is embedded in, and then
+		renamed over the song, so MPD never reads a half-written song. The copy is given
+		enough padding for later changes to be written in place.
 
-		self._musicgen.embed_cover_art(song_path, image_file)
+		With EMBED_ARTWORK_IN_PLACE, artwork which fits in the padding after a song's tags
+		is written straight into the song instead, which only rewrites the tags. Songs
+		which MPD may be reading, as the current or upcoming songs, are always copied.
 
-		# Remove existing cached artwork
-		if path.isfile(image_file):
-			# The resized image filename is {image_filename}_{width}_{height}
-			resized_filename = file_hash_path + '_' + '_'.join(map(str, self._config['COVERS_SIZE']))
-			resized_file     = resized_filename + self._config['COVERS_FILETYPE']
+		Arguments:
+			job (dict): The `id` of the job, the `songs` to change, and the `artwork` file to embed.
+		"""
+		changed = []
+		errors = []
+
+		# The artwork is deleted once a job finishes, so a job run again after a restart may have none
+		if not path.isfile(job['artwork']):
+			self.fire_event('artwork changed', job['id'], changed, ['{} no longer exists.'.format(job['artwork'])])
+			return
+
+		in_place = self._config.get('EMBED_ARTWORK_IN_PLACE', False)
+
+		try:
+			for song_file in job['songs']:
+				song_path = path.join(self._config['MUSIC_DIR'], song_file)
+				directory, filename = path.split(song_path)
+				root, extension = path.splitext(filename)
+				tmp_file = path.join(directory, '.{}.tmp{}'.format(root, extension))
+
+				current_song = self.current_song
+				playing = (current_song is not None and current_song['file'] == song_file) or song_file in self._upcoming
+
+				# A song which fails is reported, and the rest of the job carries on
+				try:
+					if self._offload(self._write_artwork, song_path, tmp_file, job['artwork'], in_place and not playing):
+						self.embed_stats['in_place'] += 1
+					else:
+						self.embed_stats['rewritten'] += 1
+
+					# Replace the cached artwork
+					self._covers.remove(song_file)
+					self._covers.generate(song_file, self._offload)
+					changed.append(song_file)
+				except Exception as e:
+					logger.exception('Failed to change the artwork of %s', song_file)
+					errors.append('{}: {}'.format(song_file, e))
+				finally:
+					if path.isfile(tmp_file):
+						remove(tmp_file)
+		finally:
+			if path.isfile(job['artwork']):
+				remove(job['artwork'])
+
+		# Changed artwork is stored under a new URL, so clients fetch it without any cache busting
+		current_song = self.current_song
+		if current_song is not None and current_song['file'] in changed:
+			self._update_current_song()
+
+		self.fire_event('artwork changed', job['id'], changed, errors)
+
+	def _write_artwork(self, song_path, tmp_file, artwork_file, in_place):
+		"""
+		Embeds artwork in a song, in place if allowed and it fits, or otherwise in a copy of
+		the song at the temporary path which is then renamed over it.
+
+		Returns:
+			True if the artwork was embedded in place, or False if the song was rewritten.
+		"""
+		if in_place and self._embed_in_place(song_path, artwork_file):
+			return True
 
-			remove(resized_file)
-			remove(image_file)
+		# Copies the permissions of the song along with its data
+		shutil.copy(song_path, tmp_file)
+		self._musicgen.embed_cover_art(tmp_file, artwork_file)
+		rename(tmp_file, song_path)
+		return False
 
-		remove(artwork_file)
+	def _embed_in_place(self, song_path, artwork_file):
+		"""
+		Embeds artwork straight into a song if it fits in the padding after the song's tags.
 
-		# Update the data for the current song
-		self._mpd_acquire()
-		self._update_current_song(reset_cache=True)
-		self._mpd_release()
+		Returns:
+			True if the artwork was embedded, or False if the song would have to be rewritten.
+		"""
+		try:
+			self._musicgen.embed_cover_art(song_path, artwork_file, in_place_only=True)
+			return True
+		except InsufficientPaddingError:
+			return False
 
-	def _update_current_song(self, reset_cache=False):
+	def _update_current_song(self, current=None, status=None):
 		"""
 		Updates the `current_song` global to contain updated information
-		about the currently playing song.
-		"""
-		current = self._mpd.currentsong()
-		status  = self._mpd.status()
-		timestamp = time.time()
-		cache_control = ''
-
-		if reset_cache:
-			cache_control = '?=' + str(time.time())
-
-		self.current_song = {
-			'artwork':    self._get_album_artwork_url(current['file']) + cache_control,
-			'file':       current['file'],
-			'title':      current['title'].decode('utf-8'),
-			'artist':     current.get('artist', 'Unknown Artist').decode('utf-8'),
-			'album':      current['album'].decode('utf-8'),
-			'length_sec': current['time'],
-			'time_sec':   status['elapsed'],
-			'start_time': timestamp - int(float(status['elapsed'])),
-			'length':     self.seconds_to_string(current['time']),
-			'time':       self.seconds_to_string(status['elapsed']),
-			'progress':   float(status['elapsed']) / float(current['time']) * 100,
-			'is_playing': True if status['state'] == 'play' else False
+		about the currently playing song. The current song is only replaced
+		while holding the song lock, so artwork which becomes ready in the
+		meantime is never applied to the wrong song or lost.
+
+		Arguments:
+			current (dict): The result of `currentsong`, if it has already been fetched.
+			status (dict): The result of `status`, if it has already been fetched.
+		"""
+		if current is None or status is None:
+			current, status = self.fetch_status()[1:]
+
+		song = {
+			'artwork':         self._config['DEFAULT_ARTWORK'],
+			'artwork_sources': [],
+			'file':            current['file'],
+			'id':              int(current.get('id', -1)),
+			'title':           current['title'].decode('utf-8'),
+			'artist':          current.get('artist', 'Unknown Artist').decode('utf-8'),
+			'album':           current['album'].decode('utf-8'),
+			'duration':        float(current.get('time', 0)),
+			'elapsed':         float(status.get('elapsed', 0)),
+			'updated_at':      clock(),
+			'state':           status['state']
 		}
 
-		self.fire_event('song change', self.current_song)
+		with self._song_lock:
+			# The song is set before its artwork is requested, so artwork generated
+			# before this returns is recognised as belonging to the current song
+			self.current_song = song
+
+			with metrics.timer('artwork_lookup_seconds'):
+				artwork = self._request_album_artwork(current['file'])
+
+			if artwork is not None:
+				self.current_song = dict(song, artwork=artwork['src'], artwork_sources=artwork['sources'])
+
+			metrics.trace('song change', file=current['file'], state=status['state'])
+			self.fire_event('song change', self.current_song)
@@ -0,0 +1,641 @@
+"""
+Micro-benchmarks for Sound Bubble.
+
+Benchmarks which talk to MPD use a FakeMPDServer on a local port, which can add
+latency to each response, so results are reproducible on any machine. With
+--real-mpd, they use the MPD_HOST and MPD_PORT from config.py instead, and leave
+the state of the running MPD instance unchanged.
+Artwork benchmarks use the audio files in tests/audio.
+
+The `update` benchmark needs a real MPD. It fills a directory in MUSIC_DIR with
+hard links to a test song to build a large library, and removes them again afterwards.
+
+Results can be saved as JSON with --json, and compared against the results
+saved from another commit with --compare.
+
+Usage:
+	python bench.py [benchmark ...] [--latency MS] [--real-mpd] [--json FILE] [--compare FILE]
+"""
+from mpd_multiplexer import MPDMultiplexer
+from audio_manager import AudioManager, start_thread
+from song_state import VersionedState, is_song_unchanged
+from fanout import FanOut
+from coalescer import Coalescer
+from uploads import ChunkedUploads
+from fake_mpd import FakeMPDServer
+from library import LibraryIndex
+from metrics import Metrics
+from artwork import ArtworkCache
+from musicgen import MusicGen
+from os import path, walk, makedirs, link
+from PIL import Image
+from io import BytesIO
+from threading import Event
+import subprocess
+import argparse
+import random
+import tempfile
+import config
+import shutil
+import struct
+import json
+import time
+
+AUDIO_DIR = 'tests/audio'
+
+# The address of the MPD instance used by benchmarks, which is a FakeMPDServer unless --real-mpd is given
+MPD_ADDRESS = (config.MPD_HOST, config.MPD_PORT)
+
+# The result of each benchmark as dicts of `benchmark`, `name`, `seconds` and `note`, for --json
+RESULTS = []
+
+# The name of the benchmark which is running
+current_benchmark = None
+
+# The FakeMPDServer at MPD_ADDRESS, or None when using a real MPD
+fake_server = None
+
+# The number of clients connecting at once in the `connect_storm` benchmark
+STORM_CLIENTS = 200
+
+# The size of the song uploaded by the `upload` benchmark, and of each chunk
+UPLOAD_SIZE       = 64 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# The number of songs in the library built by the `update` benchmark
+LIBRARY_SIZE = 50000
+
+# Typical sizes of songs in each format, which the test audio files are enlarged to
+SONG_SIZES = {
+	'flac': 30 * 1024 * 1024,
+	'm4a':  8 * 1024 * 1024,
+	'mp3':  8 * 1024 * 1024,
+}
+
+class CountingMultiplexer(MPDMultiplexer):
+	"""An MPDMultiplexer which counts the round trips it makes to MPD."""
+
+	round_trips = 0
+
+	def _send(self, client, commands):
+		self.round_trips += 1
+		return super(CountingMultiplexer, self)._send(client, commands)
+
+def timed(func, iterations):
+	"""
+	Runs a function repeatedly.
+
+	Returns:
+		The average wall time of a single run, in seconds.
+	"""
+	start = time.time()
+	for _ in range(iterations):
+		func()
+	return (time.time() - start) / iterations
+
+def report(name, seconds, note=''):
+	"""Prints and records the result of a benchmark, where seconds may be None for untimed results."""
+	RESULTS.append({'benchmark': current_benchmark, 'name': name, 'seconds': seconds, 'note': note})
+
+	if seconds is None:
+		print('{:<56} {:>13}   {}'.format(name, '', note))
+	else:
+		print('{:<56} {:>10.3f} ms   {}'.format(name, seconds * 1000, note))
+
+def audio_files():
+	"""Returns the paths of the test audio files, relative to the audio directory."""
+	files = []
+	for root, dirs, filenames in walk(AUDIO_DIR):
+		files.extend(path.relpath(path.join(root, filename), AUDIO_DIR) for filename in filenames)
+	return sorted(files)
+
+
+
+def bench_control(iterations):
+	"""
+	Compares a control action followed by separate `currentsong` and `status`
+	calls against the same commands sent in a single command list.
+
+	The control action is a `pause` to the current pause state, so playback is unaffected.
+	"""
+	mpd = CountingMultiplexer(*MPD_ADDRESS, pool_size=1)
+	pause = 0 if mpd.status()['state'] == 'play' else 1
+
+	def separate():
+		mpd.pause(pause)
+		mpd.currentsong()
+		mpd.status()
+
+	def batched():
+		mpd.command_list(('pause', pause), ('currentsong',), ('status',))
+
+	for name, func in (('control action, separate calls', separate), ('control action, command list', batched)):
+		mpd.round_trips = 0
+		seconds = timed(func, iterations)
+		report(name, seconds, '{:.2f} round trips'.format(float(mpd.round_trips) / iterations))
+
+def bench_idle(iterations):
+	"""
+	Times how long a change reported by MPD takes to be dispatched by AudioManager
+	as a 'song change' event. With the fake MPD, also counts the broadcasts left after
+	coalescing a burst of skips through the playlist, and a burst of changes reported by MPD,
+	as the server does before notifying clients.
+
+	The control action is a pause or resume, and playback is left as it was.
+	Changes which aren't dispatched within 5 seconds are left out of the average.
+	"""
+	tmp_dir = tempfile.mkdtemp()
+	changed = Event()
+	changes = []
+
+	audio = AudioManager({
+		'MPD_HOST':           MPD_ADDRESS[0],
+		'MPD_PORT':           MPD_ADDRESS[1],
+		'MPD_IDLE_TIMEOUT':   1,
+		'MUSIC_DIR':          AUDIO_DIR,
+		'DEFAULT_ARTWORK':    '',
+		'COVERS_DIR':         path.join(tmp_dir, 'covers'),
+		'COVERS_SIZE':        config.COVERS_SIZE,
+		'COVERS_FILETYPE':    config.COVERS_FILETYPE,
+		'AUDIO_EXTENSIONS':   config.AUDIO_EXTENSIONS,
+		'ARTWORK_EXTENSIONS': config.ARTWORK_EXTENSIONS,
+		'TMP_DIR':            tmp_dir,
+	})
+
+	@audio.on('song change')
+	def on_song_change(song):
+		changes.append(time.time())
+		changed.set()
+
+	def time_change(change):
+		"""Returns the seconds from making a change until a song change after it, or None if none arrives."""
+		changed.clear()
+		start = time.time()
+		change()
+
+		# A late song change from an earlier change which timed out isn't counted
+		while changed.wait(5):
+			changed.clear()
+			if changes[-1] >= start:
+				return changes[-1] - start
+		return None
+
+	def report_changes(name, change):
+		"""Reports the average time taken by each change, and how many timed out."""
+		samples = [sample for sample in (time_change(change) for _ in range(iterations)) if sample is not None]
+		timed_out = iterations - len(samples)
+		report(name, sum(samples) / len(samples) if samples else None, '{} timed out'.format(timed_out) if timed_out else '')
+
+	def report_burst(name, burst):
+		"""Reports the song changes left after coalescing a burst, and the time taken for all of them."""
+		coalescer = Coalescer(lambda song: None, window, is_song_unchanged)
+
+		@audio.on('song change')
+		def on_burst_song_change(song):
+			on_song_change(song)
+			coalescer.put(song)
+
+		received = len(changes)
+		start = time.time()
+		burst()
+		time.sleep(window * 2 + 0.5)
+
+		report(name, changes[-1] - start if len(changes) > received else None,
+			'{received} song changes, {emitted} broadcast, {coalesced} coalesced, {dropped} dropped'.format(**coalescer.stats))
+
+	window = getattr(config, 'SONG_CHANGE_WINDOW', 0.1)
+	state = None
+
+	try:
+		# The first song change is fired once the idle task has started
+		if not changed.wait(5):
+			raise RuntimeError('AudioManager never fired its first song change')
+		state = audio.current_song['state']
+		iterations = min(iterations, 100)
+
+		report_changes('control action to song change event',
+			lambda: audio._mpd.command_list(('pause', 1 if audio.current_song['state'] == 'play' else 0)))
+
+		if fake_server is None:
+			return
+
+		report_changes('idle change to song change event', lambda: fake_server.emit(['player']))
+
+		report_burst('burst of 10 skips', lambda: [audio.play_next_song() for _ in range(10)])
+		report_burst('burst of 10 idle changes', lambda: fake_server.burst(['player'], 10, interval=0.005))
+	finally:
+		if state is not None:
+			audio._mpd.pause(int(state != 'play'))
+		audio.close()
+		shutil.rmtree(tmp_dir)
+
+def bench_connect_storm(iterations):
+	"""
+	Compares encoding the song snapshot for each of STORM_CLIENTS clients connecting at once
+	against sharing the snapshot encoded once per version, and times publishing a
+	song patch to that many connected clients.
+	"""
+	state = VersionedState()
+	state.update({
+		'artwork':         '/covers/{}_600_600.jpg'.format('0' * 40),
+		'artwork_sources': [{'type': 'image/' + extension, 'srcset': ', '.join(
+			'/covers/{0}_{1}_{1}.{2} {1}w'.format('0' * 40, width, extension) for width in (150, 300, 600))}
+			for extension in ('avif', 'webp', 'jpeg')],
+		'file':       'Artist/Album/01 Song.flac',
+		'id':         1,
+		'title':      u'Song',
+		'artist':     u'Artist',
+		'album':      u'Album',
+		'duration':   240.0,
+		'elapsed':    12.3,
+		'updated_at': time.time(),
+		'state':      'play',
+	})
+
+	encode_event = lambda event, data: json.dumps({'name': event, 'args': [data]}, separators=(',', ':'))
+	encode = lambda snapshot: encode_event('song snapshot', snapshot)
+	note = '{} clients'.format(STORM_CLIENTS)
+
+	report('connect storm, encoded per client', timed(
+		lambda: [encode(state.snapshot()) for _ in range(STORM_CLIENTS)], iterations), note)
+	report('connect storm, shared snapshot', timed(
+		lambda: [state.encoded_snapshot(encode) for _ in range(STORM_CLIENTS)], iterations), note)
+
+	fanout = FanOut(start_thread, encode_event)
+	for client in range(STORM_CLIENTS):
+		fanout.add(str(client), lambda packet: None, ['viewers'])
+
+	patch = {'version': 2, 'changes': {'state': 'pause', 'elapsed': 12.4}}
+	snapshot = state.encoded_snapshot(encode)
+	report('publish song patch', timed(
+		lambda: fanout.publish('song patch', patch, key='song', snapshot=snapshot), iterations), note)
+
+def bench_upload(iterations):
+	"""
+	Times receiving a song of UPLOAD_SIZE in chunks of UPLOAD_CHUNK_SIZE,
+	streamed straight into the upload directory.
+	"""
+	tmp_dir = tempfile.mkdtemp()
+	uploads = ChunkedUploads(tmp_dir, set(['mp3']))
+	data = b'ID3' + b'\0' * (UPLOAD_SIZE - 3)
+	iterations = min(iterations, 5)
+
+	try:
+		start = time.time()
+		for i in range(iterations):
+			filename = 'upload-{}.mp3'.format(i)
+			for offset in range(0, UPLOAD_SIZE, UPLOAD_CHUNK_SIZE):
+				chunk = BytesIO(data[offset:offset + UPLOAD_CHUNK_SIZE])
+				uploads.write(filename, offset, UPLOAD_SIZE, chunk)
+		seconds = (time.time() - start) / iterations
+
+		report('upload {} MB song'.format(UPLOAD_SIZE // 1024 // 1024), seconds,
+			'{:.0f} MB/s in {} MB chunks'.format(UPLOAD_SIZE / seconds / 1024 / 1024, UPLOAD_CHUNK_SIZE // 1024 // 1024))
+	finally:
+		shutil.rmtree(tmp_dir)
+
+def bench_artwork(iterations):
+	"""
+	Compares generating the artwork of each test audio file from an empty
+	covers directory (cold) against looking up the generated artwork (warm).
+	"""
+	covers_dir = tempfile.mkdtemp()
+	covers = ArtworkCache({
+		'MUSIC_DIR':       AUDIO_DIR,
+		'COVERS_DIR':      covers_dir,
+		'COVERS_SIZE':     config.COVERS_SIZE,
+		'COVERS_FILETYPE': config.COVERS_FILETYPE,
+	})
+
+	try:
+		for song_file in audio_files():
+			def cold():
+				covers.remove(song_file)
+				covers.generate(song_file)
+
+			report('cold artwork, ' + song_file, timed(cold, iterations))
+			report('warm artwork, ' + song_file, timed(lambda: covers.lookup(song_file), iterations))
+	finally:
+		shutil.rmtree(covers_dir)
+
+def bench_artwork_variants(iterations):
+	"""
+	Compares the bytes of artwork downloaded by typical clients choosing from `srcset`
+	against the single COVERS_SIZE artwork in COVERS_FILETYPE.
+
+	Clients are assumed to support the most preferred format, and to choose the smallest
+	artwork at least as wide as the displayed width in device pixels.
+	"""
+	# Clients as (name, displayed width in CSS pixels, device pixel ratio), per the sizes in index.html
+	clients = (
+		('laptop',        250,       1),
+		('retina laptop', 250,       2),
+		('phone',         375 * .81, 2),
+		('large phone',   414 * .81, 3),
+	)
+
+	covers_dir = tempfile.mkdtemp()
+	covers = ArtworkCache({
+		'MUSIC_DIR':       AUDIO_DIR,
+		'COVERS_DIR':      covers_dir,
+		'COVERS_SIZE':     config.COVERS_SIZE,
+		'COVERS_FILETYPE': config.COVERS_FILETYPE,
+		'COVERS_SIZES':    getattr(config, 'COVERS_SIZES', [config.COVERS_SIZE]),
+		'COVERS_FORMATS':  getattr(config, 'COVERS_FORMATS', [config.COVERS_FILETYPE]),
+	})
+
+	try:
+		for song_file in audio_files():
+			covers.remove(song_file)
+			generate_time = timed(lambda: covers.generate(song_file), 1)
+			artwork = covers.lookup(song_file)[1]
+			if artwork is None:
+				continue
+
+			report('generate all variants, ' + song_file, generate_time)
+			single_bytes = path.getsize(covers.get_file(path.basename(artwork['src'])))
+			source = artwork['sources'][0]
+			candidates = [candidate.split(' ') for candidate in source['srcset'].split(', ')]
+
+			for name, css_width, pixel_ratio in clients:
+				needed = css_width * pixel_ratio
+				url = next((u for u, width in candidates if int(width[:-1]) >= needed), candidates[-1][0])
+				chosen_bytes = path.getsize(covers.get_file(path.basename(url)))
+
+				report('{} artwork, {}'.format(name, song_file), None, '{} {} bytes instead of {}, {} saved'.format(
+					source['type'], chosen_bytes, single_bytes, single_bytes - chosen_bytes))
+	finally:
+		shutil.rmtree(covers_dir)
+
+def bench_extract(iterations):
+	"""
+	Compares reading the cover art of each test audio file directly from its tags
+	against parsing all of its metadata with mutagen.
+	"""
+	musicgen = MusicGen()
+
+	for song_file in audio_files():
+		song_path = path.join(AUDIO_DIR, song_file)
+
+		report('read cover art, ' + song_file, timed(lambda: musicgen.read_cover_art(song_path), iterations))
+		report('mutagen cover art, ' + song_file, timed(lambda: musicgen._extract_cover_art_tags(song_path), iterations))
+
+class DefaultPaddingMusicGen(MusicGen):
+	"""A MusicGen which saves with mutagen's default padding, as embed_cover_art used to."""
+
+	def _get_padding(self, info, artwork_size):
+		return info.get_default_padding()
+
+def enlarge(song_path, out_path, size):
+	"""Copies an audio file, appending empty data after its audio to reach the given size."""
+	shutil.copyfile(song_path, out_path)
+	padding = size - path.getsize(out_path)
+
+	with open(out_path, 'ab') as out_file:
+		if out_path.endswith('m4a'):
+			# Data after the last MP4 atom must also be an atom
+			out_file.write(struct.pack('>I4s', padding, b'free'))
+			padding -= 8
+		out_file.write(b'\0' * padding)
+
+def bench_embed(iterations):
+	"""
+	Compares changing the artwork of songs enlarged to SONG_SIZES with padding
+	left for artwork, against saving with mutagen's default padding.
+
+	Artwork is first embedded in songs without artwork, and then alternates between
+	a small PNG and a 1000x1000 JPEG. Mutagen's default padding is only a small fraction
+	of the file size, and excess padding is trimmed, so the whole file is rewritten
+	whenever the artwork grows beyond it or shrinks well within it.
+	"""
+	tmp_dir = tempfile.mkdtemp()
+	iterations = min(iterations, 20)
+
+	try:
+		# The artwork in the test songs is much smaller than typical album artwork
+		large_artwork = path.join(tmp_dir, 'large.jpg')
+		Image.effect_noise((1000, 1000), 32).convert('RGB').save(large_artwork, quality=90)
+		artwork_files = ['tests/artwork/art.png', large_artwork]
+
+		for extension, size in sorted(SONG_SIZES.items()):
+			song_path = path.join(tmp_dir, 'song.' + extension)
+
+			for name, musicgen in (('padded', MusicGen()), ('default padding', DefaultPaddingMusicGen())):
+				enlarge(path.join(AUDIO_DIR, extension, '17 Eructation concertmatienne.' + extension), song_path, size)
+				in_place = 0
+
+				start = time.time()
+				for i in range(iterations):
+					in_place += musicgen.embed_cover_art(song_path, artwork_files[i % 2])
+				seconds = (time.time() - start) / iterations
+
+				report('embed artwork, {} MB {}, {}'.format(size // 1024 // 1024, extension, name), seconds,
+					'{}/{} saves in place'.format(in_place, iterations))
+	finally:
+		shutil.rmtree(tmp_dir)
+
+class GeneratedLibraryMPD(object):
+	"""Answers the MPD commands used by LibraryIndex with a generated library of LIBRARY_SIZE songs."""
+
+	WORDS = ('ocean', 'man', 'blue', 'night', 'love', 'dream', 'fire', 'star', 'moon', 'river',
+		'road', 'home', 'heart', 'time', 'light', 'dark', 'summer', 'city', 'gold', 'rain')
+
+	def __init__(self):
+		words = lambda count: ' '.join(random.choice(self.WORDS) for _ in range(count))
+		artists = [words(2).title() for _ in range(LIBRARY_SIZE // 30)]
+
+		self.songs = []
+		for i in range(LIBRARY_SIZE):
+			artist = random.choice(artists)
+			self.songs.append({
+				'file':   '{}/{}.flac'.format(artist, i),
+				'title':  words(3).title(),
+				'artist': artist,
+				'album':  words(2).title(),
+				'time':   str(random.randint(60, 600)),
+			})
+
+	def stats(self):
+		return {'db_update': '0'}
+
+	def listallinfo(self):
+		return self.songs
+
+def bench_search(iterations):
+	"""
+	Times searches of a generated library of LIBRARY_SIZE songs, for the first page of
+	results of common and rare queries, and for queries with no results, which search
+	the whole library.
+	"""
+	random.seed(0)
+	library = LibraryIndex(GeneratedLibraryMPD())
+
+	start = time.time()
+	library._load()
+	report('load library index', time.time() - start, 'library of {} songs'.format(LIBRARY_SIZE))
+
+	for query, prefix in (('ocean', False), ('ocean man night', False), ('ea', False), ('oc', True), ('xyz', False)):
+		name = '{} search, "{}"'.format('prefix' if prefix else 'substring', query)
+		seconds = timed(lambda: library.search(query, 0, 50, prefix), iterations)
+		results, more = library.search(query, 0, 50, prefix)
+		report(name, seconds, '{}{} results'.format(len(results), '+' if more else ''))
+
+def bench_metrics(iterations):
+	"""
+	Times an empty `with` block against the same block timed by metrics,
+	both while metrics are disabled and while they're collected.
+	"""
+	metrics = Metrics()
+	iterations *= 1000
+
+	def timer():
+		with metrics.timer('bench_seconds', event='song patch'):
+			pass
+
+	report('untimed block', timed(lambda: None, iterations))
+	report('timed block, metrics disabled', timed(timer, iterations))
+
+	metrics.configure(enabled=True)
+	report('timed block, metrics enabled', timed(timer, iterations))
+
+def wait_for_update(mpd, update_id):
+	"""Polls MPD until the database update with the given id has finished."""
+	while True:
+		updating_id = mpd.status().get('updating_db')
+		if updating_id is None or int(updating_id) > int(update_id):
+			return
+		time.sleep(0.001)
+
+def bench_update(iterations):
+	"""
+	Compares a full database update against updates of only the paths of new songs,
+	in a library of LIBRARY_SIZE songs.
+
+	New songs are updated with a command list of `update <path>` for each song,
+	as AudioManager.add_new_songs does, and with a separate round trip for each song.
+	"""
+	if isinstance(fake_server, FakeMPDServer):
+		report('update', None, 'skipped, needs --real-mpd')
+		return
+
+	mpd = MPDMultiplexer(*MPD_ADDRESS, pool_size=1)
+	song = path.join(AUDIO_DIR, 'mp3', '14 Betelgeuse_36.mp3')
+	library_dir = 'sound-bubble-bench'
+	library_path = path.join(config.MUSIC_DIR, library_dir)
+	new_songs = []
+
+	def add_songs(count):
+		# Songs are grouped into albums of 10, so MPD scans a realistic number of directories
+		songs = []
+		for i in range(len(new_songs), len(new_songs) + count):
+			album = path.join(library_dir, str(i // 10))
+			if not path.isdir(path.join(config.MUSIC_DIR, album)):
+				makedirs(path.join(config.MUSIC_DIR, album))
+			songs.append(path.join(album, '{}.mp3'.format(i)))
+			link(song, path.join(config.MUSIC_DIR, songs[-1]))
+		new_songs.extend(songs)
+		return songs
+
+	def timed_update(*paths):
+		start = time.time()
+		results = mpd.command_list(*[('update',) + p for p in paths])
+		wait_for_update(mpd, max(int(update_id) for update_id in results))
+		return time.time() - start
+
+	try:
+		add_songs(LIBRARY_SIZE)
+		wait_for_update(mpd, mpd.update(library_dir))
+
+		iterations = min(iterations, 20)
+		full = scoped = batched = separate = 0
+		for _ in range(iterations):
+			add_songs(1)
+			full += timed_update(())
+
+			scoped += timed_update((new_songs[-1],))
+
+			batched += timed_update(*[(filename,) for filename in add_songs(AudioManager.MAX_UPDATE_PATHS)])
+
+			start = time.time()
+			for filename in add_songs(AudioManager.MAX_UPDATE_PATHS):
+				wait_for_update(mpd, mpd.update(filename))
+			separate += time.time() - start
+
+		note = 'library of {} songs'.format(LIBRARY_SIZE)
+		report('full update, 1 new song', full / iterations, note)
+		report('scoped update, 1 new song', scoped / iterations, note)
+		report('scoped update, {} new songs, command list'.format(AudioManager.MAX_UPDATE_PATHS), batched / iterations, note)
+		report('scoped update, {} new songs, separate updates'.format(AudioManager.MAX_UPDATE_PATHS), separate / iterations, note)
+	finally:
+		shutil.rmtree(library_path, ignore_errors=True)
+		wait_for_update(mpd, mpd.update(library_dir))
+
+def get_commit():
+	"""Returns the git commit of the working tree, or None outside a git repository."""
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('utf-8').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare_results(json_file):
+	"""Prints the change in each timed result since the results saved in a JSON file."""
+	with open(json_file) as f:
+		saved = json.load(f)
+
+	previous = dict(((result['benchmark'], result['name']), result['seconds'])
+		for result in saved['results'] if result['seconds'])
+
+	print('\nCompared with {}:'.format(saved.get('commit') or json_file))
+	for result in RESULTS:
+		seconds = previous.get((result['benchmark'], result['name']))
+		if seconds and result['seconds'] is not None:
+			print('{:<56} {:>+10.1f} %    {:.3f} ms -> {:.3f} ms'.format(
+				result['name'], (result['seconds'] - seconds) / seconds * 100, seconds * 1000, result['seconds'] * 1000))
+
+BENCHMARKS = {
+	'idle': bench_idle,
+	'connect_storm': bench_connect_storm,
+	'upload': bench_upload,
+	'control': bench_control,
+	'extract': bench_extract,
+	'artwork': bench_artwork,
+	'artwork_variants': bench_artwork_variants,
+	'update': bench_update,
+	'embed': bench_embed,
+	'search': bench_search,
+	'metrics': bench_metrics,
+}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Runs Sound Bubble micro-benchmarks.')
+	parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS), choices=sorted(BENCHMARKS))
+	parser.add_argument('-n', '--iterations', type=int, default=200)
+	parser.add_argument('-l', '--library-size', type=int, default=LIBRARY_SIZE)
+	parser.add_argument('--latency', type=float, default=1, help='milliseconds the fake MPD waits before each response')
+	parser.add_argument('--real-mpd', action='store_true', help='use the MPD in config.py rather than a fake MPD')
+	parser.add_argument('--json', help='file to save the results to as JSON')
+	parser.add_argument('--compare', help='JSON file of earlier results to compare against')
+	args = parser.parse_args()
+
+	LIBRARY_SIZE = args.library_size
+
+	if not args.real_mpd:
+		fake_server = FakeMPDServer(latency=args.latency / 1000.0)
+		MPD_ADDRESS = ('127.0.0.1', fake_server.port)
+
+	for name in args.benchmarks:
+		current_benchmark = name
+		BENCHMARKS[name](args.iterations)
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump({
+				'commit':     get_commit(),
+				'created_at': time.time(),
+				'mpd':        'real' if args.real_mpd else 'fake, {} ms latency'.format(args.latency),
+				'iterations': args.iterations,
+				'results':    RESULTS,
+			}, f, indent=2, sort_keys=True)
+
+	if args.compare:
+		compare_results(args.compare)
@@ -0,0 +1,95 @@
+from threading import Thread, Event, Lock
+import time
+
+class Coalescer(object):
+	"""
+	Merges bursts of updates into a single update. The first update starts a window,
+	and only the latest update received by the end of the window is passed on,
+	so an update is never delayed by more than the window. Updates which make no
+	difference to the last update passed on are dropped.
+
+	Example:
+		def send_song(song):
+			print('Song is now {}.'.format(song['title']))
+
+		songs = Coalescer(send_song, 0.1)
+		songs.put({'title': 'Ocean Man', 'state': 'pause'})
+		songs.put({'title': 'Ocean Man', 'state': 'play'})
+		# send_song is called once with the playing song
+
+	Properties:
+		stats (dict): The number of updates which were `received` and `emitted`,
+		              and the number suppressed because they were `coalesced` into
+		              a later update, or `dropped` because nothing changed.
+	"""
+
+	def __init__(self, callback, window, is_unchanged=None, name='coalesce-worker'):
+		"""
+		Arguments:
+			callback (func): Called with each update which is passed on.
+			window (float): Seconds to wait for more updates after the first of a burst.
+			                Updates are passed on immediately if this is 0.
+			is_unchanged (func): Called with the last update passed on and a new update,
+			                     returning True if the new update should be dropped.
+			                     Only identical updates are dropped if this is None.
+			name (str): The name of the worker thread.
+		"""
+		self._callback = callback
+		self._window = window
+		self._is_unchanged = is_unchanged or (lambda last, value: last == value)
+		self._lock = Lock()
+		self._pending = Event()
+		self._value = None
+		self._last = None
+
+		self.stats = {'received': 0, 'emitted': 0, 'coalesced': 0, 'dropped': 0}
+
+		if self._window > 0:
+			self._thread = Thread(target=self._work, name=name, args=())
+			self._thread.setDaemon(True)
+			self._thread.start()
+
+	def put(self, value):
+		"""
+		Queues an update, replacing any update which is waiting to be passed on.
+
+		Arguments:
+			value: The update.
+		"""
+		with self._lock:
+			self.stats['received'] += 1
+			if self._pending.is_set():
+				self.stats['coalesced'] += 1
+
+			self._value = value
+			self._pending.set()
+
+		if self._window <= 0:
+			self.flush()
+
+	def flush(self):
+		"""Passes on the waiting update now, unless nothing has changed since the last update."""
+		with self._lock:
+			if not self._pending.is_set():
+				return
+
+			value = self._value
+			self._value = None
+			self._pending.clear()
+
+			# Compared against the last update passed on, as that's the one listeners have
+			if self._last is not None and self._is_unchanged(self._last, value):
+				self.stats['dropped'] += 1
+				return
+
+			self._last = value
+			self.stats['emitted'] += 1
+
+		self._callback(value)
+
+	def _work(self):
+		"""Passes on the latest update at the end of the window started by each burst."""
+		while True:
+			self._pending.wait()
+			time.sleep(self._window)
+			self.flush()
@@ -1,5 +1,9 @@
 DEBUG = False
 
+# Runs every client and background task as a greenlet with 'gevent', or on threads with None.
+# In gevent mode, generating artwork, embedding it and indexing the library run on gevent's thread pool.
+ASYNC_MODE = None
+
 USERNAME   = 'user'
 PASSWORD   = 'password'
 SECRET_KEY = 'development key'
@@ -10,12 +14,45 @@ AUDIO_EXTENSIONS = set(['m4a', 'mp3'])
 ARTWORK_EXTENSIONS = set(['png', 'jpg', 'jpeg'])
 
 COVERS_DIR      = 'static/covers/'
+COVERS_URL      = '/covers/'
 COVERS_SIZE     = (600, 600)
 COVERS_FILETYPE = '.jpg'
+COVERS_WORKERS  = 2
+COVERS_PREFETCH = 3
 DEFAULT_ARTWORK = ''
 
+# Has nginx send album covers from an internal location aliasing COVERS_DIR, where None sends them from Flask.
+# To have Apache or lighttpd send them with X-Sendfile instead, set USE_X_SENDFILE = True.
+COVERS_SENDFILE        = None
+COVERS_SENDFILE_PREFIX = '/internal/covers/'
+
+# Resized album covers for `srcset`, where formats are in order of preference
+COVERS_SIZES   = [(150, 150), (300, 300), (600, 600)]
+COVERS_FORMATS = ['.avif', '.webp', '.jpg']
+
+# Budget for stored album covers, where None is unlimited
+COVERS_CACHE_MAX_BYTES   = 256 * 1024 * 1024
+COVERS_CACHE_MAX_ENTRIES = None
+
 MUSIC_DIR = '/home/me/Music/'
 MPD_HOST  = 'localhost'
 MPD_PORT  = 6600
+MPD_IDLE_TIMEOUT = 5
+MPD_POOL_SIZE    = 2
+
+# Seconds to gather bursts of song changes before sending them to clients, where 0 sends each change
+SONG_CHANGE_WINDOW = 0.1
+
+# The most unsent events queued for each client, beyond which the oldest are dropped
+CLIENT_QUEUE_DEPTH = 16
+
+# Collects timings and counters for Prometheus at /metrics, and appends a line of JSON
+# for each step of every song change to the trace file, where None disables tracing
+METRICS_ENABLED    = False
+METRICS_TRACE_FILE = None
+
+# Writes changed artwork straight into songs which aren't playing when it fits their tag padding,
+# rather than rewriting a copy and renaming it over the song. MPD may see a half-written tag meanwhile.
+EMBED_ARTWORK_IN_PLACE = False
 
 TMP_DIR = 'static/tmp/'
@@ -0,0 +1,351 @@
+from threading import Thread, Lock
+import socket
+import time
+
+class _CommandFailure(Exception):
+	"""Exception for a command which the fake server refuses, with the MPD error code."""
+
+	def __init__(self, code, message):
+		super(_CommandFailure, self).__init__(message)
+		self.code = code
+
+class _Connection(object):
+	"""
+	A client connected to the fake server.
+
+	Properties:
+		changes (set): The subsystems which changed since the client last idled.
+		idling (bool): Whether the client is waiting in `idle`.
+	"""
+
+	def __init__(self, sock):
+		self.socket = sock
+		self.file = sock.makefile('rb')
+		self.changes = set()
+		self.idling = False
+
+class FakeMPDServer(object):
+	"""
+	A stand-in for MPD on a local port, which speaks enough of the MPD protocol
+	for AudioManager, with a generated playlist of songs. Each response can be
+	delayed to simulate a slow or remote MPD, and bursts of subsystem changes can
+	be sent to idling clients, so benchmarks are reproducible without a real MPD.
+
+	Example:
+		server = FakeMPDServer(songs=100, latency=0.002)
+		mpd = MPDMultiplexer('127.0.0.1', server.port)
+		server.burst(['player'], 5, 0.01)
+
+	Properties:
+		port (int): The port the server is listening on.
+		latency (float): Seconds to wait before sending each response.
+		requests (int): The number of requests answered, where a command list is one request.
+	"""
+
+	VERSION = '0.19.0'
+
+	def __init__(self, songs=100, latency=0, host='127.0.0.1'):
+		"""
+		Arguments:
+			songs (int): The number of songs in the playlist.
+			latency (float): Seconds to wait before sending each response.
+			host (str): The address to listen on.
+		"""
+		self._lock = Lock()
+		self._connections = []
+		self._songs = [{
+			'file':   'Artist {}/Album {}/{:02d} Song {}.flac'.format(i // 100, i // 10, i % 10 + 1, i),
+			'Title':  'Song {}'.format(i),
+			'Artist': 'Artist {}'.format(i // 100),
+			'Album':  'Album {}'.format(i // 10),
+			'Time':   str(180 + i % 120),
+		} for i in range(songs)]
+
+		# The playlist as song ids, and the playlist version each position last changed in
+		self._ids = list(range(1, songs + 1))
+		self._changed_in = [1] * songs
+		self._new_files = set()
+		self._version = 1
+		self._position = 0
+		self._state = 'play'
+		self._update_id = 0
+
+		self.latency = latency
+		self.requests = 0
+
+		self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self._socket.bind((host, 0))
+		self._socket.listen(128)
+		self.port = self._socket.getsockname()[1]
+
+		thread = Thread(target=self._accept, name='fake-mpd-accept', args=())
+		thread.setDaemon(True)
+		thread.start()
+
+	def close(self):
+		"""Stops accepting connections and closes every connection."""
+		self._socket.close()
+		self.disconnect()
+
+	def disconnect(self):
+		"""Closes every connection while still accepting new ones, as when MPD drops its clients."""
+		with self._lock:
+			for connection in self._connections:
+				try:
+					connection.socket.shutdown(socket.SHUT_RDWR)
+				except socket.error:
+					pass
+				connection.socket.close()
+
+	def emit(self, subsystems):
+		"""
+		Reports changes to subsystems to every client, as MPD does.
+
+		Arguments:
+			subsystems (list): The names of the changed subsystems.
+		"""
+		with self._lock:
+			for connection in self._connections:
+				connection.changes.update(subsystems)
+				if connection.idling:
+					self._send_changes(connection)
+
+	def add_file(self, filename):
+		"""
+		Adds a file to the music directory, which is added to the database once its path is updated.
+
+		Arguments:
+			filename (str): The name of the file relative to the music directory.
+		"""
+		with self._lock:
+			self._new_files.add(filename)
+
+	def burst(self, subsystems, count, interval=0):
+		"""
+		Reports the same changes several times in quick succession, as when skipping through songs.
+
+		Arguments:
+			subsystems (list): The names of the changed subsystems.
+			count (int): The number of times to report the changes.
+			interval (float): Seconds between each report.
+		"""
+		for _ in range(count):
+			self.emit(subsystems)
+			time.sleep(interval)
+
+	def _accept(self):
+		"""Answers each new connection on its own thread."""
+		while True:
+			try:
+				sock, address = self._socket.accept()
+			except socket.error:
+				return
+
+			# Responses are small and latency is added deliberately, so they're never delayed for batching
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			connection = _Connection(sock)
+			with self._lock:
+				self._connections.append(connection)
+
+			thread = Thread(target=self._serve, name='fake-mpd-connection', args=(connection,))
+			thread.setDaemon(True)
+			thread.start()
+
+	def _serve(self, connection):
+		"""Reads requests from a client until it disconnects."""
+		try:
+			connection.socket.sendall('OK MPD {}\n'.format(self.VERSION).encode('utf-8'))
+
+			while True:
+				line = connection.file.readline().decode('utf-8')
+				if not line:
+					break
+
+				line = line.strip()
+				if line == 'command_list_ok_begin':
+					commands = []
+					while True:
+						line = connection.file.readline().decode('utf-8').strip()
+						if line == 'command_list_end' or not line:
+							break
+						commands.append(line)
+					response = self._run_list(commands)
+				elif line.startswith('idle'):
+					with self._lock:
+						connection.idling = True
+						if connection.changes:
+							self._send_changes(connection)
+					continue
+				elif line == 'noidle':
+					with self._lock:
+						if not connection.idling:
+							continue
+						connection.idling = False
+						connection.changes.clear()
+					response = 'OK\n'
+				elif line == 'close':
+					break
+				else:
+					response = self._run_list([line], single=True)
+
+				if self.latency:
+					time.sleep(self.latency)
+				self.requests += 1
+				connection.socket.sendall(response.encode('utf-8'))
+		except socket.error:
+			pass
+		finally:
+			with self._lock:
+				self._connections.remove(connection)
+			connection.socket.close()
+
+	def _send_changes(self, connection):
+		"""Answers a client's `idle` with the changed subsystems. Must be called with the lock held."""
+		response = ''.join('changed: {}\n'.format(subsystem) for subsystem in sorted(connection.changes))
+		connection.changes.clear()
+		connection.idling = False
+
+		try:
+			connection.socket.sendall((response + 'OK\n').encode('utf-8'))
+		except socket.error:
+			pass
+
+	def _run_list(self, lines, single=False):
+		"""Returns the response to a command, or a command list, stopping at the first error."""
+		response = ''
+
+		for index, line in enumerate(lines):
+			parts = line.split(' ', 1)
+			name = parts[0]
+			args = [arg.strip('"') for arg in parts[1].split('" "')] if len(parts) > 1 else []
+			command = getattr(self, '_command_' + name, None)
+
+			if command is None:
+				return response + 'ACK [5@{}] {{{}}} unknown command "{}"\n'.format(index, name, name)
+
+			try:
+				with self._lock:
+					lines_out, changes = command(*args)
+			except _CommandFailure as e:
+				return response + 'ACK [{}@{}] {{{}}} {}\n'.format(e.code, index, name, e)
+
+			response += ''.join('{}: {}\n'.format(key, value) for key, value in lines_out)
+			response += 'OK\n' if single else 'list_OK\n'
+
+			if changes:
+				self.emit(changes)
+
+		return response if single else response + 'OK\n'
+
+	def _song_lines(self, position):
+		"""Returns the lines describing the song at a position in the playlist."""
+		song_id = self._ids[position]
+		song = self._songs[song_id - 1]
+		return [(key, song[key]) for key in ('file', 'Title', 'Artist', 'Album', 'Time')] + [('Pos', position), ('Id', song_id)]
+
+	def _change_playlist(self, position):
+		"""Records that the playlist changed from a position onwards."""
+		self._version += 1
+		for changed in range(position, len(self._ids)):
+			self._changed_in[changed] = self._version
+
+
+
+	def _command_ping(self):
+		return [], None
+
+	def _command_status(self):
+		status = [
+			('volume', 100), ('repeat', 0), ('random', 0), ('single', 0), ('consume', 0),
+			('playlist', self._version), ('playlistlength', len(self._ids)), ('state', self._state)]
+
+		if self._ids:
+			status += [('song', self._position), ('songid', self._ids[self._position]), ('elapsed', '12.345')]
+			if self._position + 1 < len(self._ids):
+				status += [('nextsong', self._position + 1), ('nextsongid', self._ids[self._position + 1])]
+		return status, None
+
+	def _command_stats(self):
+		return [('songs', len(self._songs)), ('db_update', 1)], None
+
+	def _command_currentsong(self):
+		return (self._song_lines(self._position) if self._ids else []), None
+
+	def _command_play(self, position=None):
+		if position is not None:
+			self._position = int(position)
+		self._state = 'play'
+		return [], ['player']
+
+	def _command_pause(self, pause=None):
+		self._state = 'pause' if pause == '1' or (pause is None and self._state == 'play') else 'play'
+		return [], ['player']
+
+	def _command_next(self):
+		self._position = (self._position + 1) % len(self._ids)
+		return [], ['player']
+
+	def _command_previous(self):
+		self._position = (self._position - 1) % len(self._ids)
+		return [], ['player']
+
+	def _command_playid(self, song_id):
+		self._position = self._ids.index(int(song_id))
+		return [], ['player']
+
+	def _command_deleteid(self, song_id):
+		position = self._ids.index(int(song_id))
+		del self._ids[position]
+		del self._changed_in[position]
+		self._change_playlist(position)
+		self._position = min(self._position, max(len(self._ids) - 1, 0))
+		return [], ['playlist']
+
+	def _command_playlistinfo(self, positions=None):
+		if positions is None:
+			start, end = 0, len(self._ids)
+		elif ':' in positions:
+			start, end = [int(position) for position in positions.split(':')]
+		else:
+			start, end = int(positions), int(positions) + 1
+
+		return [line for position in range(start, min(end, len(self._ids))) for line in self._song_lines(position)], None
+
+	def _command_plchangesposid(self, version):
+		changed = [position for position, changed_in in enumerate(self._changed_in) if changed_in > int(version)]
+		return [line for position in changed for line in (('cpos', position), ('Id', self._ids[position]))], None
+
+	def _command_listallinfo(self):
+		return [(key, song[key]) for song in self._songs for key in ('file', 'Title', 'Artist', 'Album', 'Time')], None
+
+	def _command_listall(self):
+		return [('file', song['file']) for song in self._songs], None
+
+	def _command_find(self, tag, value):
+		# Tags are matched case insensitively, as MPD does
+		tag = tag.capitalize() if tag != 'file' else tag
+		return [(key, song[key]) for song in self._songs if song.get(tag) == value
+			for key in ('file', 'Title', 'Artist', 'Album', 'Time')], None
+
+	def _command_update(self, *args):
+		if args and '..' in args[0]:
+			raise _CommandFailure(2, 'Malformed path')
+
+		for filename in sorted(self._new_files):
+			if not args or filename.startswith(args[0]):
+				self._new_files.remove(filename)
+				self._songs.append({'file': filename, 'Title': filename, 'Artist': '', 'Album': '', 'Time': '60'})
+
+		self._update_id += 1
+		return [('updating_db', self._update_id)], ['update', 'database']
+
+	def _command_add(self, filename):
+		songs = [song_id for song_id, song in enumerate(self._songs, 1) if song['file'] == filename]
+		if not songs:
+			raise _CommandFailure(50, 'No such directory')
+
+		self._ids.append(songs[0])
+		self._changed_in.append(self._version + 1)
+		self._version += 1
+		return [], ['playlist']
@@ -0,0 +1,174 @@
+from threading import Event, Lock
+from collections import OrderedDict
+from itertools import count
+from metrics import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+class _Client(object):
+	"""
+	A connected client and the events waiting to be sent to it.
+
+	Properties:
+		pending (OrderedDict): The unsent packets, by key.
+		rooms (set): The names of the rooms the client is in.
+		sent (int): The number of events sent to the client.
+		dropped (int): The number of events which were never sent, because
+		               they were replaced by newer state or the queue was full.
+	"""
+
+	def __init__(self, send, rooms, is_ready):
+		self.send = send
+		self.is_ready = is_ready
+		self.pending = OrderedDict()
+		self.rooms = set(rooms)
+		self.sent = 0
+		self.dropped = 0
+
+class FanOut(object):
+	"""
+	Sends events to rooms of connected clients, giving each client its own bounded
+	queue. An event is only handed to a client once the client is ready for more,
+	so a slow client never builds up a backlog in server memory. Instead, events
+	which update the same state replace each other while they wait, so a client
+	which falls behind only receives the latest state once it catches up.
+
+	Each event is encoded once for every client, by a function which turns it into
+	whatever packet the clients' transport sends, and sent by a single background task,
+	which sleeps until an event is published or `notify_ready` is called.
+
+	Example:
+		fanout = FanOut(start_thread, lambda event, data: json.dumps([event, data]))
+		fanout.add('abc', send_to_abc, ['viewers'])
+		fanout.publish('song patch', patch, room='viewers', key='song')
+
+	Properties:
+		stats (dict): The queue `depth`, `sent` and `dropped` counts and `rooms` of each client, by client id.
+	"""
+
+	def __init__(self, spawn, encode, max_depth=16):
+		"""
+		Arguments:
+			spawn (func): Starts a background task, given the function to run and a name for it.
+			encode (func): Returns the packet to send to clients, given the name and data of an event.
+			max_depth (int): The most unsent events for a client, beyond which the oldest is dropped.
+		"""
+		self._encode = encode
+		self._max_depth = max_depth
+		self._clients = {}
+		self._lock = Lock()
+		self._wakeup = Event()
+		self._keys = count(1)
+
+		self._task = spawn(self._work, 'fanout-worker')
+
+	@property
+	def stats(self):
+		with self._lock:
+			return dict((client_id, {
+				'depth':   len(client.pending),
+				'sent':    client.sent,
+				'dropped': client.dropped,
+				'rooms':   sorted(client.rooms),
+			}) for client_id, client in self._clients.items())
+
+	def add(self, client_id, send, rooms=(), is_ready=None):
+		"""
+		Adds a connected client.
+
+		Arguments:
+			client_id (str): The id of the client's session.
+			send (func): Sends a packet from the `encode` function to the client.
+			rooms (list): The names of the rooms the client is in.
+			is_ready (func): Returns whether the client has received everything sent to it so far.
+			                 Events are sent as soon as they're published if this is None,
+			                 otherwise `notify_ready` must be called once it becomes True.
+		"""
+		with self._lock:
+			self._clients[client_id] = _Client(send, rooms, is_ready or (lambda: True))
+
+	def remove(self, client_id):
+		"""Removes a disconnected client, along with its unsent events."""
+		with self._lock:
+			self._clients.pop(client_id, None)
+
+	def notify_ready(self):
+		"""Sends the unsent events of clients which have become ready, such as when a client's transport drains."""
+		self._wakeup.set()
+
+	def publish(self, event, data, room=None, key=None, snapshot=None, clients=None):
+		"""
+		Queues an event to be sent to each client in a room.
+
+		Arguments:
+			event (str): The name of the event.
+			data: The data of the event, which must be serializable as JSON.
+			room (str): The room to send the event to, or None to send it to every client.
+			key (str): The state the event updates, so it replaces an unsent event for the
+			           same state. None if the event must never be replaced.
+			snapshot (str): The encoded packet to send instead of the event to a client
+			                which hasn't been sent the last event for the same key, for events
+			                which only hold the changes since the last event.
+			clients (list): The ids of the clients to send the event to, or None to send it to every
+			                client in the room.
+		"""
+		if key is None:
+			key = next(self._keys)
+
+		with metrics.timer('fanout_publish_seconds', event=event):
+			self._publish(self._encode(event, data), room, key, snapshot, clients)
+
+		self._wakeup.set()
+
+	def _publish(self, packet, room, key, snapshot, client_ids):
+		"""Queues an encoded event for each client in a room."""
+		with self._lock:
+			if client_ids is None:
+				clients = self._clients.values()
+			else:
+				clients = [self._clients[client_id] for client_id in client_ids if client_id in self._clients]
+
+			for client in clients:
+				if room is not None and room not in client.rooms:
+					continue
+
+				if key in client.pending:
+					client.pending[key] = snapshot or packet
+					client.dropped += 1
+					continue
+
+				if len(client.pending) >= self._max_depth:
+					client.pending.popitem(last=False)
+					client.dropped += 1
+
+				client.pending[key] = packet
+
+	def _work(self):
+		"""Sends the oldest unsent event of each ready client, until no client is ready."""
+		while True:
+			self._wakeup.wait()
+			self._wakeup.clear()
+
+			while self._send_ready():
+				pass
+
+	def _send_ready(self):
+		"""
+		Sends the oldest unsent event to each client which is ready for it.
+
+		Returns:
+			True if any events were sent.
+		"""
+		with self._lock:
+			ready = [(client, client.pending.popitem(last=False)[1])
+				for client in self._clients.values() if client.pending and client.is_ready()]
+
+		for client, packet in ready:
+			try:
+				client.send(packet)
+				client.sent += 1
+			except Exception:
+				logger.exception('Failed to send an event')
+
+		return bool(ready)
@@ -0,0 +1,114 @@
+from threading import Thread, Lock
+from Queue import Queue
+from os import rename
+import logging
+import json
+
+logger = logging.getLogger(__name__)
+
+def run_inline(func, *args):
+	"""
+	Calls a function with the given arguments and returns its result. This is the default way to
+	run blocking work which is passed as `offload`, which only needs to move off the calling thread
+	when tasks are greenlets that blocking work would stop.
+	"""
+	return func(*args)
+
+class JobQueue(object):
+	"""
+	Runs jobs one at a time on a worker thread, recording each job in a journal
+	file until it has finished. Jobs which were waiting or running when the
+	process stopped are run again when the queue is next created, so handlers
+	should be safe to run more than once for the same job.
+
+	Example:
+		def handle_job(job):
+			print('Running job {} for {}'.format(job['id'], job['song']))
+
+		queue = JobQueue('jobs.json', handle_job)
+		queue.put({'song': 'song.mp3'})
+
+	Properties:
+		pending (int): The number of jobs which haven't finished.
+	"""
+
+	def __init__(self, journal_file, handler, name='job-worker'):
+		"""
+		Arguments:
+			journal_file (str): The path of the file to record unfinished jobs in.
+			handler (func): Called with each job dict, which includes its `id`.
+			name (str): The name of the worker thread.
+		"""
+		self._journal_file = journal_file
+		self._handler = handler
+		self._lock = Lock()
+		self._queue = Queue()
+		self._jobs = self._load_journal()
+		self._next_id = max([job['id'] for job in self._jobs] or [0]) + 1
+
+		for job in self._jobs:
+			self._queue.put(job)
+
+		self._thread = Thread(target=self._work, name=name, args=())
+		self._thread.setDaemon(True)
+		self._thread.start()
+
+	@property
+	def pending(self):
+		return len(self._jobs)
+
+	def put(self, job):
+		"""
+		Records a job in the journal and queues it to be run.
+
+		Arguments:
+			job (dict): The job, which must be serializable as JSON.
+
+		Returns:
+			The id of the job.
+		"""
+		with self._lock:
+			job = dict(job, id=self._next_id)
+			self._next_id += 1
+
+			self._jobs.append(job)
+			self._save_journal()
+
+		self._queue.put(job)
+		return job['id']
+
+	def join(self):
+		"""Waits until every queued job has finished and been removed from the journal."""
+		self._queue.join()
+
+	def _work(self):
+		"""Runs each job as it's queued, and removes it from the journal once finished."""
+		while True:
+			job = self._queue.get()
+
+			try:
+				self._handler(job)
+			except Exception:
+				# A failing job is dropped rather than retried forever
+				logger.exception('Job %s failed', job['id'])
+
+			with self._lock:
+				self._jobs.remove(job)
+				self._save_journal()
+
+			self._queue.task_done()
+
+	def _load_journal(self):
+		"""Returns the unfinished jobs recorded in the journal."""
+		try:
+			with open(self._journal_file) as journal:
+				return json.load(journal)
+		except (IOError, ValueError):
+			return []
+
+	def _save_journal(self):
+		"""Writes the unfinished jobs to a temporary file and renames it over the journal."""
+		tmp_file = self._journal_file + '.tmp'
+		with open(tmp_file, 'w') as journal:
+			json.dump(self._jobs, journal)
+		rename(tmp_file, self._journal_file)
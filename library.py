@@ -0,0 +1,227 @@
+from threading import Thread, Event, Lock
+from bisect import bisect_right
+from array import array
+from jobs import run_inline
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Separates the fields of a track in the search text, so matches can't span fields
+FIELD_SEPARATOR = u'\x00'
+
+# Separates tracks in the search text
+TRACK_SEPARATOR = u'\n'
+
+# Marks the start of each word in the search text, so prefix searches are also a single `find`
+WORD_MARK = u'\x01'
+
+def _get_search_text(fields):
+	"""Returns the lowercase search text of the fields of a song, with each word marked."""
+	return FIELD_SEPARATOR.join(WORD_MARK + (u' ' + WORD_MARK).join(field.lower().split()) for field in fields)
+
+def _decode(value):
+	"""Returns a tag value from MPD as unicode, using the first value of repeated tags."""
+	if isinstance(value, list):
+		value = value[0]
+	return value.decode('utf-8') if isinstance(value, bytes) else value
+
+class LibraryIndex(object):
+	"""
+	Holds the metadata of every song in the MPD library in memory for fast searching.
+
+	Each field of the songs is stored as a column, with repeated artists and albums
+	interned so they're only stored once. The lowercase title, artist and album of
+	every song are joined into one search text, which is searched with `str.find`,
+	and matches are mapped back to songs by bisecting an array of each song's offset.
+	The start of each word is marked in the search text, so searches for the start
+	of words are also a single `str.find`.
+
+	The index is loaded on a worker thread, and reloaded whenever `request_update`
+	is called. Songs which were modified since the last update are fetched with
+	`find modified-since`, and added and removed songs are found with `listall`,
+	so the whole library is only fetched the first time. Added songs are fetched
+	by filename, as files copied with their modification time preserved are
+	older than the last update.
+
+	Example:
+		library = LibraryIndex(mpd)
+		library.request_update()
+		results, more = library.search('ocean', limit=10)
+
+	Properties:
+		loaded (bool): Whether the index has been loaded.
+	"""
+
+	# The MPD song fields stored for each song
+	FIELDS = ('file', 'title', 'artist', 'album', 'time')
+
+	# The most added songs to fetch in one command list
+	FETCH_BATCH = 100
+
+	def __init__(self, mpd, offload=run_inline):
+		"""
+		Arguments:
+			mpd (MPDMultiplexer): The connection to fetch the library from.
+			offload (func): Runs the building of the search text given the function and its
+			                arguments. Defaults to running it on the worker thread.
+		"""
+		self._mpd = mpd
+		self._offload = offload
+		self._lock = Lock()
+		self._stale = Event()
+		self._updated_at = None
+		self._songs = {}
+		self._strings = {}
+
+		self._set_columns([])
+		self.loaded = False
+
+		self._thread = Thread(target=self._work, name='library-worker', args=())
+		self._thread.setDaemon(True)
+		self._thread.start()
+
+	def request_update(self):
+		"""Reloads the index on the worker thread, after the MPD database has changed."""
+		self._stale.set()
+
+	def search(self, query, offset=0, limit=50, prefix=False):
+		"""
+		Searches the title, artist and album of each song.
+
+		Arguments:
+			query (str): The text to search for, ignoring case.
+			offset (int): The number of matching songs to skip.
+			limit (int): The maximum number of matching songs to return.
+			prefix (bool): Whether to only match the start of words.
+
+		Returns:
+			A tuple of a list of the matching songs in library order, as dicts of each of
+			FIELDS, and whether there are more matching songs after them.
+		"""
+		query = _decode(query)
+		if any(separator in query for separator in (FIELD_SEPARATOR, TRACK_SEPARATOR, WORD_MARK)):
+			return [], False
+
+		# Words in the search text are marked, so the query's words are too
+		query = (u' ' + WORD_MARK).join(query.lower().split())
+		if not query:
+			return [], False
+		if prefix:
+			query = WORD_MARK + query
+
+		# Taken as one reference so the columns can't change during the search
+		columns = self._columns
+		text, offsets = columns['text'], columns['offsets']
+		indexes = []
+		position = text.find(query)
+
+		while position != -1 and len(indexes) <= offset + limit:
+			index = bisect_right(offsets, position) - 1
+			indexes.append(index)
+
+			# Each song is only matched once
+			position = text.find(query, offsets[index + 1]) if index + 1 < len(offsets) else -1
+
+		results = [self._get_song(columns, index) for index in indexes[offset:offset + limit]]
+		return results, len(indexes) > offset + limit
+
+	def _get_song(self, columns, index):
+		"""Returns a dict of the fields of the song at the given index of the columns."""
+		song = dict((field, columns[field][index]) for field in self.FIELDS if field != 'time')
+		song['time'] = columns['time'][index]
+		return song
+
+	def _work(self):
+		"""
+		Loads the index whenever an update is requested. If MPD fails, the index is kept
+		as it was, and the whole library is loaded again on the next update.
+		"""
+		while True:
+			self._stale.wait()
+			self._stale.clear()
+
+			try:
+				if self.loaded:
+					self._update()
+				else:
+					self._load()
+			except Exception:
+				logger.exception('Failed to update the library index')
+				self.loaded = False
+
+	def _load(self):
+		"""Loads every song in the library."""
+		updated_at = self._mpd.stats().get('db_update')
+		songs = {}
+
+		for song in self._mpd.listallinfo():
+			if 'file' in song:
+				songs[song['file']] = self._compact_song(song)
+
+		with self._lock:
+			self._songs = songs
+			self._updated_at = updated_at
+			self._offload(self._set_columns, songs)
+			self.loaded = True
+
+	def _update(self):
+		"""Updates the songs which were added, modified or removed since the last update."""
+		updated_at = self._mpd.stats().get('db_update')
+		if updated_at == self._updated_at:
+			return
+
+		changed = self._mpd.find('modified-since', self._updated_at or '0')
+		files = set(item['file'] for item in self._mpd.listall() if 'file' in item)
+
+		# Songs which are new to the index, but weren't modified since the last update
+		added = sorted(files - set(self._songs) - set(song['file'] for song in changed))
+		for i in range(0, len(added), self.FETCH_BATCH):
+			for found in self._mpd.command_list(*[('find', 'file', song_file) for song_file in added[i:i + self.FETCH_BATCH]]):
+				changed += found
+
+		with self._lock:
+			songs = dict((song_file, song) for song_file, song in self._songs.items() if song_file in files)
+			for song in changed:
+				songs[song['file']] = self._compact_song(song)
+
+			# Artists and albums which no longer have any songs are dropped from the interned strings
+			self._strings = dict((string, string) for song in songs.values() for string in song[2:4])
+
+			self._songs = songs
+			self._updated_at = updated_at
+			self._offload(self._set_columns, songs)
+
+	def _compact_song(self, song):
+		"""
+		Returns the fields of a song from MPD as a tuple in the order of FIELDS,
+		with artists and albums interned, so each is only stored once.
+		"""
+		artist = _decode(song.get('artist', 'Unknown Artist'))
+		album = _decode(song.get('album', ''))
+
+		return (
+			song['file'],
+			_decode(song.get('title', song['file'].rsplit('/', 1)[-1])),
+			self._strings.setdefault(artist, artist),
+			self._strings.setdefault(album, album),
+			int(float(song.get('time', 0))),
+		)
+
+	def _set_columns(self, songs):
+		"""Replaces the columns and search text with the given songs, sorted by filename."""
+		rows = [songs[song_file] for song_file in sorted(songs)]
+
+		columns = dict((field, [row[i] for row in rows]) for i, field in enumerate(self.FIELDS) if field != 'time')
+		columns['time'] = array('I', (row[-1] for row in rows))
+
+		texts = [_get_search_text(row[1:4]) for row in rows]
+		offsets = array('I')
+		position = 0
+		for text in texts:
+			offsets.append(position)
+			position += len(text) + len(TRACK_SEPARATOR)
+
+		columns['text'] = TRACK_SEPARATOR.join(texts)
+		columns['offsets'] = offsets
+
+		self._columns = columns
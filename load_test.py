@@ -0,0 +1,250 @@
+"""
+Measures how long song changes take to reach many Socket.IO clients at once.
+
+Opens the given number of WebSocket clients to a running server, each as a greenlet,
+then pauses and resumes MPD several times, timing how long each change takes to
+reach every client. Playback is left as it was. MPD must be playing or paused.
+It uses the MPD settings in config.py.
+
+Usage:
+	python load_test.py [--url URL] [--clients N] [--changes N] [--pid PID]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.event import Event
+from mpd import MPDClient
+from base64 import b64encode
+from urlparse import urlparse
+import argparse
+import urllib2
+import gevent
+import config
+import socket
+import struct
+import json
+import time
+import sys
+import os
+
+# Seconds between each song change, which must be longer than SONG_CHANGE_WINDOW
+CHANGE_INTERVAL = 1
+
+# Seconds to wait for every client to connect
+CONNECT_TIMEOUT = 30
+
+class SocketIOClient(object):
+	"""
+	A minimal Socket.IO 0.9 client over a WebSocket, which records when each event arrives.
+
+	Properties:
+		events (list): Tuples of (time received, event name, arguments) for each event.
+		connected (Event): Set once the server has accepted the connection.
+		error (str): Why the client disconnected, or None.
+	"""
+
+	def __init__(self, url):
+		"""
+		Arguments:
+			url (str): The URL of the server, as in http://localhost:5000.
+		"""
+		self._url = url
+		self._socket = None
+		self._file = None
+
+		self.events = []
+		self.connected = Event()
+		self.error = None
+
+	def run(self):
+		"""Connects to the server and records events until the connection closes."""
+		try:
+			self._connect()
+
+			while True:
+				message = self._receive()
+				if message is None:
+					break
+				self._handle(message)
+		except Exception as e:
+			self.error = '{}: {}'.format(type(e).__name__, e)
+
+	def _connect(self):
+		"""Starts a Socket.IO session, and opens its WebSocket."""
+		url = urlparse(self._url)
+		handshake = urllib2.urlopen('{}/socket.io/1/?t={}'.format(self._url, int(time.time() * 1000)))
+		session_id = handshake.read().split(':')[0]
+
+		self._socket = socket.create_connection((url.hostname, url.port or 80))
+		self._socket.sendall(
+			'GET /socket.io/1/websocket/{} HTTP/1.1\r\n'
+			'Host: {}\r\n'
+			'Upgrade: websocket\r\n'
+			'Connection: Upgrade\r\n'
+			'Sec-WebSocket-Key: {}\r\n'
+			'Sec-WebSocket-Version: 13\r\n\r\n'.format(session_id, url.netloc, b64encode(os.urandom(16))))
+
+		self._file = self._socket.makefile('rb')
+		status = self._file.readline()
+		if ' 101 ' not in status:
+			raise IOError('WebSocket was refused with {}'.format(status.strip()))
+
+		# Skip the rest of the response headers
+		while self._file.readline().strip():
+			pass
+
+	def _handle(self, message):
+		"""Replies to heartbeats, and records connections and events."""
+		kind, data = message.split(':', 1)[0], message.split(':', 3)[-1]
+
+		if kind == '1':
+			self.connected.set()
+		elif kind == '2':
+			self._send('2::')
+		elif kind == '5':
+			event = json.loads(data)
+			self.events.append((time.time(), event['name'], event.get('args', [])))
+
+	def _read(self, size):
+		"""Reads exactly the given number of bytes from the WebSocket."""
+		data = self._file.read(size)
+		if len(data) < size:
+			raise IOError('WebSocket closed')
+		return data
+
+	def _receive(self):
+		"""Returns the payload of the next text frame, or None once the WebSocket is closed."""
+		while True:
+			header = bytearray(self._read(2))
+			opcode = header[0] & 0x0f
+			size = header[1] & 0x7f
+
+			if size == 126:
+				size = struct.unpack('!H', self._read(2))[0]
+			elif size == 127:
+				size = struct.unpack('!Q', self._read(8))[0]
+
+			payload = self._read(size)
+
+			if opcode == 0x8:
+				return None
+			elif opcode == 0x9:
+				self._send(payload, 0xa)
+			elif opcode == 0x1:
+				return payload.decode('utf-8')
+
+	def _send(self, payload, opcode=0x1):
+		"""Sends a frame, masked as clients must."""
+		payload = bytearray(payload.encode('utf-8') if isinstance(payload, unicode) else payload)
+		mask = bytearray(os.urandom(4))
+		header = bytearray([0x80 | opcode])
+
+		if len(payload) < 126:
+			header.append(0x80 | len(payload))
+		elif len(payload) < 0x10000:
+			header.append(0x80 | 126)
+			header.extend(struct.pack('!H', len(payload)))
+		else:
+			header.append(0x80 | 127)
+			header.extend(struct.pack('!Q', len(payload)))
+
+		for i in range(len(payload)):
+			payload[i] ^= mask[i % 4]
+
+		self._socket.sendall(bytes(header + mask + payload))
+
+def get_thread_count(pid):
+	"""Returns the number of threads of a process, or None if it can't be read."""
+	try:
+		with open('/proc/{}/status'.format(pid)) as status:
+			for line in status:
+				if line.startswith('Threads:'):
+					return int(line.split()[1])
+	except IOError:
+		return None
+
+def get_percentile(values, percentile):
+	"""Returns the value at the given percentile of a sorted list."""
+	return values[int(round(percentile / 100.0 * (len(values) - 1)))]
+
+def load_test(url, client_count, changes, pid=None):
+	"""
+	Connects many clients to a server, and times how long song changes take to reach them.
+
+	Arguments:
+		url (str): The URL of the server.
+		client_count (int): The number of clients to connect.
+		changes (int): The number of song changes to make.
+		pid (int): The process id of the server, to count its threads.
+
+	Returns:
+		A dict of the number of clients `connected`, the `delivered` and `expected`
+		song changes, `latencies` in seconds of each delivered change, and the server's `threads`.
+	"""
+	clients = [SocketIOClient(url) for i in range(client_count)]
+	greenlets = [gevent.spawn(client.run) for client in clients]
+
+	deadline = time.time() + CONNECT_TIMEOUT
+	for client in clients:
+		client.connected.wait(max(deadline - time.time(), 0))
+
+	connected = [client for client in clients if client.connected.is_set()]
+	print('{} of {} clients connected'.format(len(connected), client_count))
+
+	mpd = MPDClient()
+	mpd.connect(config.MPD_HOST, config.MPD_PORT)
+	state = mpd.status()['state']
+	if state == 'stop':
+		sys.exit('MPD must be playing or paused.')
+
+	threads = get_thread_count(pid) if pid else None
+	changed_at = []
+
+	try:
+		for i in range(changes):
+			changed_at.append(time.time())
+			mpd.pause(int((state == 'play') == (i % 2 == 0)))
+			gevent.sleep(CHANGE_INTERVAL)
+	finally:
+		mpd.pause(int(state == 'pause'))
+		mpd.disconnect()
+
+	latencies = []
+	for client in connected:
+		patches = [received_at for received_at, name, args in client.events if name == 'song patch']
+
+		for started_at in changed_at:
+			received = [received_at - started_at for received_at in patches
+				if started_at <= received_at < started_at + CHANGE_INTERVAL]
+			if received:
+				latencies.append(received[0])
+
+	gevent.killall(greenlets)
+
+	return {
+		'connected': len(connected),
+		'delivered': len(latencies),
+		'expected':  len(connected) * changes,
+		'latencies': sorted(latencies),
+		'threads':   threads,
+	}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Times how long song changes take to reach many clients.')
+	parser.add_argument('-u', '--url', default='http://localhost:5000', help='URL of the running server')
+	parser.add_argument('-c', '--clients', type=int, default=500, help='number of clients to connect')
+	parser.add_argument('-n', '--changes', type=int, default=10, help='number of song changes to make')
+	parser.add_argument('-p', '--pid', type=int, help='process id of the server, to count its threads')
+	args = parser.parse_args()
+
+	results = load_test(args.url, args.clients, args.changes, args.pid)
+	latencies = results['latencies']
+
+	print('{delivered} of {expected} song changes delivered'.format(**results))
+	if latencies:
+		print('Latency: p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms'.format(
+			*[get_percentile(latencies, percentile) * 1000 for percentile in (50, 90, 99, 100)]))
+	if results['threads'] is not None:
+		print('Server threads: {}'.format(results['threads']))
+
+	sys.exit(0 if results['delivered'] == results['expected'] else 1)
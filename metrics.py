@@ -0,0 +1,216 @@
+from threading import Lock
+from bisect import bisect_left
+import json
+import time
+
+class _NullTimer(object):
+	"""A timer which does nothing, returned while metrics are disabled."""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer(object):
+	"""Observes the seconds spent within a `with` block in a histogram."""
+
+	def __init__(self, metrics, name, labels):
+		self._metrics = metrics
+		self._name = name
+		self._labels = labels
+
+	def __enter__(self):
+		self._started_at = time.time()
+		return self
+
+	def __exit__(self, *exc_info):
+		self._metrics.observe(self._name, time.time() - self._started_at, **self._labels)
+		return False
+
+def _format_labels(labels, extra=()):
+	"""Returns (name, value) pairs of labels in the Prometheus format, as in {a="1",b="2"}."""
+	pairs = list(labels) + list(extra)
+	if not pairs:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+class Metrics(object):
+	"""
+	Collects timing histograms and counters, and renders them in the Prometheus
+	text format. Metrics are disabled until `configure` is called, and while disabled
+	every method returns immediately, so instrumented code costs next to nothing.
+
+	Events can also be written to a trace log as lines of JSON, to follow each step
+	of a slow song change.
+
+	Example:
+		metrics.configure(enabled=True)
+
+		with metrics.timer('mpd_round_trip_seconds'):
+			mpd.status()
+		metrics.increment('mpd_commands_total', command='status')
+
+	Properties:
+		enabled (bool): Whether metrics are being collected.
+	"""
+
+	# The upper bounds in seconds of the histogram buckets
+	BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+	def __init__(self, prefix='soundbubble_'):
+		"""
+		Arguments:
+			prefix (str): The prefix of the name of each metric.
+		"""
+		self._prefix = prefix
+		self._lock = Lock()
+		self._histograms = {}
+		self._counters = {}
+		self._collectors = []
+		self._trace_file = None
+
+		self.enabled = False
+
+	def configure(self, enabled, trace_file=None):
+		"""
+		Arguments:
+			enabled (bool): Whether to collect metrics.
+			trace_file (str): The path of a file to append traced events to, or None.
+		"""
+		self.enabled = enabled
+		self._trace_file = open(trace_file, 'a') if enabled and trace_file else None
+
+	def timer(self, name, **labels):
+		"""
+		Returns a context manager which observes the seconds spent within it.
+
+		Arguments:
+			name (str): The name of the histogram.
+			labels: The labels of the histogram.
+		"""
+		if not self.enabled:
+			return _NULL_TIMER
+		return _Timer(self, name, labels)
+
+	def observe(self, name, seconds, **labels):
+		"""
+		Adds a duration to a histogram.
+
+		Arguments:
+			name (str): The name of the histogram.
+			seconds (float): The duration.
+			labels: The labels of the histogram.
+		"""
+		if not self.enabled:
+			return
+
+		key = (name, tuple(sorted(labels.items())))
+		bucket = bisect_left(self.BUCKETS, seconds)
+
+		with self._lock:
+			histogram = self._histograms.get(key)
+			if histogram is None:
+				# Counts of each bucket and the +Inf bucket, then the sum
+				histogram = self._histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+
+			histogram[bucket] += 1
+			histogram[-1] += seconds
+
+	def increment(self, name, amount=1, **labels):
+		"""
+		Adds to a counter.
+
+		Arguments:
+			name (str): The name of the counter, which should end in `_total`.
+			amount (int): The amount to add.
+			labels: The labels of the counter.
+		"""
+		if not self.enabled:
+			return
+
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + amount
+
+	def add_collector(self, collect):
+		"""
+		Adds a function which reports gauges whenever the metrics are rendered,
+		for values which are already counted elsewhere.
+
+		Arguments:
+			collect (func): Returns a list of (name, labels dict, value) for each gauge.
+
+		Returns:
+			The function, so this can be used as a decorator.
+		"""
+		self._collectors.append(collect)
+		return collect
+
+	def trace(self, event, **fields):
+		"""
+		Writes an event to the trace log, if there is one.
+
+		Arguments:
+			event (str): The name of the event.
+			fields: Details of the event, which must be serializable as JSON.
+		"""
+		if self._trace_file is None:
+			return
+
+		fields.update(time=time.time(), event=event)
+		line = json.dumps(fields) + '\n'
+
+		with self._lock:
+			self._trace_file.write(line)
+			self._trace_file.flush()
+
+	def render(self):
+		"""
+		Returns:
+			Every metric in the Prometheus text format.
+		"""
+		lines = []
+		typed = set()
+
+		def add_type(name, kind):
+			# Each metric is only typed once, however many labels it has
+			if name not in typed:
+				typed.add(name)
+				lines.append('# TYPE {} {}'.format(name, kind))
+
+		with self._lock:
+			histograms = sorted((key, list(value)) for key, value in self._histograms.items())
+			counters = sorted(self._counters.items())
+
+		gauges = sorted(
+			(name, tuple(sorted(labels.items())), value)
+			for collect in self._collectors
+			for name, labels, value in collect())
+
+		for (name, labels), histogram in histograms:
+			name = self._prefix + name
+			add_type(name, 'histogram')
+
+			total = 0
+			for bound, count in zip(self.BUCKETS + ('+Inf',), histogram[:-1]):
+				total += count
+				lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', bound)]), total))
+
+			lines.append('{}_sum{} {!r}'.format(name, _format_labels(labels), histogram[-1]))
+			lines.append('{}_count{} {}'.format(name, _format_labels(labels), total))
+
+		for (name, labels), value in counters:
+			add_type(self._prefix + name, 'counter')
+			lines.append('{}{} {}'.format(self._prefix + name, _format_labels(labels), value))
+
+		for name, labels, value in gauges:
+			add_type(self._prefix + name, 'gauge')
+			lines.append('{}{} {}'.format(self._prefix + name, _format_labels(labels), value))
+
+		return '\n'.join(lines) + '\n'
+
+# The metrics of the whole process, which are disabled until configured
+metrics = Metrics()
@@ -0,0 +1,349 @@
+from mpd import MPDClient, CommandError, ConnectionError
+from threading import Thread, Event
+from Queue import Queue, Empty
+from metrics import metrics
+from select import select
+import socket
+import time
+import re
+
+class CommandListError(CommandError):
+	"""
+	Exception for a command which MPD refused within a command list.
+
+	Properties:
+		index (int): The position of the refused command in the caller's command list.
+		             MPD ran every command before it, and none after it.
+	"""
+
+	def __init__(self, message, index):
+		super(CommandListError, self).__init__(message)
+		self.index = index
+
+class _CommandJob(object):
+	"""
+	A list of MPD commands submitted together by a single caller.
+	The commands of a job are always sent to MPD in order, within the same command list.
+
+	Properties:
+		commands (list): Tuples of (command name, arguments...).
+	"""
+
+	def __init__(self, commands):
+		self.commands = commands
+		self._results = None
+		self._error = None
+		self._done = Event()
+
+	def finish(self, results=None, error=None):
+		"""Stores the outcome of the job and wakes the thread waiting on it."""
+		self._results = results
+		self._error = error
+		self._done.set()
+
+	def wait(self, timeout=None):
+		"""
+		Blocks until the job has been run.
+
+		Arguments:
+			timeout (float): The most seconds to wait, or None to wait forever.
+
+		Returns:
+			A list containing the result of each command.
+
+		Raises:
+			ConnectionError: If the job wasn't run within the timeout.
+		"""
+		if not self._done.wait(timeout):
+			raise ConnectionError('MPD did not answer within {} seconds'.format(timeout))
+
+		if self._error is not None:
+			raise self._error
+		return self._results
+
+class MPDMultiplexer(object):
+	"""
+	Shares a running MPD instance between any number of threads.
+
+	A dedicated connection is used to wait for subsystem changes, so
+	commands never have to interrupt it with `noidle`. Commands are queued
+	from any thread and run by a small pool of command connections, which
+	pipeline everything waiting in the queue into a single command list.
+
+	MPD commands can be called as methods, as with MPDClient:
+
+		mpd = MPDMultiplexer('localhost', 6600)
+		mpd.play()
+		current, status = mpd.command_list(('currentsong',), ('status',))
+	"""
+
+	# Commands which can safely be sent again if their results were lost
+	READ_ONLY_COMMANDS = set([
+		'currentsong', 'status', 'stats', 'find', 'search', 'list', 'listall',
+		'listallinfo', 'lsinfo', 'playlistinfo', 'playlistid', 'plchanges',
+		'plchangesposid', 'ping'])
+
+	# Seconds to wait before connecting to MPD again after failing to, doubling up to MAX_RECONNECT_DELAY
+	RECONNECT_DELAY = 0.5
+	MAX_RECONNECT_DELAY = 10
+
+	# Matches the index of the failed command in a command list error, as in `[50@1] {play} ...`
+	_LIST_ERROR_INDEX = re.compile(r'^\[\d+@(\d+)\]')
+
+	def __init__(self, host, port, pool_size=2, max_batch=32, keepalive=30, timeout=30):
+		"""
+		Connects to a running MPD instance.
+
+		Arguments:
+			host (str): The hostname of the MPD instance.
+			port (int): The port that the MPD instance is running on.
+			pool_size (int): The number of connections used to run commands.
+			max_batch (int): The maximum number of commands to send in one command list.
+			keepalive (int): Seconds between pings on unused command connections,
+			                 which keeps MPD from closing them.
+			timeout (float): The most seconds to wait for the results of commands.
+		"""
+		self._host = host
+		self._port = port
+		self._max_batch = max_batch
+		self._keepalive = keepalive
+		self._timeout = timeout
+		self._queue = Queue()
+		self._idling = False
+		self._idle_delay = self.RECONNECT_DELAY
+		self._idle_client = self._connect()
+
+		for index in range(pool_size):
+			worker = Thread(target=self._work, name='mpd-command-{}'.format(index), args=())
+			worker.setDaemon(True)
+			worker.start()
+
+	def __getattr__(self, name):
+		"""Allows MPD commands to be called as methods, as with MPDClient."""
+		if name.startswith('_'):
+			raise AttributeError(name)
+
+		def command(*args):
+			return self.execute(name, *args)
+		return command
+
+	def _connect(self):
+		"""Returns a new connection to MPD."""
+		client = MPDClient()
+		client.connect(self._host, self._port)
+		return client
+
+	def _reconnect(self):
+		"""
+		Returns a new connection to MPD, trying again with increasing delays until MPD can be reached.
+		Jobs queued while MPD can't be reached are failed, so their callers aren't left waiting.
+		"""
+		delay = self.RECONNECT_DELAY
+
+		while True:
+			try:
+				return self._connect()
+			except (ConnectionError, socket.error) as e:
+				metrics.increment('mpd_connect_errors_total')
+				self._fail_queued(ConnectionError('Could not connect to MPD: {}'.format(e)))
+
+			time.sleep(delay)
+			delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+	def _fail_queued(self, error):
+		"""Finishes every queued job with the given error."""
+		while True:
+			try:
+				self._queue.get_nowait().finish(error=error)
+			except Empty:
+				return
+
+
+
+	def execute(self, name, *args):
+		"""
+		Runs a single MPD command.
+
+		Arguments:
+			name (str): The name of the MPD command.
+
+		Returns:
+			The result of the command.
+		"""
+		return self.command_list((name,) + args)[0]
+
+	def command_list(self, *commands):
+		"""
+		Runs several MPD commands in order in a single round trip.
+
+		Arguments:
+			commands (tuple): Each command as a tuple of (command name, arguments...).
+
+		Returns:
+			A list containing the result of each command.
+
+		Raises:
+			CommandListError: If MPD refused a command, along with the position of the command.
+			ConnectionError: If MPD couldn't be reached, didn't answer in time, or the connection was
+			                 lost while running commands which aren't read-only, which may have run.
+		"""
+		job = _CommandJob(commands)
+
+		# Includes the time spent waiting for a connection, unlike the round trip itself
+		with metrics.timer('mpd_request_seconds'):
+			self._queue.put(job)
+			return job.wait(self._timeout)
+
+	def wait_for_changes(self, timeout=None):
+		"""
+		Waits for a change in an MPD subsystem on the dedicated idle connection.
+
+		Arguments:
+			timeout (float): The maximum number of seconds to wait, or None to wait forever.
+
+		Returns:
+			A tuple of a list of the changed subsystems, which is empty if the timeout elapsed,
+			and the UNIX timestamp for when MPD reported them, before the response was read.
+		"""
+		try:
+			if not self._idling:
+				self._idle_client.send_idle()
+				self._idling = True
+
+			if not select([self._idle_client], [], [], timeout)[0]:
+				return [], None
+
+			changed_at = time.time()
+			self._idling = False
+			return self._idle_client.fetch_idle(), changed_at
+		except (ConnectionError, socket.error):
+			self._idling = False
+
+		try:
+			self._idle_client = self._connect()
+			self._idle_delay = self.RECONNECT_DELAY
+		except (ConnectionError, socket.error):
+			# The next call tries again, after waiting longer each time MPD still can't be reached
+			time.sleep(self._idle_delay if timeout is None else min(self._idle_delay, timeout))
+			self._idle_delay = min(self._idle_delay * 2, self.MAX_RECONNECT_DELAY)
+		return [], None
+
+
+
+	def _work(self):
+		"""
+		Runs queued commands on a connection of the pool.
+		Every job waiting in the queue is sent in the same command list.
+		"""
+		client = self._reconnect()
+
+		while True:
+			try:
+				jobs = [self._queue.get(timeout=self._keepalive)]
+			except Empty:
+				client = self._ping(client)
+				continue
+
+			count = len(jobs[0].commands)
+			while count < self._max_batch:
+				try:
+					jobs.append(self._queue.get_nowait())
+				except Empty:
+					break
+				count += len(jobs[-1].commands)
+
+			client = self._run_jobs(client, jobs)
+
+	def _ping(self, client):
+		"""Keeps an unused connection open, returning a new connection if it was closed."""
+		try:
+			client.ping()
+			return client
+		except (ConnectionError, socket.error):
+			pass
+
+		try:
+			return self._connect()
+		except (ConnectionError, socket.error):
+			return client
+
+	def _is_read_only(self, job):
+		"""Returns True if every command of a job can safely be sent again."""
+		return all(command[0] in self.READ_ONLY_COMMANDS for command in job.commands)
+
+	def _run_jobs(self, client, jobs, reconnected=False):
+		"""
+		Sends the commands of the given jobs in one command list and
+		hands each job its results.
+
+		If a command fails, its job receives the error. Jobs after it were
+		never run by MPD and are sent again, as are read-only jobs before it,
+		whose results are discarded by MPD along with the failed list.
+
+		If the connection is lost, MPD may have run some of the commands, so only
+		read-only jobs are sent again on a new connection. Other jobs receive
+		the connection error rather than risk running them twice.
+
+		Arguments:
+			reconnected (bool): Whether the jobs are being sent again after losing the connection,
+			                    in which case losing it again fails every job.
+
+		Returns:
+			The connection to use for the next jobs, which is a new
+			connection if MPD closed the given one.
+		"""
+		commands = [command for job in jobs for command in job.commands]
+		metrics.increment('mpd_commands_total', len(commands))
+
+		try:
+			with metrics.timer('mpd_round_trip_seconds'):
+				results = self._send(client, commands)
+		except (ConnectionError, socket.error) as e:
+			metrics.increment('mpd_reconnects_total')
+			retry = [job for job in jobs if self._is_read_only(job) and not reconnected]
+
+			for job in jobs:
+				if job not in retry:
+					job.finish(error=ConnectionError('Lost the connection to MPD: {}'.format(e)))
+
+			client = self._reconnect()
+			return self._run_jobs(client, retry, reconnected=True) if retry else client
+		except CommandError as e:
+			metrics.increment('mpd_errors_total')
+			match = self._LIST_ERROR_INDEX.match(str(e))
+			failed = int(match.group(1)) if match else 0
+			retry = []
+
+			for job in jobs:
+				if failed < 0:
+					retry.append(job)
+				elif failed < len(job.commands):
+					job.finish(error=CommandListError(str(e), failed))
+				elif self._is_read_only(job):
+					retry.append(job)
+				else:
+					job.finish(results=[None] * len(job.commands))
+				failed -= len(job.commands)
+
+			return self._run_jobs(client, retry, reconnected) if retry else client
+		except Exception as e:
+			for job in jobs:
+				job.finish(error=e)
+			return self._ping(client)
+
+		for job in jobs:
+			job.finish(results=results[:len(job.commands)])
+			results = results[len(job.commands):]
+
+		return client
+
+	def _send(self, client, commands):
+		"""Sends the given commands to MPD, returning a list of their results."""
+		if len(commands) == 1:
+			name, args = commands[0][0], commands[0][1:]
+			return [getattr(client, name)(*args)]
+
+		client.command_list_ok_begin()
+		for command in commands:
+			getattr(client, command[0])(*command[1:])
+		return client.command_list_end()
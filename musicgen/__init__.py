@@ -1 +1 @@
-from musicgen import MusicGen
+from musicgen import MusicGen, InsufficientPaddingError
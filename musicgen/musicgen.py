@@ -3,11 +3,28 @@ from mutagen.flac import Picture, FLAC
 from mutagen.mp4 import MP4, MP4Cover
 from mutagen.mp3 import MP3
 from mutagen import File
+from functools import reduce
 from os import path
+import io
+
+class UnsupportedTagsError(Exception):
+	"""Exception for when the tags of an audio file can't be read directly."""
+	pass
+
+class InsufficientPaddingError(Exception):
+	"""Exception for when artwork can't be embedded without rewriting the whole audio file."""
+	pass
 
 class MusicGen(object):
 	"""A wrapper for mutagen which unifies the API for differing filetypes."""
 
+	# The number of bytes at the start of an ID3 picture frame to search for the image data
+	ID3_PICTURE_HEADER_LIMIT = 4096
+
+	# The minimum padding to leave after the tags when a file has to be rewritten,
+	# so that later artwork changes can be written in place
+	ARTWORK_PADDING = 256 * 1024
+
 	def __init__(self):
 		super(MusicGen, self).__init__()
 
@@ -24,82 +41,357 @@ class MusicGen(object):
 			Nothing if an output file is specified, otherwise
 			the cover art image data is returned.
 		"""
+		artwork = self.read_cover_art(audio_file)
+
+		if artwork is None:
+			return None
+
+		# Return the artwork data if no output file is specified
+		if out_file is None:
+			return artwork.tobytes()
+
+		# Otherwise, write to the output file
+		with open(out_file, 'wb') as image_file:
+			image_file.write(artwork)
+
+	def read_cover_art(self, audio_file):
+		"""Reads cover artwork from an audio file.
+
+		The artwork is read directly from the FLAC PICTURE block, MP4 `covr`
+		atom or ID3 APIC frame, seeking past everything else in the file.
+		Files which can't be read this way are parsed by mutagen instead.
+
+		Arguments:
+			audio_file (str): The path to the audio file.
+
+		Returns:
+			A memoryview of the cover art image data,
+			or None if the file has no cover art.
+		"""
+		try:
+			with io.open(audio_file, 'rb') as audio:
+				magic = audio.read(8)
+				audio.seek(0)
+
+				if magic.startswith(b'fLaC'):
+					return self._read_flac_picture(audio)
+				elif magic[4:8] == b'ftyp':
+					return self._read_mp4_cover(audio)
+				elif magic.startswith(b'ID3'):
+					artwork = self._read_id3_picture(audio)
+					if artwork is not None:
+						return artwork
+
+					# Some taggers write an ID3 tag before the `fLaC` marker of a FLAC file
+					start = self._get_id3_end(audio)
+					audio.seek(start)
+					if audio.read(4) == b'fLaC':
+						return self._read_flac_picture(audio, start)
+					return None
+		except UnsupportedTagsError:
+			pass
+
+		artwork = self._extract_cover_art_tags(audio_file)
+		return None if artwork is None else memoryview(artwork)
+
+	def _extract_cover_art_tags(self, audio_file):
+		"""Extracts cover artwork from an audio file by parsing all of its tags with mutagen.
+
+		Arguments:
+			audio_file (str): The path to the audio file.
+
+		Returns:
+			The cover art image data, or None if the file has no cover art.
+		"""
 		audio_file = File(audio_file)
 
-		if hasattr(audio_file, 'pictures') and len(audio_file.pictures):
+		if audio_file is None:
+			return None
+		elif hasattr(audio_file, 'pictures') and len(audio_file.pictures):
 			# FLAC
-			artwork = audio_file.pictures[0].data
+			return audio_file.pictures[0].data
 		elif 'covr' in audio_file:
-			# MP3
-			artwork = audio_file['covr'][0]
-		elif hasattr(audio_file, 'tags'):
 			# M4A
+			return audio_file['covr'][0]
+		elif getattr(audio_file, 'tags', None) is not None:
+			# MP3
 			apic_keys = [k for k in audio_file.tags.keys() if k.startswith('APIC:')]
 			if apic_keys:
-				artwork = audio_file.tags[apic_keys[0]].data
-			else:
+				return audio_file.tags[apic_keys[0]].data
+
+		return None
+
+
+
+	def _read(self, audio, length):
+		"""Reads exactly the given number of bytes from a file, as a memoryview."""
+		data = bytearray(length)
+		if audio.readinto(data) != length:
+			raise UnsupportedTagsError('Unexpected end of file')
+		return memoryview(data)
+
+	def _read_int(self, audio, length=4):
+		"""Reads a big-endian unsigned integer of the given number of bytes."""
+		return self._to_int(self._read(audio, length))
+
+	def _to_int(self, data):
+		"""Converts bytes into a big-endian unsigned integer."""
+		return reduce(lambda total, byte: total << 8 | byte, bytearray(data), 0)
+
+	def _read_flac_picture(self, audio, start=0):
+		"""Reads the image data of the first PICTURE metadata block of a FLAC file starting at the given offset."""
+		audio.seek(start + 4) # Skip the `fLaC` marker
+
+		is_last = False
+		while not is_last:
+			header  = self._read_int(audio)
+			is_last = header >> 31
+			kind    = header >> 24 & 0x7f
+			length  = header & 0xffffff
+
+			if kind != 6: # 6 is for PICTURE
+				audio.seek(length, io.SEEK_CUR)
+				continue
+
+			audio.seek(4, io.SEEK_CUR)                        # Picture type
+			audio.seek(self._read_int(audio), io.SEEK_CUR)    # MIME type
+			audio.seek(self._read_int(audio), io.SEEK_CUR)    # Description
+			audio.seek(16, io.SEEK_CUR)                       # Width, height, depth and colors
+			return self._read(audio, self._read_int(audio))
+
+		return None
+
+	def _read_mp4_cover(self, audio):
+		"""Reads the image data of the first `data` atom of the `covr` atom of an MP4 file."""
+		end = audio.seek(0, io.SEEK_END)
+		audio.seek(0)
+
+		for name in (b'moov', b'udta', b'meta', b'ilst', b'covr', b'data'):
+			end = self._find_mp4_atom(audio, name, end)
+			if end is None:
 				return None
+
+			if name == b'meta':
+				audio.seek(4, io.SEEK_CUR) # Version and flags
+
+		audio.seek(8, io.SEEK_CUR) # Data type and locale
+		return self._read(audio, end - audio.tell())
+
+	def _find_mp4_atom(self, audio, name, end):
+		"""
+		Seeks to the content of the atom with the given name, among the
+		atoms between the current position and the given end offset.
+
+		Returns:
+			The end offset of the atom, or None if there is no such atom.
+		"""
+		while audio.tell() + 8 <= end:
+			start  = audio.tell()
+			length = self._read_int(audio)
+			kind   = self._read(audio, 4).tobytes()
+
+			if length == 1: # 64-bit length
+				length = self._read_int(audio, 8)
+			elif length == 0: # Extends to the end
+				length = end - start
+
+			if length < audio.tell() - start:
+				raise UnsupportedTagsError('Invalid MP4 atom length')
+
+			if kind == name:
+				return start + length
+
+			audio.seek(start + length)
+
+		return None
+
+	def _read_id3_picture(self, audio):
+		"""Reads the image data of the first APIC frame (PIC in ID3v2.2) of an ID3v2 tag."""
+		header  = self._read(audio, 10)
+		version = header[3:4].tobytes()
+		flags   = bytearray(header[5:6])[0]
+		end     = 10 + self._read_syncsafe(header[6:10])
+
+		if flags & 0x80: # Unsynchronisation
+			raise UnsupportedTagsError('Unsynchronised ID3 tag')
+
+		if version == b'\x02':
+			frame_header, picture_id = 6, b'PIC'
+		elif version in (b'\x03', b'\x04'):
+			frame_header, picture_id = 10, b'APIC'
 		else:
-			return None
+			raise UnsupportedTagsError('Unknown ID3 version')
 
-		# Return the artwork data if no output file is specified
-		if out_file is None:
-			return artwork
+		if flags & 0x40 and version != b'\x02': # Extended header
+			length = self._read(audio, 4)
+			if version == b'\x03':
+				audio.seek(self._to_int(length), io.SEEK_CUR)
+			else:
+				audio.seek(self._read_syncsafe(length) - 4, io.SEEK_CUR)
 
-		# Otherwise, write to the output file
-		with open(out_file, 'wb') as image_file:
-			image_file.write(artwork)
-		
-	def embed_cover_art(self, audio_file, cover_file):
+		while audio.tell() + frame_header <= end:
+			frame = self._read(audio, frame_header)
+			frame_id = frame[:len(picture_id)].tobytes()
+
+			if frame_id[:1] == b'\x00': # Padding
+				break
+
+			if version == b'\x02':
+				length = self._to_int(frame[3:6])
+			elif version == b'\x03':
+				length = self._to_int(frame[4:8])
+			else:
+				length = self._read_syncsafe(frame[4:8])
+
+			if frame_id != picture_id:
+				audio.seek(length, io.SEEK_CUR)
+				continue
+
+			# Compressed, encrypted, grouped or unsynchronised frames
+			if version != b'\x02' and bytearray(frame[9:10])[0]:
+				raise UnsupportedTagsError('Encoded ID3 picture frame')
+
+			return self._get_id3_picture_data(self._read(audio, length), version)
+
+		return None
+
+	def _get_id3_end(self, audio):
+		"""Returns the offset of the end of the ID3v2 tag at the start of a file, including any footer."""
+		audio.seek(0)
+		header = self._read(audio, 10)
+		flags  = bytearray(header[5:6])[0]
+
+		return 10 + self._read_syncsafe(header[6:10]) + (10 if flags & 0x10 else 0)
+
+	def _read_syncsafe(self, data):
+		"""Reads an ID3 syncsafe integer, which stores 7 bits in each byte."""
+		return reduce(lambda total, byte: total << 7 | byte & 0x7f, bytearray(data), 0)
+
+	def _get_id3_picture_data(self, frame, version):
+		"""Returns a slice of the image data from the content of an APIC or PIC frame."""
+		encoding = bytearray(frame[0:1])[0]
+
+		# Only the start of the frame is copied to search for the end of its text fields
+		content  = frame[:self.ID3_PICTURE_HEADER_LIMIT].tobytes()
+
+		# The image format is 3 characters in ID3v2.2, otherwise a null terminated MIME type
+		if version == b'\x02':
+			position = 4
+		elif b'\x00' in content[1:]:
+			position = content.index(b'\x00', 1) + 1
+		else:
+			raise UnsupportedTagsError('ID3 picture MIME type is too long')
+
+		position += 1 # Picture type
+
+		# The description is terminated by a null character of its encoding
+		try:
+			if encoding in (1, 2): # UTF-16
+				position = next(i for i in range(position, len(content), 2) if content[i:i + 2] == b'\x00\x00') + 2
+			else:
+				position = content.index(b'\x00', position) + 1
+		except (StopIteration, ValueError):
+			raise UnsupportedTagsError('ID3 picture description is too long')
+
+		return frame[position:]
+
+	def embed_cover_art(self, audio_file, cover_file, in_place_only=False):
 		"""Embeds cover art into an audio file.
 
+		If the artwork fits in the padding after the file's tags, only the tags are
+		rewritten. Otherwise the whole file is rewritten, leaving enough padding for
+		artwork of at least ARTWORK_PADDING bytes to be written in place afterwards.
+		Excess padding is never trimmed, since that would also rewrite the file.
+
 		Arguments:
 			audio_file (str): The path to the audio file to embed the artwork in.
 			cover_file (str): The path to the artwork file to embed.
+			in_place_only (bool): Whether to raise InsufficientPaddingError
+			                      rather than rewrite the whole file.
+
+		Returns:
+			True if the artwork was written in place, or False if the whole file was rewritten.
 		"""
-		if path.isfile(audio_file) and path.isfile(cover_file):
-			mimetype = 'image/png' if cover_file.endswith('png') else 'image/jpeg'
-			artwork  = open(cover_file, 'rb').read()
-			desc     = u'Cover Art'
-
-			# Determine which filetype we're handling
-			if audio_file.endswith('m4a'):
-				audio = MP4(audio_file)
-
-				covr = []
-				if cover_file.endswith('png'):
-					covr.append(MP4Cover(artwork, MP4Cover.FORMAT_PNG))
-				else:
-					covr.append(MP4Cover(artwork, MP4Cover.FORMAT_JPEG))
-
-				audio.tags['covr'] = covr
-			elif audio_file.endswith('mp3'):
-				audio = MP3(audio_file, ID3=ID3)
-
-				# Add ID3 tags if they don't exist
-				try:
-					audio.add_tags()
-				except error:
-					pass
-
-				audio.tags.add(
-					APIC(
-						encoding = 3, # 3 is UTF-8
-						mime     = mimetype,
-						type     = 3, # 3 is for cover artwork
-						desc     = desc,
-						data     = artwork))
-			elif audio_file.endswith('flac'):
-				audio = FLAC(audio_file)
-
-				image = Picture()
-				image.type = 3 # 3 is for cover artwork
-				image.mime = mimetype
-				image.desc = desc
-				image.data = artwork
-
-				audio.clear_pictures() # Clear existing pictures
-				audio.add_picture(image)
+		mimetype = 'image/png' if cover_file.endswith('png') else 'image/jpeg'
+		artwork  = open(cover_file, 'rb').read()
+		desc     = u'Cover Art'
+
+		# Determine which filetype we're handling
+		if audio_file.endswith('m4a'):
+			audio = MP4(audio_file)
+
+			# Add MP4 tags if they don't exist
+			if audio.tags is None:
+				audio.add_tags()
+
+			covr = []
+			if cover_file.endswith('png'):
+				covr.append(MP4Cover(artwork, MP4Cover.FORMAT_PNG))
+			else:
+				covr.append(MP4Cover(artwork, MP4Cover.FORMAT_JPEG))
+
+			audio.tags['covr'] = covr
+		elif audio_file.endswith('mp3'):
+			audio = MP3(audio_file, ID3=ID3)
+
+			# Add ID3 tags if they don't exist
+			try:
+				audio.add_tags()
+			except error:
+				pass
+
+			audio.tags.delall('APIC') # Clear existing pictures
+			audio.tags.add(
+				APIC(
+					encoding = 3, # 3 is UTF-8
+					mime     = mimetype,
+					type     = 3, # 3 is for cover artwork
+					desc     = desc,
+					data     = artwork))
+		elif audio_file.endswith('flac'):
+			audio = FLAC(audio_file)
+
+			image = Picture()
+			image.type = 3 # 3 is for cover artwork
+			image.mime = mimetype
+			image.desc = desc
+			image.data = artwork
+
+			audio.clear_pictures() # Clear existing pictures
+			audio.add_picture(image)
+		else:
+			raise UnsupportedTagsError('Can\'t embed artwork in {}'.format(audio_file))
+
+		in_place = [True]
+
+		def get_padding(info):
+			padding = self._get_padding(info, len(artwork))
+
+			# Any change in padding moves the audio data, so the whole file is rewritten
+			if padding != info.padding:
+				if in_place_only:
+					raise InsufficientPaddingError('{} can\'t be written in place'.format(audio_file))
+				in_place[0] = False
+
+			return padding
 
 		# Save the audio file
-		audio.save()
+		audio.save(padding=get_padding)
+
+		return in_place[0]
+
+	def _get_padding(self, info, artwork_size):
+		"""Chooses the padding to leave after the tags when saving an audio file.
+
+		Arguments:
+			info (PaddingInfo): The padding left after the new tags, which is
+			                    negative if they no longer fit before the audio data.
+			artwork_size (int): The size of the embedded artwork in bytes.
+
+		Returns:
+			The number of bytes of padding.
+		"""
+		if info.padding >= 0:
+			return info.padding
+
+		return max(self.ARTWORK_PADDING, artwork_size)
@@ -0,0 +1,184 @@
+"""
+Generates the album artwork for every song in the music library ahead of time,
+so songs don't have to wait for their artwork the first time they're played.
+
+Songs are processed in parallel across all cores, and songs whose modification
+time and size haven't changed since the last run are skipped, so this can be run
+regularly from cron, with or without the web server running. It uses the settings
+in config.py.
+
+Artwork is never evicted to make room, so with COVERS_CACHE_MAX_BYTES or
+COVERS_CACHE_MAX_ENTRIES set, this stops once the cache is full.
+
+Usage:
+	python prewarm_covers.py [--workers N] [--quiet]
+"""
+from multiprocessing import Pool, cpu_count
+from artwork import ArtworkCache
+from os import path, walk, rename
+from hashlib import md5
+import argparse
+import config
+import json
+import time
+import sys
+
+# Audio formats which MusicGen can read cover art from
+EXTENSIONS = set(['flac', 'm4a', 'mp3'])
+
+# The file in the covers directory which records each song as of the last run
+STATE_FILENAME = 'prewarm.json'
+
+# The number of songs between each save of the state, so an interrupted run isn't wasted.
+# The index is journaled as each song is recorded.
+SAVE_INTERVAL = 500
+
+# Seconds between each progress report
+PROGRESS_INTERVAL = 2
+
+# The artwork cache of each worker process
+_covers = None
+
+def get_config():
+	"""Returns the uppercase settings of config.py as a dict, as Flask does."""
+	return dict((key, getattr(config, key)) for key in dir(config) if key.isupper())
+
+def find_songs(music_dir, extensions):
+	"""
+	Walks the music directory for audio files.
+
+	Returns:
+		A list of tuples of (filename relative to the music directory, [modification time, size]).
+	"""
+	songs = []
+	for root, dirs, filenames in walk(music_dir):
+		dirs.sort()
+		for filename in sorted(filenames):
+			if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in extensions:
+				continue
+
+			song_path = path.join(root, filename)
+			try:
+				stat = path.getmtime(song_path), path.getsize(song_path)
+			except OSError:
+				continue
+			songs.append((path.relpath(song_path, music_dir), list(stat)))
+	return songs
+
+def load_state(state_file):
+	"""Returns the state saved by the last run as a dict of {song key: [modification time, size]}."""
+	try:
+		with open(state_file) as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {}
+
+def save_state(state_file, state):
+	"""Writes the state to a temporary file and renames it over the state file."""
+	tmp_file = state_file + '.tmp'
+	with open(tmp_file, 'w') as f:
+		json.dump(state, f)
+	rename(tmp_file, state_file)
+
+def get_song_key(song_file):
+	"""Returns the key of a song in the state file."""
+	return md5(song_file).hexdigest()
+
+def init_worker(settings):
+	"""Creates the artwork cache of a worker process."""
+	global _covers
+	_covers = ArtworkCache(settings)
+
+def render(song_file):
+	"""
+	Renders the artwork of a song in a worker process.
+
+	Returns:
+		A tuple of (song_file, result of ArtworkCache.render, error message or None).
+	"""
+	try:
+		return song_file, _covers.render(song_file), None
+	except Exception as e:
+		return song_file, None, '{}: {}'.format(type(e).__name__, e)
+
+def prewarm(settings, workers, quiet=False):
+	"""
+	Generates the artwork of each new or modified song in the music directory.
+
+	Arguments:
+		settings (dict): A dictionary of config values, as described by ArtworkCache.
+		workers (int): The number of worker processes.
+		quiet (bool): Whether to only print errors and the summary.
+
+	Returns:
+		A dict of counts of the songs which were `found`, `skipped`, `generated`, without `artwork`, or `failed`,
+		and whether the run `stopped` early because the cache was full.
+	"""
+	started_at = time.time()
+	covers = ArtworkCache(settings)
+	state_file = path.join(settings['COVERS_DIR'], STATE_FILENAME)
+	state = load_state(state_file)
+	extensions = EXTENSIONS | set(settings.get('AUDIO_EXTENSIONS', []))
+
+	songs = find_songs(settings['MUSIC_DIR'], extensions)
+	pending = {}
+	for song_file, stat in songs:
+		if state.get(get_song_key(song_file)) != stat or not covers.contains(song_file):
+			pending[song_file] = stat
+
+	counts = {'found': len(songs), 'skipped': len(songs) - len(pending), 'generated': 0, 'artwork': 0, 'failed': 0, 'stopped': False}
+	if not quiet:
+		print('{found} songs found, {} to generate'.format(len(pending), **counts))
+
+	if pending and covers.is_full():
+		print('The artwork cache is full, so no artwork was generated')
+		counts['stopped'] = True
+		return counts
+
+	pool = Pool(workers, init_worker, (settings,))
+	done = 0
+	reported_at = time.time()
+
+	try:
+		for song_file, result, error in pool.imap_unordered(render, sorted(pending), chunksize=8):
+			done += 1
+
+			if error is not None:
+				counts['failed'] += 1
+				print('Failed to generate {}: {}'.format(song_file, error))
+			else:
+				covers.record(song_file, *result, evict=False)
+				state[get_song_key(song_file)] = pending[song_file]
+				counts['generated'] += 1
+				counts['artwork'] += bool(result[0])
+
+				if covers.is_full():
+					print('Stopped after {} songs as the artwork cache is full'.format(done))
+					counts['stopped'] = True
+					break
+
+			if done % SAVE_INTERVAL == 0:
+				save_state(state_file, state)
+
+			if not quiet and time.time() - reported_at >= PROGRESS_INTERVAL:
+				reported_at = time.time()
+				print('{}/{} songs, {:.1f} songs/s'.format(done, len(pending), done / (reported_at - started_at)))
+	finally:
+		pool.terminate()
+		covers.save_index()
+		save_state(state_file, state)
+
+	elapsed = time.time() - started_at
+	print('{generated} songs generated ({artwork} with artwork), {skipped} skipped, {failed} failed '
+		'in {:.1f}s, {:.1f} songs/s'.format(elapsed, counts['generated'] / elapsed, **counts))
+
+	return counts
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generates the album artwork for every song in the music library.')
+	parser.add_argument('-w', '--workers', type=int, default=cpu_count(), help='number of worker processes')
+	parser.add_argument('-q', '--quiet', action='store_true', help='only print errors and the summary')
+	args = parser.parse_args()
+
+	counts = prewarm(get_config(), args.workers, args.quiet)
+	sys.exit(1 if counts['failed'] else 0)
@@ -0,0 +1,144 @@
+from threading import Lock
+
+# Seconds which the elapsed time of a song can drift from where it's expected to be
+# before clients need to be told about it
+ELAPSED_TOLERANCE = 0.5
+
+def is_song_unchanged(last, song, tolerance=ELAPSED_TOLERANCE):
+	"""
+	Returns True if a song from AudioManager.current_song would look the same to
+	clients as the last song sent to them. The elapsed time is read each time the
+	song is updated, so it's compared with where clients will have counted it to,
+	rather than with the last elapsed time.
+
+	Arguments:
+		last (dict): The last song sent to clients.
+		song (dict): The updated song.
+		tolerance (float): Seconds the elapsed time can differ by.
+	"""
+	for key in set(last) | set(song):
+		if key not in ('elapsed', 'updated_at') and last.get(key) != song.get(key):
+			return False
+
+	elapsed = last.get('elapsed', 0)
+	if last.get('state') == 'play':
+		elapsed += song.get('updated_at', 0) - last.get('updated_at', 0)
+
+	return abs(song.get('elapsed', 0) - elapsed) <= tolerance
+
+class VersionedState(object):
+	"""
+	Holds a dict of state along with a version number which is
+	incremented whenever the state changes. Each change produces a
+	patch of only the fields which differ from the previous version,
+	so clients holding the previous version can apply it directly.
+
+	Clients without the previous version should request a snapshot of the full state instead.
+
+	Example:
+		state = VersionedState()
+		state.update({'title': 'Ocean Man', 'is_playing': True})
+		patch = state.update({'title': 'Ocean Man', 'is_playing': False})
+		# patch == {'version': 2, 'changes': {'is_playing': False}}
+
+	Properties:
+		version (int): The version of the current state, which is 0 before the first update.
+	"""
+
+	def __init__(self):
+		self.version = 0
+		self._state = {}
+		self._encoded = None
+		self._lock = Lock()
+
+	def update(self, state):
+		"""
+		Replaces the current state.
+
+		Arguments:
+			state (dict): The new state.
+
+		Returns:
+			A dict containing the new `version` and a dict of the fields which
+			changed as `changes`, where removed fields are None.
+			None is returned if nothing changed, and the version is not incremented.
+		"""
+		with self._lock:
+			changes = dict((key, value) for key, value in state.items() if self._state.get(key) != value)
+
+			for key in self._state:
+				if key not in state:
+					changes[key] = None
+
+			if not changes and self.version:
+				return None
+
+			self._state = dict(state)
+			self.version += 1
+
+			return {'version': self.version, 'changes': changes}
+
+	def snapshot(self):
+		"""
+		Returns:
+			A dict containing the current `version` and a copy of the full state as `state`.
+		"""
+		with self._lock:
+			return {'version': self.version, 'state': dict(self._state)}
+
+	def encoded_snapshot(self, encode):
+		"""
+		Returns the snapshot encoded by the given function. It's only encoded once
+		per version, so it can be sent to any number of clients without encoding it again.
+
+		Arguments:
+			encode (func): Encodes a snapshot dict as returned by `snapshot`.
+		"""
+		with self._lock:
+			if self._encoded is None or self._encoded[0] != self.version:
+				self._encoded = (self.version, encode({'version': self.version, 'state': self._state}))
+			return self._encoded[1]
+
+class ClientVersions(object):
+	"""
+	Holds the version of some state which each connected client was last sent, by client id,
+	so changes can be sent to each client from the version it has.
+
+	Example:
+		versions = ClientVersions()
+		versions.set(['abc', 'def'], 4)
+		versions.group()
+		# {4: ['abc', 'def']}
+	"""
+
+	def __init__(self):
+		self._versions = {}
+		self._lock = Lock()
+
+	def set(self, client_ids, version):
+		"""
+		Records the version sent to some clients.
+
+		Arguments:
+			client_ids (list): The ids of the clients.
+			version (int): The version they were sent.
+		"""
+		with self._lock:
+			for client_id in client_ids:
+				self._versions[client_id] = version
+
+	def remove(self, client_id):
+		"""Forgets a disconnected client."""
+		with self._lock:
+			self._versions.pop(client_id, None)
+
+	def group(self):
+		"""
+		Returns:
+			A dict of the ids of the clients which were last sent each version, by version.
+		"""
+		groups = {}
+		with self._lock:
+			for client_id, version in self._versions.items():
+				groups.setdefault(version, []).append(client_id)
+		return groups
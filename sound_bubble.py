@@ -1,17 +1,44 @@
-import time
+import config
+
+# In async mode every client and background task runs as a greenlet on one thread.
+# Blocking calls in the standard library are patched to yield to other greenlets,
+# which makes the MPD sockets non-blocking, so this must happen before anything else is imported.
+ASYNC_MODE = getattr(config, 'ASYNC_MODE', None)
+
+if ASYNC_MODE == 'gevent':
+	from gevent import monkey
+	monkey.patch_all()
+	import gevent
+
 from sb_user import SoundBubbleUser
-from audio_manager import AudioManager
+from song_state import VersionedState, ClientVersions, is_song_unchanged
+from coalescer import Coalescer
+from fanout import FanOut
+from metrics import metrics
+from audio_manager import AudioManager, clock, start_thread
+from uploads import ChunkedUploads, UploadError
 from flask import Flask, request, g, redirect, url_for, \
-     abort, render_template, flash
+     abort, render_template, flash, jsonify, send_file, Response
 from flask.ext.login import LoginManager, current_user, login_user, logout_user
 from flask.ext.socketio import SocketIO, emit
+from socketio import packet
+from socketio.defaultjson import default_json_dumps
 from werkzeug import secure_filename
+from werkzeug.http import parse_content_range_header
+from uuid import uuid4
+import mimetypes
 import os.path
+import math
+
+# The Socket.IO namespace which every event is handled and sent on
+NAMESPACE = ''
 
 app = Flask(__name__)
 app.config.from_object('config')
 socket = SocketIO(app)
 
+metrics.configure(app.config.get('METRICS_ENABLED', False), app.config.get('METRICS_TRACE_FILE'))
+
 SoundBubbleUser.register_users({
 	app.config['USERNAME']: app.config['PASSWORD']
 })
@@ -19,7 +46,33 @@ SoundBubbleUser.register_users({
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-audio = AudioManager(app.config)
+def start_background_task(target, name):
+	"""Runs a function in the background as a greenlet in async mode, otherwise as a thread."""
+	if ASYNC_MODE == 'gevent':
+		return gevent.spawn(target)
+	return start_thread(target, name)
+
+def offload(func, *args):
+	"""
+	Runs CPU or file work on gevent's pool of real threads in async mode, so it
+	doesn't stop every greenlet while it runs, otherwise on the calling thread.
+	"""
+	if ASYNC_MODE == 'gevent':
+		return gevent.get_hub().threadpool.apply(func, args)
+	return func(*args)
+
+audio = AudioManager(app.config, spawn=start_background_task, offload=offload)
+song_state = VersionedState()
+playlist_versions = ClientVersions()
+def encode_event(event, data):
+	"""
+	Returns the packet gevent-socketio sends for an event emitted on NAMESPACE, so the
+	same packet can be queued for any number of clients with `put_client_msg`.
+	"""
+	return packet.encode({'type': 'event', 'name': event, 'args': [data], 'endpoint': NAMESPACE}, default_json_dumps)
+
+fanout = FanOut(start_background_task, encode_event, app.config.get('CLIENT_QUEUE_DEPTH', 16))
+uploads = ChunkedUploads(app.config['MUSIC_DIR'], app.config['AUDIO_EXTENSIONS'])
 
 
 
@@ -29,18 +82,205 @@ def load_user(id):
 
 
 
-@audio.on('song change')
 def notify_song_change(song):
-	song['server_time'] = time.time()
-	socket.emit('song change', song)
+	"""Sends the fields of the current song which have changed to all clients."""
+	with metrics.timer('song_broadcast_seconds'):
+		patch = song_state.update(song)
+		if patch:
+			fanout.publish('song patch', patch, key='song', snapshot=song_state.encoded_snapshot(encode_song_snapshot))
+
+	if patch:
+		metrics.trace('song broadcast', file=song['file'], version=patch['version'], changes=sorted(patch['changes']))
+
+# Bursts of player changes from skipping or seeking are sent to clients as one patch
+song_changes = Coalescer(notify_song_change, app.config.get('SONG_CHANGE_WINDOW', 0.1), is_song_unchanged)
+
+@audio.on('song change')
+@audio.on('artwork ready')
+def coalesce_song_change(song):
+	"""Queues the current song to be sent to clients once a burst of changes has settled."""
+	song_changes.put(song)
+
+@audio.on('song added')
+def notify_song_added(job_id, songs, errors):
+	"""Tells the logged in clients which songs have been added to the playlist for an upload, and which couldn't be."""
+	fanout.publish('song added', {
+		'job':    job_id,
+		'songs':  [{key: song.get(key) for key in ('file', 'title', 'artist', 'album')} for song in songs],
+		'errors': errors
+	}, room='controllers')
+
+@audio.on('artwork changed')
+def notify_artwork_changed(job_id, songs, errors):
+	"""Tells the logged in clients which songs have had their artwork changed."""
+	fanout.publish('artwork changed', {'job': job_id, 'songs': songs, 'errors': errors}, room='controllers')
+
+@audio.on('playlist patch')
+def notify_playlist_patch(patch):
+	"""
+	Sends each client the positions of the playlist which changed since the version it was last sent.
+	Clients which were sent the previous version share the given patch, and the changes since any
+	other version are only fetched once. A client which still hasn't been sent its last patch is
+	sent a patch which reloads the whole playlist instead, since it can't apply the newer changes alone.
+	"""
+	for version, client_ids in playlist_versions.group().items():
+		client_patch = patch if version == patch['from_version'] else audio.get_playlist_patch(version)
+		reset = encode_event('playlist patch', dict(client_patch, from_version=None, changes=[]))
 
+		fanout.publish('playlist patch', client_patch, key='playlist', snapshot=reset, clients=client_ids)
+		playlist_versions.set(client_ids, client_patch['version'])
 
+@audio.on('artwork prefetch')
+def notify_artwork_prefetch(artwork):
+	"""Sends the artwork of the upcoming songs to all clients, so they can fetch it ahead of time."""
+	fanout.publish('artwork prefetch', artwork, key='artwork prefetch')
+
+
+
+def encode_song_snapshot(snapshot):
+	"""Returns the packet of the 'song snapshot' event for a snapshot of the song state."""
+	return encode_event('song snapshot', snapshot)
+
+def send_song_snapshot():
+	"""
+	Sends the full state of the current song to the requesting client. The packet is
+	encoded once per version of the song, so a burst of reconnecting clients all share it.
+	"""
+	request.namespace.socket.put_client_msg(song_state.encoded_snapshot(encode_song_snapshot))
+
+def send_playlist():
+	"""
+	Sends the current version and length of the playlist to the requesting client,
+	which reloads every position, and records the version it was sent.
+	"""
+	patch = audio.get_playlist_patch()
+	playlist_versions.set([get_client_id()], patch['version'])
+	emit('playlist patch', patch)
+
+def get_int(data, key, default=None):
+	"""Returns a value sent by a client as an int, or the default if it is missing or isn't a number."""
+	try:
+		return int(data.get(key, default))
+	except (ValueError, TypeError, AttributeError):
+		return default
+
+def get_float(data, key, default=None):
+	"""Returns a value sent by a client as a float, or the default if it is missing or isn't a finite number."""
+	try:
+		value = float(data.get(key, default))
+	except (ValueError, TypeError, AttributeError):
+		return default
+	return value if not (math.isinf(value) or math.isnan(value)) else default
+
+def get_client_id():
+	"""Returns the session id of the requesting client."""
+	return request.namespace.socket.sessid
+
+def notify_when_drained(client):
+	"""
+	Wraps the methods a client's transport takes outgoing packets with, so the fanout
+	is woken to send more events once the client's queue has drained.
+	"""
+	def notify_after(take):
+		def take_and_notify(*args, **kwargs):
+			packets = take(*args, **kwargs)
+			if client.client_queue.empty():
+				fanout.notify_ready()
+			return packets
+		return take_and_notify
+
+	for name in ('get_client_msg', 'get_multiple_client_msgs'):
+		setattr(client, name, notify_after(getattr(client, name)))
 
 @socket.on('connect')
 def on_connect():
-	data = audio.current_song
-	data['server_time'] = time.time()
-	emit('song change', data)
+	# Events are only sent to a client once its previous events have left its outgoing queue
+	client = request.namespace.socket
+	notify_when_drained(client)
+	fanout.add(
+		get_client_id(),
+		client.put_client_msg,
+		['controllers' if current_user.is_authenticated else 'viewers'],
+		lambda: client.client_queue.empty())
+
+	send_song_snapshot()
+	send_playlist()
+	emit('artwork prefetch', audio.upcoming_artwork)
+
+@socket.on('disconnect')
+def on_disconnect():
+	fanout.remove(get_client_id())
+	playlist_versions.remove(get_client_id())
+
+@socket.on('clock sync')
+def on_clock_sync(data):
+	"""
+	Replies to a client with the time on the server's playback clock,
+	so the client can measure the offset from its own clock.
+	"""
+	client_time = get_float(data, 'client_time')
+	if client_time is None:
+		return
+
+	emit('clock sync', {'client_time': client_time, 'server_time': clock()})
+
+@socket.on('resync')
+def on_resync():
+	"""Sends the full song state to a client which has missed a patch."""
+	send_song_snapshot()
+
+@socket.on('playlist sync')
+def on_playlist_sync():
+	"""Sends the whole playlist to a client which missed a patch."""
+	send_playlist()
+
+@socket.on('playlist songs')
+def on_playlist_songs(data):
+	"""Sends the songs at the positions from `start` to `end` of the playlist to a client."""
+	start = max(get_int(data, 'start', 0), 0)
+	end   = max(min(get_int(data, 'end', start), start + 500), start)
+
+	version, songs = audio.get_playlist_songs(start, end)
+	emit('playlist songs', {'version': version, 'start': start, 'songs': songs})
+
+@socket.on('play song')
+def on_play_song(data):
+	"""Plays a song in the playlist by its `id` if the user is logged in."""
+	song_id = get_int(data, 'id')
+	if current_user.is_authenticated and song_id is not None:
+		audio.play_song(song_id)
+
+@socket.on('remove song')
+def on_remove_song(data):
+	"""Removes a song from the playlist by its `id` if the user is logged in."""
+	song_id = get_int(data, 'id')
+	if current_user.is_authenticated and song_id is not None:
+		audio.remove_song(song_id)
+
+@socket.on('search')
+def on_search(data):
+	"""
+	Sends a page of the songs in the library matching a search to the requesting client.
+	The `query`, `offset`, `limit` and `prefix` of the search are passed to LibraryIndex.search.
+	"""
+	if not isinstance(data, dict):
+		return
+
+	query  = data.get('query', '')
+	if not isinstance(query, basestring):
+		return
+
+	offset = max(get_int(data, 'offset', 0), 0)
+	limit  = min(max(get_int(data, 'limit', 50), 1), 200)
+
+	results, more = audio.library.search(query, offset, limit, bool(data.get('prefix')))
+
+	emit('search results', {
+		'query':   query,
+		'offset':  offset,
+		'results': results,
+		'more':    more
+	})
 
 @socket.on('play')
 def on_play():
@@ -88,25 +328,129 @@ def show_index():
 			if audio_file and audio.is_allowed_audio_file(audio_file.filename):
 				filename = secure_filename(audio_file.filename)
 				filepath = os.path.join(app.config['MUSIC_DIR'], filename)
-				audio_file.save(filepath)
+				with metrics.timer('upload_seconds'):
+					audio_file.save(filepath)
 
-				data = audio.add_new_song(filename)
+				audio.add_new_song(filename)
 
-				msg = 'Added {} to the playlist.'.format(data['title'])
+				msg = 'Adding {} to the playlist.'.format(filename)
 		elif request.form['action'] == 'add_artwork' and current_user.is_authenticated:
 			artwork_file = request.files.get('artwork', None)
 			if artwork_file and audio.is_allowed_artwork_file(artwork_file.filename):
-				filename = secure_filename(artwork_file.filename)
+				# Artwork is embedded in the background, so each upload needs its own file
+				filename = '{}-{}'.format(uuid4().hex, secure_filename(artwork_file.filename))
 				filepath = os.path.join(app.config['TMP_DIR'], filename)
 				artwork_file.save(filepath)
 
-				song_title = audio.current_song['title']
-				audio.change_album_artwork(audio.current_song, filepath)
+				whole_album = request.form.get('whole_album') == '1'
+				song = audio.current_song
+				audio.change_album_artwork(song['file'], filepath, whole_album)
 
-				msg = 'Updated artwork for {}.'.format(song_title)
+				msg = 'Updating artwork for {}.'.format(song['album'] if whole_album else song['title'])
 
 	return render_template('index.html', error=error, message=msg)
 
+@app.route(app.config.get('COVERS_URL', '/covers/') + '<filename>')
+def send_cover(filename):
+	"""
+	Sends an album cover from COVERS_URL, the same path its artwork URLs are built with.
+	Covers are named by a hash of their contents, so the filename is a strong ETag,
+	and clients can cache them forever without checking for changes.
+
+	With COVERS_SENDFILE set to 'X-Accel-Redirect', the file is served by nginx from
+	COVERS_SENDFILE_PREFIX instead, which should be an internal location aliasing COVERS_DIR.
+	With USE_X_SENDFILE, Flask has the front-end server send the file with `X-Sendfile`.
+	"""
+	cover_file = audio.get_artwork_file(filename)
+	if cover_file is None or not os.path.isfile(cover_file):
+		abort(404)
+
+	if request.if_none_match.contains(filename):
+		response = app.response_class(status=304)
+	elif app.config.get('COVERS_SENDFILE') == 'X-Accel-Redirect':
+		response = app.response_class(mimetype=mimetypes.guess_type(filename)[0])
+		response.headers['X-Accel-Redirect'] = app.config['COVERS_SENDFILE_PREFIX'] + filename
+	else:
+		response = send_file(cover_file, add_etags=False)
+
+	response.set_etag(filename)
+	response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+	return response
+
+@metrics.add_collector
+def collect_stats():
+	"""Reports the counters kept by each part of the server as gauges."""
+	gauges = [('artwork_cache_' + key, {}, value) for key, value in audio.artwork_stats.items()]
+	gauges += [('artwork_embedded', {'mode': key}, value) for key, value in audio.embed_stats.items()]
+	gauges += [('song_changes', {'outcome': key}, value) for key, value in song_changes.stats.items()]
+	gauges += [('upload_' + key, {}, value) for key, value in uploads.stats.items()]
+
+	# Clients are totalled by room, since session ids would give every client its own series
+	rooms = {}
+	for client in fanout.stats.values():
+		for room in client['rooms']:
+			totals = rooms.setdefault(room, {'clients': 0, 'depth': 0, 'sent': 0, 'dropped': 0})
+			totals['clients'] += 1
+			for key in ('depth', 'sent', 'dropped'):
+				totals[key] += client[key]
+
+	for room, totals in rooms.items():
+		gauges += [('clients', {'room': room}, totals['clients'])]
+		gauges += [('client_queue_' + key, {'room': room}, totals[key]) for key in ('depth', 'sent', 'dropped')]
+
+	return gauges
+
+@app.route('/metrics')
+def show_metrics():
+	"""Returns the metrics of the server in the Prometheus text format, if enabled."""
+	if not metrics.enabled:
+		abort(404)
+
+	return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/clients')
+def show_clients():
+	"""Returns the rooms, queue depth, and sent and dropped event counts of each connected client."""
+	if not current_user.is_authenticated:
+		abort(403)
+
+	return jsonify(clients=fanout.stats)
+
+@app.route('/upload/<filename>', methods=['GET', 'PUT'])
+def upload_music(filename):
+	"""
+	Receives a song in chunks, streaming each chunk straight into the music directory.
+
+	GET returns the number of bytes of the song which have been received as `offset`,
+	so an interrupted upload can be resumed. PUT writes the chunk in the request body
+	at the position given by its `Content-Range` header. Once the last chunk is
+	received, the song is added to the playlist.
+	"""
+	if not current_user.is_authenticated:
+		abort(403)
+
+	filename = secure_filename(filename)
+
+	if request.method == 'GET':
+		return jsonify(offset=uploads.get_offset(filename))
+
+	content_range = parse_content_range_header(request.headers.get('Content-Range'))
+	if content_range is None or content_range.units != 'bytes':
+		abort(400)
+
+	try:
+		result = uploads.write(filename, content_range.start, content_range.length, request.stream)
+	except UploadError as e:
+		response = jsonify(error=str(e), offset=e.offset)
+		response.status_code = e.status
+		return response
+
+	if result['complete']:
+		result['job'] = audio.add_new_song(filename)
+		result['message'] = 'Adding {} to the playlist.'.format(filename)
+
+	return jsonify(**result)
+
 
 
 if __name__ == '__main__':
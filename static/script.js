@@ -12,16 +12,70 @@
 		button        = document.querySelector('#current .state-button'),
 		next_button   = document.querySelector('#current .next-button'),
 		file_forms    = document.querySelectorAll('.file-upload'),
+		playlist_view  = document.querySelector('.playlist .playlist-songs'),
+		playlist_rows  = document.querySelector('.playlist .playlist-rows'),
+		playlist       = {version: null, length: 0, ids: [], songs: {}},
+		playlist_pages = {},
+		playlist_render_scheduled = false,
+		search_input   = document.querySelector('.library .search'),
+		search_results = document.querySelector('.library .search-results'),
+		search_more    = document.querySelector('.library .search-more'),
+		search_query   = '',
+		search_timeout = null,
+		upload_jobs    = {},
 		is_playing     = null,
-		start_time     = 0,
-		time_seconds   = 0,
-		length_seconds = 0,
+		song           = {},
+		song_version   = null,
+		clock_offset   = 0,
+		artwork_src    = null,
+		prefetched     = [],
+
+		// Playlist rows are a fixed height so only the visible rows need to exist,
+		// and songs are requested a page at a time
+		PLAYLIST_ROW_HEIGHT = 48,
+		PLAYLIST_PAGE_SIZE  = 100,
+		PLAYLIST_OVERSCAN   = 10,
+
+		// Songs are requested from the library this many at a time, once typing pauses for SEARCH_DELAY ms
+		SEARCH_PAGE_SIZE = 50,
+		SEARCH_DELAY     = 150,
+
+		// Uploads are sent in chunks of this many bytes, with this many files at a time
+		UPLOAD_CHUNK_SIZE  = 4 * 1024 * 1024,
+		PARALLEL_UPLOADS   = 3,
+		UPLOAD_RETRIES     = 5,
 
 	/**
 	 * Returns the current UNIX timestamp, in seconds.
 	 */
 	get_timestamp = function() {
-		return Math.floor(Date.now() / 1000);
+		return Date.now() / 1000;
+	},
+
+	/**
+	 * Returns the current time on the server's clock, in seconds.
+	 */
+	get_server_time = function() {
+		return get_timestamp() + clock_offset;
+	},
+
+	/**
+	 * Asks the server for its clock, to measure the offset from the local clock.
+	 */
+	sync_clock = function() {
+		socket.emit('clock sync', {client_time: get_timestamp()});
+	},
+
+	/**
+	 * Sets the offset between the server's clock and the local clock.
+	 * The server's time is assumed to have been read halfway through the round trip.
+	 * @param sync (obj) The `client_time` the sync was sent at, and the server's `server_time`.
+	 */
+	apply_clock_sync = function(sync) {
+		var midpoint = (sync.client_time + get_timestamp()) / 2;
+		clock_offset = sync.server_time - midpoint;
+
+		increment_time();
 	},
 
 	/**
@@ -49,7 +103,7 @@
 		total_seconds = Math.floor(total_seconds);
 
 		var h = Math.floor(total_seconds / 3600),
-			m = Math.floor(total_seconds / 60),
+			m = Math.floor(total_seconds % 3600 / 60),
 			s = Math.floor(total_seconds % 60),
 			str = '';
 
@@ -98,6 +152,92 @@
 		socket.emit('next song');
 	},
 
+	/**
+	 * Updates the artwork, offering each of its formats to the browser with a <source>.
+	 * @param src (str) The URL for the largest artwork, for browsers without `srcset` support.
+	 * @param sources (array) Each format of the artwork, as objects of `type` and `srcset`.
+	 */
+	update_artwork = function(src, sources) {
+		var picture     = artwork.parentNode,
+			old_sources = picture.querySelectorAll('source'),
+			i;
+
+		// Leave the artwork alone if it hasn't changed
+		if (src === artwork_src) {
+			return;
+		}
+		artwork_src = src;
+
+		for (i = 0; i < old_sources.length; i++) {
+			picture.removeChild(old_sources[i]);
+		}
+
+		for (i = 0; i < sources.length; i++) {
+			picture.insertBefore(create_source(sources[i]), artwork);
+		}
+
+		artwork.src = src;
+	},
+
+	/**
+	 * Creates a <source> element for one format of the artwork.
+	 * @param source_data (obj) The `type` and `srcset` of the format.
+	 * @return (Element) The <source> element, with the same `sizes` as the artwork.
+	 */
+	create_source = function(source_data) {
+		var source = document.createElement('source');
+
+		source.type   = source_data.type;
+		source.srcset = source_data.srcset;
+		source.sizes  = artwork.getAttribute('sizes');
+
+		return source;
+	},
+
+	/**
+	 * Fetches the artwork of the upcoming songs into the browser cache.
+	 * Each artwork is loaded by a detached copy of the artwork <picture>, so the
+	 * browser chooses the same format and size it will later display.
+	 * @param upcoming (array) The artwork of each upcoming song, as objects of `src` and `sources`.
+	 */
+	prefetch_artwork = function(upcoming) {
+		var picture,
+			img,
+			i,
+			j;
+
+		// Keep the pictures referenced so their requests are not abandoned
+		prefetched = [];
+
+		for (i = 0; i < upcoming.length; i++) {
+			picture = document.createElement('picture');
+			img     = document.createElement('img');
+
+			for (j = 0; j < upcoming[i].sources.length; j++) {
+				picture.appendChild(create_source(upcoming[i].sources[j]));
+			}
+
+			img.sizes = artwork.getAttribute('sizes');
+			picture.appendChild(img);
+			img.src = upcoming[i].src;
+
+			prefetched.push(picture);
+		}
+	},
+
+	/**
+	 * Returns the number of seconds into the current song.
+	 */
+	get_elapsed = function() {
+		var elapsed = song.elapsed;
+
+		if (song.state === 'play') {
+			elapsed += get_server_time() - song.updated_at;
+		}
+
+		return Math.min(Math.max(elapsed, 0), song.duration);
+	},
+
 	/**
 	 * Updates the information for the currently playing song.
 	 * @param song_data (obj) Updated song data from the server.
@@ -107,43 +247,458 @@
 		title.textContent  = song_data.title;
 		artist.textContent = song_data.artist;
 		album.textContent  = song_data.album;
-		time.textContent   = song_data.time;
-		length.textContent = song_data.length;
-		progress.value     = song_data.progress;
-		artwork.src        = song_data.artwork;
+		length.textContent = seconds_to_string(song_data.duration);
 
-		if (is_playing === null) {
-			is_playing = song_data.is_playing;
+		update_artwork(song_data.artwork, song_data.artwork_sources || []);
+		render_playlist();
+
+		if (is_playing !== (song_data.state === 'play')) {
+			is_playing = song_data.state === 'play';
 			toggle_button();
 		}
 
-		if (is_playing !== song_data.is_playing) {
-			is_playing = !is_playing;
-			toggle_button();
+		increment_time();
+	},
+	
+	/**
+	 * Replaces the current song with the full state sent by the server.
+	 * @param snapshot (obj) The song `state` and its `version`.
+	 */
+	apply_song_snapshot = function(snapshot) {
+		song         = snapshot.state;
+		song_version = snapshot.version;
+
+		update_current_song(song);
+	},
+
+	/**
+	 * Applies the changed fields of the current song sent by the server.
+	 * A snapshot is requested instead if a previous patch was missed.
+	 * @param patch (obj) The song field `changes` and their `version`.
+	 */
+	apply_song_patch = function(patch) {
+		// Ignore patches which are already applied
+		if (song_version !== null && patch.version <= song_version) {
+			return;
 		}
 
-		var time_diff = get_timestamp() - song_data.server_time;
-		start_time = song_data.start_time + time_diff;
-		progress.setAttribute('data-start-time', start_time);
+		if (song_version === null || patch.version !== song_version + 1) {
+			socket.emit('resync');
+			return;
+		}
 
-		time_seconds   = parseFloat(song_data.time_sec);
-		length_seconds = parseInt(song_data.length_sec, 10);
+		for (var key in patch.changes) {
+			if (patch.changes.hasOwnProperty(key)) {
+				song[key] = patch.changes[key];
+			}
+		}
+		song_version = patch.version;
+
+		update_current_song(song);
 	},
-	
+
 	/**
-	 * Increments the playback time for the current song.
+	 * Updates the playback time for the current song.
 	 */
 	increment_time = function() {
-		// Do nothing if playback is paused or the song is over
-		if (!is_playing || time_seconds >= length_seconds) {
+		// Do nothing until a song has been received
+		if (song_version === null) {
+			return;
+		}
+
+		var elapsed = get_elapsed();
+
+		time.textContent = seconds_to_string(elapsed);
+		progress.value   = song.duration ? elapsed / song.duration * 100 : 0;
+	},
+
+	/**
+	 * Applies the changed positions of the playlist sent by the server.
+	 * Songs which moved keep their data, since it's stored by song id.
+	 * The whole playlist is requested instead if a previous patch was missed.
+	 * @param patch (obj) The `changes` as [position, song id] from `from_version` to `version`,
+	 *                    and the new `length` of the playlist.
+	 */
+	apply_playlist_patch = function(patch) {
+		var i;
+
+		// A patch without a previous version replaces the whole playlist
+		if (patch.from_version === null) {
+			playlist.ids   = [];
+			playlist.songs = {};
+		} else if (patch.from_version !== playlist.version) {
+			if (patch.version !== playlist.version) {
+				socket.emit('playlist sync');
+			}
+			return;
+		}
+
+		playlist.ids.length = Math.min(playlist.ids.length, patch.length);
+		for (i = 0; i < patch.changes.length; i++) {
+			playlist.ids[patch.changes[i][0]] = patch.changes[i][1];
+		}
+
+		playlist.version = patch.version;
+		playlist.length  = patch.length;
+		playlist_pages   = {};
+
+		prune_playlist_songs();
+		render_playlist();
+	},
+
+	/**
+	 * Forgets the stored songs which were removed from the playlist,
+	 * once more of them have been removed than are still in it.
+	 */
+	prune_playlist_songs = function() {
+		var ids   = Object.keys(playlist.songs),
+			songs = {},
+			i;
+
+		if (ids.length <= 2 * playlist.length + PLAYLIST_PAGE_SIZE) {
+			return;
+		}
+
+		for (i = 0; i < playlist.ids.length; i++) {
+			if (playlist.songs[playlist.ids[i]]) {
+				songs[playlist.ids[i]] = playlist.songs[playlist.ids[i]];
+			}
+		}
+
+		playlist.songs = songs;
+	},
+
+	/**
+	 * Stores songs sent by the server, and their positions if the playlist hasn't changed since.
+	 * @param data (obj) The `songs` from the position `start`, as of the playlist `version`.
+	 */
+	apply_playlist_songs = function(data) {
+		var i;
+
+		delete playlist_pages[Math.floor(data.start / PLAYLIST_PAGE_SIZE)];
+
+		for (i = 0; i < data.songs.length; i++) {
+			playlist.songs[data.songs[i].id] = data.songs[i];
+
+			if (data.version === playlist.version) {
+				playlist.ids[data.start + i] = data.songs[i].id;
+			}
+		}
+
+		render_playlist();
+	},
+
+	/**
+	 * Renders the visible rows of the playlist on the next frame.
+	 */
+	render_playlist = function() {
+		if (playlist_view && !playlist_render_scheduled) {
+			playlist_render_scheduled = true;
+			window.requestAnimationFrame(render_playlist_rows);
+		}
+	},
+
+	/**
+	 * Replaces the rendered rows of the playlist with the rows in view,
+	 * and requests the pages of songs which haven't been received.
+	 */
+	render_playlist_rows = function() {
+		var first    = Math.max(Math.floor(playlist_view.scrollTop / PLAYLIST_ROW_HEIGHT) - PLAYLIST_OVERSCAN, 0),
+			last     = Math.min(Math.ceil((playlist_view.scrollTop + playlist_view.clientHeight) / PLAYLIST_ROW_HEIGHT) + PLAYLIST_OVERSCAN, playlist.length),
+			fragment = document.createDocumentFragment(),
+			row,
+			row_song,
+			page,
+			i;
+
+		playlist_render_scheduled = false;
+		playlist_rows.style.height = (playlist.length * PLAYLIST_ROW_HEIGHT) + 'px';
+
+		for (i = first; i < last; i++) {
+			row_song = playlist.songs[playlist.ids[i]];
+			row      = document.createElement('li');
+
+			row.style.top = (i * PLAYLIST_ROW_HEIGHT) + 'px';
+			row.setAttribute('data-id', playlist.ids[i]);
+
+			if (row_song) {
+				row.textContent = row_song.title + ' \u00b7 ' + row_song.artist;
+				row.classList.toggle('current', row_song.id === current_song_id());
+
+				// Only logged in users have playback controls
+				if (button) {
+					row.appendChild(document.createElement('button')).className = 'remove-button';
+				}
+			} else {
+				page = Math.floor(i / PLAYLIST_PAGE_SIZE);
+				if (!playlist_pages[page]) {
+					playlist_pages[page] = true;
+					socket.emit('playlist songs', {start: page * PLAYLIST_PAGE_SIZE, end: (page + 1) * PLAYLIST_PAGE_SIZE});
+				}
+			}
+
+			fragment.appendChild(row);
+		}
+
+		playlist_rows.innerHTML = '';
+		playlist_rows.appendChild(fragment);
+	},
+
+	/**
+	 * Returns the song id of the current song, or null.
+	 */
+	current_song_id = function() {
+		return song.id === undefined ? null : song.id;
+	},
+
+	/**
+	 * Plays or removes the song of a clicked playlist row.
+	 * @param event (Event) The click event.
+	 */
+	handle_playlist_click = function(event) {
+		var row = event.target.closest('li');
+
+		if (!row || !row.getAttribute('data-id')) {
 			return;
 		}
 
-		time_seconds = get_timestamp() - start_time;
+		if (event.target.classList.contains('remove-button')) {
+			socket.emit('remove song', {id: +row.getAttribute('data-id')});
+		} else {
+			socket.emit('play song', {id: +row.getAttribute('data-id')});
+		}
+	},
 
-		// Update the current time
-		time.textContent = seconds_to_string(time_seconds);
-		progress.value = time_seconds / length_seconds * 100;
+	/**
+	 * Asks the server for a page of the songs matching the search query.
+	 * Queries shorter than three characters only match the start of words.
+	 * @param offset (int) The number of matching songs to skip.
+	 */
+	search_library = function(offset) {
+		socket.emit('search', {
+			query:  search_query,
+			offset: offset,
+			limit:  SEARCH_PAGE_SIZE,
+			prefix: search_query.length < 3
+		});
+	},
+
+	/**
+	 * Searches the library once the search query stops changing.
+	 */
+	update_search = function() {
+		window.clearTimeout(search_timeout);
+
+		search_timeout = window.setTimeout(function() {
+			var query = search_input.value.trim();
+
+			if (query === search_query) {
+				return;
+			}
+			search_query = query;
+
+			if (query) {
+				search_library(0);
+			} else {
+				search_results.innerHTML = '';
+				search_more.hidden = true;
+			}
+		}, SEARCH_DELAY);
+	},
+
+	/**
+	 * Shows a page of search results, replacing the results if it's the first page.
+	 * Results for an outdated query are ignored.
+	 * @param data (obj) The `query`, `offset`, `results` and whether there are `more` results.
+	 */
+	show_search_results = function(data) {
+		var fragment = document.createDocumentFragment(),
+			item,
+			details,
+			i;
+
+		if (data.query !== search_query) {
+			return;
+		}
+
+		if (data.offset === 0) {
+			search_results.innerHTML = '';
+		}
+
+		for (i = 0; i < data.results.length; i++) {
+			item    = document.createElement('li');
+			details = document.createElement('span');
+
+			item.textContent    = data.results[i].title;
+			details.textContent = data.results[i].artist + ' \u00b7 ' + data.results[i].album;
+			details.className   = 'details';
+
+			item.appendChild(details);
+			fragment.appendChild(item);
+		}
+
+		search_results.appendChild(fragment);
+		search_more.hidden = !data.more;
+	},
+
+	/**
+	 * Sends a request for a chunked upload.
+	 * @param method (str) The HTTP method.
+	 * @param url (str) The URL of the upload.
+	 * @param body (Blob) The chunk to send, or null.
+	 * @param content_range (str) The `Content-Range` header of the chunk, or null.
+	 * @param callback (func) Called with an error message or null, and the parsed response.
+	 */
+	send_upload_request = function(method, url, body, content_range, callback) {
+		var xhr = new XMLHttpRequest();
+
+		xhr.open(method, url);
+		if (content_range) {
+			xhr.setRequestHeader('Content-Range', content_range);
+			xhr.setRequestHeader('Content-Type', 'application/octet-stream');
+		}
+
+		xhr.onload = function() {
+			var response = {};
+			try {
+				response = JSON.parse(xhr.responseText);
+			} catch (e) {}
+
+			callback(xhr.status === 200 ? null : (response.error || 'Upload failed.'), response);
+		};
+		xhr.onerror = function() {
+			callback('Connection lost.', {});
+		};
+
+		xhr.send(body);
+	},
+
+	/**
+	 * Uploads a file in chunks, resuming from the last chunk the server received
+	 * if the connection is lost.
+	 * @param base_url (str) The URL to upload files under.
+	 * @param file (File) The file to upload.
+	 * @param on_progress (func) Called with the number of bytes sent for each chunk.
+	 * @param callback (func) Called with an error message or null, and the final response.
+	 */
+	upload_file = function(base_url, file, on_progress, callback) {
+		var url     = base_url + encodeURIComponent(file.name),
+			retries = 0,
+
+		send_chunk = function(offset) {
+			var end = Math.min(offset + UPLOAD_CHUNK_SIZE, file.size),
+				content_range = 'bytes ' + offset + '-' + (end - 1) + '/' + file.size;
+
+			send_upload_request('PUT', url, file.slice(offset, end), content_range, function(error, response) {
+				if (error) {
+					// Errors which leave the offset unchanged can't be fixed by resuming
+					if (response.offset === offset || retries++ >= UPLOAD_RETRIES) {
+						callback(error, response);
+					} else if (response.offset !== undefined) {
+						send_chunk(response.offset);
+					} else {
+						window.setTimeout(resume, 1000 * retries);
+					}
+					return;
+				}
+
+				on_progress(response.offset - offset);
+
+				if (response.complete) {
+					callback(null, response);
+				} else {
+					send_chunk(response.offset);
+				}
+			});
+		},
+
+		resume = function() {
+			send_upload_request('GET', url, null, null, function(error, response) {
+				if (error) {
+					callback(error, response);
+				} else {
+					send_chunk(response.offset);
+				}
+			});
+		};
+
+		resume();
+	},
+
+	/**
+	 * Uploads the selected files of an upload form several at a time,
+	 * showing the progress and throughput in the form.
+	 * @param form (Element) The form with a `data-upload-url` and file field.
+	 * @param files (FileList) The files to upload.
+	 */
+	upload_files = function(form, files) {
+		var base_url    = form.getAttribute('data-upload-url'),
+			active_text = form.getAttribute('data-active-text'),
+			queue       = Array.prototype.slice.call(files),
+			total       = 0,
+			sent        = 0,
+			running     = 0,
+			messages    = [],
+			started_at  = get_timestamp(),
+			i,
+
+		show_progress = function() {
+			var rate = sent / Math.max(get_timestamp() - started_at, 0.001) / 1024 / 1024;
+
+			form.setAttribute('data-active-text', 'Uploading ' + Math.floor(sent / total * 100) +
+				'% at ' + rate.toFixed(1) + ' MB/s...');
+		},
+
+		upload_next = function() {
+			var file = queue.shift();
+
+			if (!file) {
+				if (running === 0) {
+					form.setAttribute('data-active-text', active_text);
+					form.classList.remove('active');
+					window.alert(messages.join('\n'));
+				}
+				return;
+			}
+
+			running++;
+			upload_file(base_url, file, function(bytes) {
+				sent += bytes;
+				show_progress();
+			}, function(error, response) {
+				running--;
+				messages.push(error ? file.name + ': ' + error : response.message);
+				if (!error && response.job) {
+					upload_jobs[response.job] = true;
+				}
+				upload_next();
+			});
+		};
+
+		for (i = 0; i < queue.length; i++) {
+			total += queue[i].size;
+		}
+
+		form.classList.add('active');
+		for (i = 0; i < PARALLEL_UPLOADS; i++) {
+			upload_next();
+		}
+	},
+
+	/**
+	 * Reports the songs from this client's uploads which couldn't be added to the playlist.
+	 * Songs which were added appear as the playlist changes.
+	 * @param data (Object) The `job` id, the added `songs`, and `errors` for the songs which weren't added.
+	 */
+	show_song_added = function(data) {
+		if (!upload_jobs[data.job]) {
+			return;
+		}
+
+		delete upload_jobs[data.job];
+		if (data.errors.length) {
+			window.alert('Couldn\'t add to the playlist:\n' + data.errors.join('\n'));
+		}
 	},
 
 	/**
@@ -172,22 +727,54 @@
 			var file_fields = document.querySelectorAll('.file-upload input[type=file]');
 			for (var i = 0; i < file_fields.length; i++) {
 				file_fields[i].addEventListener('change', function() {
-					this.parentNode.classList.add('active');
-					this.parentNode.submit();
+					var form = this.parentNode;
+
+					// Forms with an upload URL send their files in chunks instead of all at once
+					if (form.getAttribute('data-upload-url') && window.Blob && Blob.prototype.slice) {
+						upload_files(form, this.files);
+						this.value = '';
+					} else {
+						form.classList.add('active');
+						form.submit();
+					}
 				});
 			}
 		}
 
+		if (playlist_view) {
+			playlist_view.addEventListener('scroll', render_playlist);
+
+			if (button) {
+				playlist_rows.addEventListener('click', handle_playlist_click);
+			}
+		}
+
+		if (search_input) {
+			// Search as the user types, and load more results on request
+			search_input.addEventListener('input', update_search);
+			search_more.addEventListener('click', function() {
+				search_library(search_results.children.length);
+			});
+		}
+
 		// Tells the server that we've connected
 		socket.on('connect', function() {
 			socket.emit('connect');
+			sync_clock();
 
 			increment_time();
 			window.setInterval(increment_time, 1000);
 		});
 
-		// Updates the current song when the server sends a 'song change' event
-		socket.on('song change', update_current_song);
+		// Updates the current song when the server sends its full state or changes to it
+		socket.on('song snapshot', apply_song_snapshot);
+		socket.on('song patch', apply_song_patch);
+		socket.on('clock sync', apply_clock_sync);
+		socket.on('artwork prefetch', prefetch_artwork);
+		socket.on('search results', show_search_results);
+		socket.on('playlist patch', apply_playlist_patch);
+		socket.on('playlist songs', apply_playlist_songs);
+		socket.on('song added', show_song_added);
 	};
 
 	init();
@@ -1,7 +1,31 @@
 from os import path, remove, makedirs
-from musicgen import MusicGen
+from song_state import VersionedState, is_song_unchanged
+from coalescer import Coalescer
+from fanout import FanOut
+from metrics import Metrics
+from uploads import ChunkedUploads, UploadError
+from library import LibraryIndex
+from jobs import JobQueue
+from mpd_multiplexer import MPDMultiplexer, CommandListError, _CommandJob
+from mpd import ConnectionError
+from audio_manager import AudioManager, start_thread
+from fake_mpd import FakeMPDServer
+from artwork import ArtworkCache
+from musicgen import MusicGen, InsufficientPaddingError
+from PIL import Image
+from io import BytesIO
+from threading import Event
+import json
+import time
+import types
 import unittest
 import shutil
+import sys
+
+try:
+	import flask
+except ImportError:
+	flask = None
 
 class MusicGenTests(unittest.TestCase):
 
@@ -73,6 +97,43 @@ class MusicGenTests(unittest.TestCase):
 				open(self.out_file, 'rb').read(),
 				'Saved {} cover art differs from embedded artwork'.format(filetype))
 
+	def test_read_cover_art(self):
+		"""Tests reading cover art directly from the tags of a file."""
+
+		for filetype in self.filetypes:
+			for cover in ('cover', 'no_cover'):
+				artwork = self.musicgen.read_cover_art(self.audio[filetype][cover])
+				tag_artwork = self.musicgen._extract_cover_art_tags(self.audio[filetype][cover])
+
+				if tag_artwork is None:
+					self.assertIsNone(
+						artwork,
+						'Coverless {} returned cover art data'.format(filetype))
+				else:
+					self.assertIsInstance(
+						artwork, memoryview,
+						'{} cover art data is not a memoryview'.format(filetype))
+
+					self.assertEqual(
+						artwork.tobytes(),
+						tag_artwork,
+						'{} cover art differs from cover art read by mutagen'.format(filetype))
+
+	def test_read_cover_art_id3_flac(self):
+		"""Tests reading cover art from a FLAC file with an ID3 tag before its `fLaC` marker."""
+
+		flac_file = path.join(self.tmp_dir, 'id3.flac')
+
+		# An ID3v2.4 tag with no frames, only 16 bytes of padding
+		with open(flac_file, 'wb') as out_file:
+			out_file.write(b'ID3\x04\x00\x00\x00\x00\x00\x10' + b'\x00' * 16)
+			out_file.write(open(self.audio['flac']['cover'], 'rb').read())
+
+		self.assertEqual(
+			self.musicgen.read_cover_art(flac_file).tobytes(),
+			self.musicgen.read_cover_art(self.audio['flac']['cover']).tobytes(),
+			'Cover art was not read from the FLAC file after its ID3 tag')
+
 	def test_embed_cover_art_coverless(self):
 		"""Tests embedding cover art in a coverless audio file with an image file."""
 
@@ -123,5 +184,1031 @@ class MusicGenTests(unittest.TestCase):
 				self.musicgen.extract_cover_art(tmp_file),
 				'Newly embedded {} cover art does not differ from original artwork'.format(filetype))
 
+	def test_embed_cover_art_in_place(self):
+		"""Tests that cover art is embedded in place once a file has been given padding."""
+
+		for filetype in self.filetypes:
+			tmp_file = path.join(self.tmp_dir, path.basename(self.audio[filetype]['no_cover']))
+			shutil.copyfile(self.audio[filetype]['no_cover'], tmp_file)
+
+			original = open(tmp_file, 'rb').read()
+
+			try:
+				self.musicgen.embed_cover_art(tmp_file, self.art_file, in_place_only=True)
+			except InsufficientPaddingError:
+				self.assertEqual(
+					open(tmp_file, 'rb').read(), original,
+					'{} file was modified when cover art did not fit in place'.format(filetype))
+
+			self.musicgen.embed_cover_art(tmp_file, self.art_file)
+
+			size = path.getsize(tmp_file)
+
+			self.assertTrue(
+				self.musicgen.embed_cover_art(tmp_file, self.art_file, in_place_only=True),
+				'Embedding {} cover art again was not in place'.format(filetype))
+
+			self.assertEqual(
+				path.getsize(tmp_file), size,
+				'Embedding {} cover art in place changed the file size'.format(filetype))
+
+class ArtworkCacheTests(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = 'tests/tmp'
+		self.config  = {
+			'MUSIC_DIR':                self.tmp_dir,
+			'COVERS_DIR':               path.join(self.tmp_dir, 'covers'),
+			'COVERS_SIZE':              (60, 60),
+			'COVERS_FILETYPE':          '.png',
+			'COVERS_CACHE_MAX_ENTRIES': 1
+		}
+
+		if not path.exists(self.tmp_dir):
+			makedirs(self.tmp_dir)
+
+		# Two songs with the same artwork, and one song with different artwork
+		shutil.copyfile('tests/audio/flac/14 Betelgeuse_36.flac', path.join(self.tmp_dir, 'a.flac'))
+		shutil.copyfile('tests/audio/flac/14 Betelgeuse_36.flac', path.join(self.tmp_dir, 'b.flac'))
+		shutil.copyfile('tests/audio/flac/17 Eructation concertmatienne.flac', path.join(self.tmp_dir, 'c.flac'))
+		MusicGen().embed_cover_art(path.join(self.tmp_dir, 'c.flac'), 'tests/artwork/art.png')
+
+		self.covers = ArtworkCache(self.config)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_generate_shared_artwork(self):
+		"""Tests that songs with the same artwork share stored artwork."""
+
+		self.assertEqual(
+			self.covers.generate('a.flac'),
+			self.covers.generate('b.flac'),
+			'Songs with the same artwork have different artwork')
+
+		self.assertEqual(
+			self.covers.stats['entries'], 1,
+			'Songs with the same artwork stored separate images')
+
+	def test_lookup(self):
+		"""Tests looking up generated and ungenerated artwork."""
+
+		self.assertEqual(
+			self.covers.lookup('a.flac'),
+			(False, None),
+			'Ungenerated artwork was found')
+
+		artwork = self.covers.generate('a.flac')
+
+		self.assertEqual(
+			self.covers.lookup('a.flac'),
+			(True, artwork),
+			'Generated artwork was not found')
+
+		self.assertEqual(
+			(self.covers.stats['hits'], self.covers.stats['misses']),
+			(1, 1),
+			'Lookups were not counted')
+
+	def test_render_record(self):
+		"""Tests that rendered artwork is only found once it has been recorded."""
+
+		result = self.covers.render('a.flac')
+
+		self.assertFalse(
+			self.covers.contains('a.flac'),
+			'Rendered artwork was found before being recorded')
+
+		self.covers.record('a.flac', *result)
+
+		self.assertEqual(
+			self.covers.lookup('a.flac'),
+			(True, self.covers.generate('a.flac')),
+			'Recorded artwork differs from generated artwork')
+
+	def test_artwork_urls(self):
+		"""Tests that artwork URLs name stored artwork files, and other filenames are refused."""
+
+		artwork = self.covers.generate('a.flac')
+
+		self.assertTrue(
+			path.isfile(self.covers.get_file(artwork['src'].rsplit('/', 1)[1])),
+			'Artwork URL does not name a stored file')
+
+		self.assertIsNone(
+			self.covers.get_file(ArtworkCache.INDEX_FILENAME),
+			'Index was served as artwork')
+
+	def test_evict_least_recently_used(self):
+		"""Tests that the least recently used artwork is evicted when over budget."""
+
+		first_artwork = self.covers.generate('a.flac')
+		self.covers.generate('c.flac')
+
+		self.assertFalse(
+			path.isfile(self.covers.get_file(path.basename(first_artwork['src']))),
+			'Least recently used artwork was not evicted')
+
+		self.assertEqual(
+			self.covers.lookup('a.flac'),
+			(False, None),
+			'Evicted artwork was found')
+
+		self.assertEqual(
+			(self.covers.stats['entries'], self.covers.stats['evictions']),
+			(1, 1),
+			'Eviction was not counted')
+
+	def test_generate_variants(self):
+		"""Tests generating artwork in several sizes and formats."""
+
+		self.config['COVERS_SIZES']   = [(30, 30), (60, 60)]
+		self.config['COVERS_FORMATS'] = ['.nonexistent', '.gif']
+		artwork = ArtworkCache(self.config).generate('a.flac')
+
+		self.assertEqual(
+			[source['type'] for source in artwork['sources']],
+			['image/gif', 'image/png'],
+			'Artwork sources are not in order of preference, or include unsupported formats')
+
+		for source in artwork['sources']:
+			for candidate in source['srcset'].split(', '):
+				url, width = candidate.split(' ')
+				filename = self.covers.get_file(path.basename(url))
+				self.assertEqual(
+					'{}w'.format(Image.open(filename).size[0]),
+					width,
+					'Resized artwork {} does not match its `srcset` width'.format(filename))
+
+	def test_journal(self):
+		"""Tests that recorded artwork is journaled rather than rewriting the index, and found after a restart."""
+
+		self.config['COVERS_CACHE_MAX_ENTRIES'] = None
+		covers = ArtworkCache(self.config)
+		artwork = covers.generate('a.flac')
+		covers.generate('c.flac')
+
+		self.assertFalse(
+			path.isfile(path.join(self.config['COVERS_DIR'], ArtworkCache.INDEX_FILENAME)),
+			'Index was rewritten for each song')
+
+		restarted = ArtworkCache(self.config)
+
+		self.assertEqual(
+			(restarted.lookup('a.flac'), restarted.stats['entries'], restarted.stats['bytes']),
+			((True, artwork), 2, covers.stats['bytes']),
+			'Journaled artwork was not found after a restart')
+
+		restarted.save_index()
+
+		self.assertEqual(
+			ArtworkCache(self.config).lookup('c.flac'),
+			covers.lookup('c.flac'),
+			'Artwork was lost when the journal was written to the index')
+
+	def test_shared_index(self):
+		"""Tests that artwork recorded by another process is found, and kept when either writes the index."""
+
+		self.config['COVERS_CACHE_MAX_ENTRIES'] = None
+		server = ArtworkCache(self.config)
+		prewarm = ArtworkCache(self.config)
+
+		artwork = prewarm.generate('a.flac')
+		server.generate('c.flac')
+
+		self.assertEqual(
+			server.lookup('a.flac'),
+			(True, artwork),
+			'Artwork recorded by another process was not found')
+
+		prewarm.save_index()
+		server.save_index()
+		restarted = ArtworkCache(self.config)
+
+		self.assertTrue(
+			restarted.contains('a.flac') and restarted.contains('c.flac'),
+			'Artwork recorded by another process was lost when the index was written')
+
+	def test_record_without_evicting(self):
+		"""Tests that recording artwork without evicting keeps artwork past the budget."""
+
+		self.covers.generate('a.flac')
+		self.covers.record('c.flac', *self.covers.render('c.flac'), evict=False)
+
+		self.assertTrue(
+			self.covers.contains('a.flac') and self.covers.is_full(),
+			'Artwork was evicted when recording without evicting')
+
+	def test_original_format(self):
+		"""Tests that the original image is stored with the extension of its own format."""
+
+		image_hash, size, widths, extension = self.covers.render('a.flac')
+
+		self.assertEqual(extension, '.jpg', 'Original JPEG was given the extension {}'.format(extension))
+		self.assertEqual(
+			Image.open(path.join(self.config['COVERS_DIR'], image_hash + extension)).format,
+			'JPEG',
+			'Original image was not stored in its own format')
+
+	def test_upgrade_index(self):
+		"""Tests that images recorded without widths are generated again rather than failing."""
+
+		artwork = self.covers.generate('a.flac')
+		image_hash = path.basename(artwork['src'])[:40]
+
+		# Images were recorded as [size, last access time] before widths were stored
+		self.covers._images[image_hash] = self.covers._images[image_hash][:2]
+		self.covers.save_index()
+		covers = ArtworkCache(self.config)
+
+		self.assertEqual(covers.lookup('a.flac'), (False, None), 'Image without widths was found')
+		self.assertEqual(covers.generate('a.flac'), artwork, 'Image without widths was not generated again')
+
+	def test_rebuild_index(self):
+		"""Tests that stored images are found when the index is missing."""
+
+		self.covers.generate('a.flac')
+		self.covers.save_index()
+		remove(path.join(self.config['COVERS_DIR'], ArtworkCache.INDEX_FILENAME))
+		remove(path.join(self.config['COVERS_DIR'], ArtworkCache.JOURNAL_FILENAME))
+
+		self.assertEqual(
+			ArtworkCache(self.config).stats['bytes'],
+			self.covers.stats['bytes'],
+			'Rebuilt index does not contain the stored images')
+
+class VersionedStateTests(unittest.TestCase):
+
+	def setUp(self):
+		self.state = VersionedState()
+		self.song  = {'title': 'Betelgeuse', 'album': 'Nebula', 'is_playing': True}
+
+	def test_first_update(self):
+		"""Tests that the first update contains every field."""
+
+		self.assertEqual(
+			self.state.update(self.song),
+			{'version': 1, 'changes': self.song},
+			'First patch does not contain the full state')
+
+	def test_update_changes(self):
+		"""Tests that updates only contain changed fields."""
+
+		self.state.update(self.song)
+		paused = dict(self.song, is_playing=False)
+
+		self.assertEqual(
+			self.state.update(paused),
+			{'version': 2, 'changes': {'is_playing': False}},
+			'Patch contains unchanged fields')
+
+		self.assertEqual(
+			self.state.snapshot(),
+			{'version': 2, 'state': paused},
+			'Snapshot does not contain the patched state')
+
+	def test_update_removed(self):
+		"""Tests that removed fields are sent as None."""
+
+		self.state.update(self.song)
+		del self.song['album']
+
+		self.assertEqual(
+			self.state.update(self.song),
+			{'version': 2, 'changes': {'album': None}},
+			'Patch does not clear removed fields')
+
+	def test_update_unchanged(self):
+		"""Tests that an identical update does not create a new version."""
+
+		self.state.update(self.song)
+
+		self.assertIsNone(
+			self.state.update(dict(self.song)),
+			'Unchanged update created a patch')
+
+		self.assertEqual(
+			self.state.version, 1,
+			'Unchanged update incremented the version')
+
+	def test_song_unchanged(self):
+		"""Tests that songs whose elapsed time has progressed as expected are unchanged."""
+
+		song = {'title': 'Betelgeuse', 'state': 'play', 'elapsed': 10.0, 'updated_at': 100.0}
+
+		self.assertTrue(
+			is_song_unchanged(song, dict(song, elapsed=15.1, updated_at=105.0)),
+			'Playing song with expected elapsed time is changed')
+
+		self.assertFalse(
+			is_song_unchanged(song, dict(song, elapsed=30.0, updated_at=105.0)),
+			'Seeked song is unchanged')
+
+		self.assertFalse(
+			is_song_unchanged(song, dict(song, state='pause', elapsed=15.0, updated_at=105.0)),
+			'Paused song is unchanged')
+
+	def test_encoded_snapshot(self):
+		"""Tests that snapshots are only encoded once per version."""
+
+		encoded = []
+		encode  = lambda snapshot: encoded.append(snapshot) or json.dumps(snapshot)
+
+		self.state.update(self.song)
+		self.state.encoded_snapshot(encode)
+		self.state.encoded_snapshot(encode)
+		self.state.update(dict(self.song, is_playing=False))
+
+		self.assertEqual(
+			json.loads(self.state.encoded_snapshot(encode)),
+			self.state.snapshot(),
+			'Encoded snapshot is not the current snapshot')
+
+		self.assertEqual(len(encoded), 2, 'Snapshot was encoded more than once per version')
+
+class CoalescerTests(unittest.TestCase):
+
+	def setUp(self):
+		self.updates = []
+
+	def test_coalesce(self):
+		"""Tests that a burst of updates is passed on as the latest update."""
+
+		emitted = Event()
+		coalescer = Coalescer(lambda value: (self.updates.append(value), emitted.set()), 0.05)
+
+		for value in range(5):
+			coalescer.put(value)
+
+		self.assertTrue(emitted.wait(5), 'Burst was not passed on')
+		self.assertEqual(self.updates, [4], 'Burst was not passed on as the latest update')
+		self.assertEqual(coalescer.stats['coalesced'], 4, 'Coalesced updates were not counted')
+
+	def test_drop_unchanged(self):
+		"""Tests that updates which change nothing are dropped."""
+
+		coalescer = Coalescer(self.updates.append, 0, lambda last, value: last // 10 == value // 10)
+
+		for value in (1, 2, 11, 12, 3):
+			coalescer.put(value)
+
+		self.assertEqual(self.updates, [1, 11, 3], 'Unchanged updates were passed on')
+		self.assertEqual(coalescer.stats['dropped'], 2, 'Dropped updates were not counted')
+
+def encode_event(event, data):
+	"""Encodes an event as JSON, standing in for a Socket.IO packet."""
+	return json.dumps([event, data])
+
+class FanOutTests(unittest.TestCase):
+
+	def setUp(self):
+		self.fanout = FanOut(start_thread, encode_event, max_depth=2)
+		self.ready  = False
+		self.sent   = []
+		self.done   = Event()
+
+		self.fanout.add('viewer', self.send, ['viewers'], lambda: self.ready)
+
+	def send(self, packet):
+		self.sent.append(tuple(json.loads(packet)))
+		if len(self.sent) >= 2:
+			self.done.set()
+
+	def test_latest_state(self):
+		"""Tests that a client which falls behind is only sent the latest state."""
+
+		for version in (1, 2, 3):
+			self.fanout.publish('song patch', version, key='song', snapshot=encode_event('song snapshot', version))
+		self.fanout.publish('playlist patch', 1, key='playlist')
+
+		stats = self.fanout.stats['viewer']
+		self.assertEqual((stats['depth'], stats['dropped']), (2, 2), 'Replaced state was not dropped')
+
+		self.ready = True
+		self.fanout.notify_ready()
+		self.assertTrue(self.done.wait(5), 'Queued events were not sent')
+		self.assertEqual(
+			self.sent,
+			[('song snapshot', 3), ('playlist patch', 1)],
+			'Client was not sent the latest state')
+
+	def test_bounded_queue(self):
+		"""Tests that the oldest events are dropped once a client's queue is full."""
+
+		for job in (1, 2, 3):
+			self.fanout.publish('song added', job)
+
+		self.ready = True
+		self.fanout.notify_ready()
+		self.assertTrue(self.done.wait(5), 'Queued events were not sent')
+		self.assertEqual(self.sent, [('song added', 2), ('song added', 3)], 'Oldest event was not dropped')
+		self.assertEqual(self.fanout.stats['viewer']['dropped'], 1, 'Dropped event was not counted')
+
+	def test_rooms(self):
+		"""Tests that events are only queued for clients in their room."""
+
+		self.fanout.publish('song added', 1, room='controllers')
+
+		self.assertEqual(self.fanout.stats['viewer']['depth'], 0, 'Event was queued outside its room')
+
+class MetricsTests(unittest.TestCase):
+
+	def setUp(self):
+		self.metrics = Metrics(prefix='test_')
+
+	def test_disabled(self):
+		"""Tests that nothing is collected while metrics are disabled."""
+
+		with self.metrics.timer('request_seconds'):
+			self.metrics.increment('requests_total')
+
+		self.assertEqual(self.metrics.render(), '\n', 'Disabled metrics were collected')
+
+	def test_render(self):
+		"""Tests that histograms and counters are rendered in the Prometheus text format."""
+
+		self.metrics.configure(enabled=True)
+		self.metrics.observe('request_seconds', 0.003, command='status')
+		self.metrics.observe('request_seconds', 20, command='status')
+		self.metrics.increment('requests_total', 2)
+
+		lines = self.metrics.render().splitlines()
+
+		for line in (
+			'# TYPE test_request_seconds histogram',
+			'test_request_seconds_bucket{command="status",le="0.0025"} 0',
+			'test_request_seconds_bucket{command="status",le="0.005"} 1',
+			'test_request_seconds_bucket{command="status",le="+Inf"} 2',
+			'test_request_seconds_count{command="status"} 2',
+			'# TYPE test_requests_total counter',
+			'test_requests_total 2'):
+			self.assertIn(line, lines, 'Metrics do not include {}'.format(line))
+
+class ChunkedUploadsTests(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = 'tests/tmp'
+		if not path.exists(self.tmp_dir):
+			makedirs(self.tmp_dir)
+
+		self.uploads = ChunkedUploads(self.tmp_dir, set(['flac', 'mp3']))
+
+		with open('tests/audio/flac/14 Betelgeuse_36.flac', 'rb') as song:
+			self.data = song.read()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_write_chunks(self):
+		"""Tests that a file written in chunks is moved into place once complete."""
+
+		middle = len(self.data) // 2
+
+		result = self.uploads.write('a.flac', 0, len(self.data), BytesIO(self.data[:middle]))
+		self.assertEqual(
+			(result['offset'], result['complete']),
+			(middle, False),
+			'First chunk was not written')
+
+		self.assertEqual(
+			self.uploads.get_offset('a.flac'), middle,
+			'Offset to resume from is incorrect')
+
+		result = self.uploads.write('a.flac', middle, len(self.data), BytesIO(self.data[middle:]))
+		self.assertTrue(result['complete'], 'Last chunk did not complete the upload')
+
+		with open(path.join(self.tmp_dir, 'a.flac'), 'rb') as song:
+			self.assertEqual(song.read(), self.data, 'Uploaded file differs from the original')
+
+	def test_write_wrong_offset(self):
+		"""Tests that a chunk which doesn't continue from the received bytes is rejected."""
+
+		self.uploads.write('a.flac', 0, len(self.data), BytesIO(self.data[:100]))
+
+		with self.assertRaises(UploadError) as context:
+			self.uploads.write('a.flac', 200, len(self.data), BytesIO(self.data[200:300]))
+
+		self.assertEqual(context.exception.offset, 100, 'Error does not give the offset to resume from')
+
+	def test_write_invalid_header(self):
+		"""Tests that files which don't match the header of their format are rejected."""
+
+		with self.assertRaises(UploadError):
+			self.uploads.write('a.mp3', 0, len(self.data), BytesIO(self.data))
+
+		self.assertEqual(
+			self.uploads.get_offset('a.mp3'), 0,
+			'Invalid file was kept')
+
+	def test_write_short_reads(self):
+		"""Tests that the header is checked once it has all arrived, over several reads or chunks."""
+
+		class ShortReads(BytesIO):
+			def read(self, size=-1):
+				return BytesIO.read(self, 3)
+
+		result = self.uploads.write('a.flac', 0, len(self.data), ShortReads(self.data[:100]))
+		self.assertEqual(result['offset'], 100, 'Header split over reads was rejected')
+
+		self.uploads.write('b.flac', 0, len(self.data), BytesIO(self.data[:2]))
+		result = self.uploads.write('b.flac', 2, len(self.data), BytesIO(self.data[2:]))
+		self.assertTrue(result['complete'], 'Header split over chunks was rejected')
+
+		self.uploads.write('c.mp3', 0, len(self.data), BytesIO(self.data[:2]))
+		with self.assertRaises(UploadError):
+			self.uploads.write('c.mp3', 2, len(self.data), BytesIO(self.data[2:]))
+
+class JobQueueTests(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = 'tests/tmp'
+		self.journal_file = path.join(self.tmp_dir, 'jobs.json')
+		if not path.exists(self.tmp_dir):
+			makedirs(self.tmp_dir)
+
+		self.jobs = []
+		self.finished = Event()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def handle_job(self, job):
+		self.jobs.append(job)
+		self.finished.set()
+
+	def test_put(self):
+		"""Tests that queued jobs are run and removed from the journal."""
+
+		queue = JobQueue(self.journal_file, self.handle_job)
+		job_id = queue.put({'song': 'a.flac'})
+
+		self.assertTrue(self.finished.wait(5), 'Job was not run')
+		self.assertEqual(self.jobs, [{'id': job_id, 'song': 'a.flac'}], 'Job was run with different data')
+
+		queue.join()
+
+		with open(self.journal_file) as journal:
+			self.assertEqual(json.load(journal), [], 'Finished job was kept in the journal')
+
+	def test_resume(self):
+		"""Tests that unfinished jobs in the journal are run when the queue is created."""
+
+		with open(self.journal_file, 'w') as journal:
+			json.dump([{'id': 3, 'song': 'a.flac'}], journal)
+
+		queue = JobQueue(self.journal_file, self.handle_job)
+
+		self.assertTrue(self.finished.wait(5), 'Unfinished job was not run')
+		self.assertEqual(queue.put({'song': 'b.flac'}), 4, 'Job ids were reused')
+		queue.join()
+
+class FakeLibraryMPD(object):
+	"""Answers the MPD commands used by LibraryIndex from a list of songs."""
+
+	def __init__(self, songs):
+		self.songs = songs
+		self.db_update = '1'
+
+	def stats(self):
+		return {'db_update': self.db_update}
+
+	def listallinfo(self):
+		return self.songs
+
+	def listall(self):
+		return [{'file': song['file']} for song in self.songs]
+
+	def find(self, tag, value):
+		if tag == 'file':
+			return [song for song in self.songs if song['file'] == value]
+		return [song for song in self.songs if song.get('modified', '0') > value]
+
+	def command_list(self, *commands):
+		return [getattr(self, command[0])(*command[1:]) for command in commands]
+
+class LibraryIndexTests(unittest.TestCase):
+
+	def setUp(self):
+		self.mpd = FakeLibraryMPD([
+			{'file': 'a.flac', 'title': 'Ocean Man',   'artist': 'Ween',   'album': 'The Mollusk', 'time': '127'},
+			{'file': 'b.flac', 'title': 'Push th\' Little Daisies', 'artist': 'Ween', 'album': 'Pure Guava', 'time': '170'},
+			{'file': 'c.flac', 'title': 'Betelgeuse', 'artist': 'Vulfpeck', 'album': 'Thrill of the Arts', 'time': '36'},
+		])
+		self.library = LibraryIndex(self.mpd)
+		self.library._load()
+
+	def get_files(self, results):
+		return [song['file'] for song in results[0]]
+
+	def test_search(self):
+		"""Tests searching the title, artist and album of songs."""
+
+		self.assertEqual(
+			self.get_files(self.library.search('WEEN')),
+			['a.flac', 'b.flac'],
+			'Search by artist did not ignore case')
+
+		self.assertEqual(
+			self.get_files(self.library.search('an m')),
+			['a.flac'],
+			'Search across words did not match')
+
+		self.assertEqual(
+			self.get_files(self.library.search('ee')),
+			['a.flac', 'b.flac'],
+			'Substring search did not match within words')
+
+		self.assertEqual(
+			self.get_files(self.library.search('ee', prefix=True)),
+			[],
+			'Prefix search matched within words')
+
+		self.assertEqual(
+			self.get_files(self.library.search('mol', prefix=True)),
+			['a.flac'],
+			'Prefix search did not match the start of a word')
+
+	def test_search_pages(self):
+		"""Tests paginating search results."""
+
+		self.assertEqual(
+			self.library.search('e', limit=2),
+			(self.library.search('e')[0][:2], True),
+			'First page of results was incorrect')
+
+		self.assertEqual(
+			self.get_files(self.library.search('e', offset=2, limit=2)),
+			['c.flac'],
+			'Last page of results was incorrect')
+
+	def test_update(self):
+		"""Tests that added, modified and removed songs are updated."""
+
+		self.mpd.songs = [
+			dict(self.mpd.songs[0], title='Ocean Woman', modified='2'),
+			{'file': 'd.flac', 'title': 'Dean Town', 'artist': 'Vulfpeck', 'album': 'The Beautiful Game', 'modified': '2'},
+		]
+		self.mpd.db_update = '2'
+		self.library._update()
+
+		self.assertEqual(
+			self.get_files(self.library.search('vulfpeck')),
+			['d.flac'],
+			'Songs were not added and removed')
+
+		self.assertEqual(
+			self.library.search('ocean')[0][0]['title'],
+			'Ocean Woman',
+			'Modified song was not updated')
+
+		self.assertNotIn(
+			'Pure Guava',
+			self.library._strings,
+			'Album with no songs left was kept')
+
+	def test_update_preserved_mtime(self):
+		"""Tests that added songs are found when they were modified before the last update."""
+
+		self.mpd.songs.append({'file': 'e.flac', 'title': 'Copied', 'artist': 'Rsync', 'album': 'Preserved', 'modified': '0'})
+		self.mpd.db_update = '2'
+		self.library._update()
+
+		self.assertEqual(
+			self.get_files(self.library.search('copied')),
+			['e.flac'],
+			'Song with an old modification time was not added')
+
+	def test_update_failure(self):
+		"""Tests that the whole library is loaded again on the next update after MPD fails."""
+
+		failed = Event()
+		def fail_listall():
+			failed.set()
+			raise IOError('Connection lost')
+
+		self.mpd.listall = fail_listall
+		self.mpd.db_update = '2'
+		self.library.request_update()
+		self.assertTrue(failed.wait(5), 'Library was not updated')
+
+		del self.mpd.listall
+		self.mpd.songs.append({'file': 'e.flac', 'title': 'Reloaded', 'artist': 'MPD', 'album': 'Restarted'})
+		self.library.request_update()
+
+		for _ in range(500):
+			if self.get_files(self.library.search('reloaded')):
+				break
+			time.sleep(0.01)
+
+		self.assertTrue(self.library.loaded, 'Library was not loaded again after a failed update')
+		self.assertEqual(self.get_files(self.library.search('reloaded')), ['e.flac'], 'Library was not reloaded')
+
+class MPDMultiplexerTests(unittest.TestCase):
+
+	def setUp(self):
+		self.server = FakeMPDServer(songs=5)
+		# Without workers, queued jobs are only run when a test runs them
+		self.mpd = MPDMultiplexer('127.0.0.1', self.server.port, pool_size=0, timeout=0.1)
+		self.client = self.mpd._connect()
+
+	def tearDown(self):
+		self.server.close()
+
+	def test_batch(self):
+		"""Tests that the commands of several jobs are sent in one command list."""
+
+		jobs = [_CommandJob([('status',)]), _CommandJob([('next',), ('currentsong',)])]
+		requests = self.server.requests
+		self.mpd._run_jobs(self.client, jobs)
+
+		self.assertEqual(self.server.requests, requests + 1, 'Jobs were not sent in one command list')
+		self.assertEqual(jobs[0].wait()[0]['playlistlength'], '5', 'First job had the wrong results')
+		self.assertEqual(jobs[1].wait()[1]['title'], 'Song 1', 'Second job had the wrong results')
+
+	def test_command_error(self):
+		"""Tests that a refused command fails only its own job, and the jobs around it are run."""
+
+		jobs = [
+			_CommandJob([('status',)]),
+			_CommandJob([('next',), ('add', 'missing.flac')]),
+			_CommandJob([('currentsong',)])]
+		self.mpd._run_jobs(self.client, jobs)
+
+		with self.assertRaises(CommandListError) as error:
+			jobs[1].wait()
+		self.assertEqual(error.exception.index, 1, 'Error was not mapped to the refused command')
+
+		self.assertEqual(jobs[0].wait()[0]['playlistlength'], '5', 'Read-only job before the error was not run again')
+		self.assertEqual(jobs[2].wait()[0]['title'], 'Song 1', 'Job after the error was not run')
+
+	def test_reconnect(self):
+		"""Tests that only read-only jobs are sent again after the connection is lost."""
+
+		jobs = [_CommandJob([('status',)]), _CommandJob([('next',)])]
+		self.server.disconnect()
+		self.mpd._run_jobs(self.client, jobs)
+
+		self.assertEqual(jobs[0].wait()[0]['playlistlength'], '5', 'Read-only job was not sent again')
+		with self.assertRaises(ConnectionError):
+			jobs[1].wait()
+		self.assertEqual(self.mpd._connect().currentsong()['title'], 'Song 0', 'Job which may have run was sent again')
+
+	def test_timeout(self):
+		"""Tests that a command which is never run fails once the timeout has passed."""
+
+		with self.assertRaises(ConnectionError):
+			self.mpd.execute('status')
+
+class AudioManagerTests(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = 'tests/tmp'
+		self.server  = FakeMPDServer(songs=5)
+		self.config  = {
+			'MPD_HOST':         '127.0.0.1',
+			'MPD_PORT':         self.server.port,
+			'MPD_IDLE_TIMEOUT': 0.1,
+			'MUSIC_DIR':        self.tmp_dir,
+			'COVERS_DIR':       path.join(self.tmp_dir, 'covers'),
+			'COVERS_SIZE':      (60, 60),
+			'COVERS_FILETYPE':  '.png',
+			'COVERS_PREFETCH':  0,
+			'DEFAULT_ARTWORK':  '',
+			'TMP_DIR':          self.tmp_dir
+		}
+
+		if not path.exists(self.tmp_dir):
+			makedirs(self.tmp_dir)
+
+		self.audio = AudioManager(self.config)
+		self.added = Event()
+
+		@self.audio.on('song added')
+		def handle_song_added(job_id, songs, errors):
+			self.result = (job_id, [song['file'] for song in songs], errors)
+			self.added.set()
+
+	def tearDown(self):
+		self.audio.close()
+		self.server.close()
+		shutil.rmtree(self.tmp_dir)
+
+	def test_add_new_songs(self):
+		"""Tests that songs are added when another song in the same job is refused by MPD."""
+
+		self.server.add_file('a.flac')
+		self.server.add_file('c.flac')
+		job_id = self.audio.add_new_songs(['a.flac', 'b.flac', 'c.flac'])
+
+		self.assertTrue(self.added.wait(5), 'Songs were never added')
+		self.assertEqual(self.result[:2], (job_id, ['a.flac', 'c.flac']), 'Songs after a refused song were not added')
+		self.assertEqual(len(self.result[2]), 1, 'Added songs were reported as failed')
+		self.assertTrue(self.result[2][0].startswith('b.flac: '), 'Refused song was not reported')
+
+	def test_add_new_songs_after_failure(self):
+		"""Tests that songs are still added after MPD fails during an earlier upload."""
+
+		update_database = self.audio._update_database
+		def fail_update(paths):
+			self.audio._update_database = update_database
+			raise ConnectionError('Connection lost')
+		self.audio._update_database = fail_update
+
+		self.server.add_file('a.flac')
+		job_id = self.audio.add_new_songs(['a.flac'])
+		self.assertTrue(self.added.wait(5), 'Failed upload was never reported')
+		self.assertEqual(self.result, (job_id, [], ['a.flac: Connection lost']), 'Failure was not reported')
+
+		self.added.clear()
+		job_id = self.audio.add_new_songs(['a.flac'])
+		self.assertTrue(self.added.wait(5), 'Songs were not added after a failure')
+		self.assertEqual(self.result, (job_id, ['a.flac'], []), 'Songs were not added after a failure')
+
+	def test_embed_artwork_failure(self):
+		"""Tests that the rest of an artwork job carries on when generating one song's artwork fails."""
+
+		for song_file in ('a.flac', 'b.flac'):
+			shutil.copyfile('tests/audio/flac/17 Eructation concertmatienne.flac', path.join(self.tmp_dir, song_file))
+		artwork_file = path.join(self.tmp_dir, 'art.png')
+		shutil.copyfile('tests/artwork/art.png', artwork_file)
+
+		generate = self.audio._covers.generate
+		def fail_generate(song_file, offload):
+			if song_file == 'a.flac':
+				raise IOError('cannot identify image file')
+			return generate(song_file, offload)
+		self.audio._covers.generate = fail_generate
+
+		changed = Event()
+		@self.audio.on('artwork changed')
+		def handle_artwork_changed(job_id, songs, errors):
+			self.result = (songs, errors)
+			changed.set()
+
+		self.audio._embed_artwork({'id': 1, 'songs': ['a.flac', 'b.flac'], 'artwork': artwork_file})
+
+		self.assertTrue(changed.is_set(), 'Artwork changes were never reported')
+		self.assertEqual(self.result, (['b.flac'], ['a.flac: cannot identify image file']), 'Failed song stopped the job')
+		self.assertFalse(path.exists(artwork_file), 'Artwork file was not removed')
+
+	def test_embed_artwork_by_rename(self):
+		"""Tests that artwork is embedded in a copy of a song unless writing in place is enabled."""
+
+		song_file = path.join(self.tmp_dir, 'a.flac')
+		shutil.copyfile('tests/audio/flac/17 Eructation concertmatienne.flac', song_file)
+		# Leaves room in the padding for the artwork
+		MusicGen().embed_cover_art(song_file, 'tests/artwork/art.png')
+
+		changed = Event()
+		self.audio.on('artwork changed')(lambda job_id, songs, errors: changed.set())
+
+		for in_place in (False, True):
+			self.config['EMBED_ARTWORK_IN_PLACE'] = in_place
+			shutil.copyfile('tests/artwork/art.png', path.join(self.tmp_dir, 'art.png'))
+			changed.clear()
+			self.audio.change_album_artwork('a.flac', path.join(self.tmp_dir, 'art.png'))
+			self.assertTrue(changed.wait(5), 'Artwork was never embedded')
+
+		self.assertEqual(
+			self.audio.embed_stats,
+			{'in_place': 1, 'rewritten': 1},
+			'Artwork was written in place without opting in')
+
+	def test_playlist_patch(self):
+		"""Tests that only the positions changed since a version are returned."""
+
+		patch = self.audio.get_playlist_patch()
+		self.assertEqual(patch['from_version'], None, 'First patch was not a whole playlist')
+		self.assertEqual((patch['length'], patch['changes']), (5, []), 'First patch had the wrong length')
+
+		self.audio.remove_song(3)
+		changes = self.audio.get_playlist_patch(patch['version'])
+		self.assertEqual(changes['from_version'], patch['version'], 'Patch was not from the given version')
+		self.assertGreater(changes['version'], patch['version'], 'Playlist version was not incremented')
+		self.assertEqual(changes['length'], 4, 'Removed song was still counted')
+		self.assertEqual(changes['changes'], [[2, 4], [3, 5]], 'Changed positions were wrong')
+
+		self.assertEqual(
+			self.audio.get_playlist_patch(changes['version'])['changes'],
+			[],
+			'Unchanged playlist had changes')
+
+	def test_playlist_songs(self):
+		"""Tests that a range of playlist positions is fetched, and an empty range has no songs."""
+
+		version, songs = self.audio.get_playlist_songs(1, 3)
+		self.assertEqual([song['id'] for song in songs], [2, 3], 'Wrong songs were fetched')
+
+		self.assertEqual(self.audio.get_playlist_songs(3, 1), (version, []), 'Empty range had songs')
+
+	def test_playlist_patch_limit(self):
+		"""Tests that the whole playlist is reloaded when too many positions changed."""
+
+		version = self.audio.get_playlist_patch()['version']
+		self.audio.MAX_PLAYLIST_CHANGES = 1
+		self.audio.remove_song(1)
+
+		patch = self.audio.get_playlist_patch(version)
+		self.assertEqual((patch['from_version'], patch['changes']), (None, []), 'Too many changes were sent')
+		self.assertEqual(patch['length'], 4, 'Reloaded playlist had the wrong length')
+
+@unittest.skipIf(flask is None, 'Flask is not installed')
+class CoverRouteTests(unittest.TestCase):
+
+	# The filename of a stored cover, named by the hash of its contents
+	COVER = 'a' * 40 + '.jpg'
+
+	@classmethod
+	def setUpClass(cls):
+		cls.tmp_dir = 'tests/tmp_app'
+		cls.server = FakeMPDServer(songs=5)
+		covers_dir = path.join(cls.tmp_dir, 'covers')
+		makedirs(covers_dir)
+
+		with open(path.join(covers_dir, cls.COVER), 'wb') as cover:
+			cover.write(b'cover')
+
+		# The server reads its settings from the config module when it's imported
+		config = types.ModuleType('config')
+		config.__dict__.update({
+			'ASYNC_MODE':             None,
+			'USERNAME':               'user',
+			'PASSWORD':               'password',
+			'SECRET_KEY':             'test key',
+			'TITLE':                  'Test',
+			'AUDIO_EXTENSIONS':       set(['flac']),
+			'ARTWORK_EXTENSIONS':     set(['png']),
+			'COVERS_DIR':             covers_dir,
+			'COVERS_URL':             '/art/',
+			'COVERS_SIZE':            (60, 60),
+			'COVERS_FILETYPE':        '.jpg',
+			'COVERS_PREFETCH':        0,
+			'COVERS_SENDFILE':        None,
+			'COVERS_SENDFILE_PREFIX': '/internal/covers/',
+			'DEFAULT_ARTWORK':        '',
+			'MUSIC_DIR':              cls.tmp_dir,
+			'MPD_HOST':               '127.0.0.1',
+			'MPD_PORT':               cls.server.port,
+			'MPD_IDLE_TIMEOUT':       0.1,
+			'TMP_DIR':                cls.tmp_dir,
+		})
+		cls.config = sys.modules.get('config')
+		sys.modules['config'] = config
+
+		import sound_bubble
+		cls.sound_bubble = sound_bubble
+		cls.client = sound_bubble.app.test_client()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.sound_bubble.audio.close()
+		cls.server.close()
+		shutil.rmtree(cls.tmp_dir)
+
+		if cls.config is None:
+			del sys.modules['config']
+		else:
+			sys.modules['config'] = cls.config
+
+	def test_send_cover(self):
+		"""Tests that covers are sent from COVERS_URL with their filename as an ETag, to be cached forever."""
+
+		response = self.client.get('/art/' + self.COVER)
+		self.assertEqual(response.status_code, 200, 'Cover was not sent')
+		self.assertEqual(response.data, b'cover', 'Wrong cover was sent')
+		self.assertEqual(response.headers['ETag'], '"{}"'.format(self.COVER), 'Cover was not tagged with its filename')
+		self.assertEqual(
+			response.headers['Cache-Control'],
+			'public, max-age=31536000, immutable',
+			'Cover can not be cached forever')
+
+		self.assertEqual(self.client.get('/covers/' + self.COVER).status_code, 404, 'Cover was sent outside COVERS_URL')
+		self.assertEqual(self.client.get('/art/' + 'b' * 40 + '.jpg').status_code, 404, 'Missing cover was sent')
+
+	def test_not_modified(self):
+		"""Tests that a client which has a cover is told it hasn't changed."""
+
+		response = self.client.get('/art/' + self.COVER, headers={'If-None-Match': '"{}"'.format(self.COVER)})
+		self.assertEqual(response.status_code, 304, 'Cached cover was sent again')
+		self.assertEqual(response.headers['ETag'], '"{}"'.format(self.COVER), 'Unchanged cover lost its ETag')
+
+	def test_x_accel_redirect(self):
+		"""Tests that nginx is asked to send covers when COVERS_SENDFILE is 'X-Accel-Redirect'."""
+
+		self.sound_bubble.app.config['COVERS_SENDFILE'] = 'X-Accel-Redirect'
+		try:
+			response = self.client.get('/art/' + self.COVER)
+		finally:
+			self.sound_bubble.app.config['COVERS_SENDFILE'] = None
+
+		self.assertEqual(response.status_code, 200, 'Cover was not sent')
+		self.assertEqual(response.headers['X-Accel-Redirect'], '/internal/covers/' + self.COVER, 'Cover was not sent by nginx')
+		self.assertEqual(response.data, b'', 'Cover was sent by Flask as well as nginx')
+		self.assertEqual(response.headers['Content-Type'], 'image/jpeg', 'Cover had the wrong type')
+		self.assertEqual(
+			response.headers['Cache-Control'],
+			'public, max-age=31536000, immutable',
+			'Cover sent by nginx can not be cached forever')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,168 @@
+from threading import Lock
+from metrics import metrics
+from os import path, remove, rename
+import time
+
+def _is_mp3_header(header):
+	"""Returns True if the header starts with an ID3 tag, or the sync bits of an MPEG audio frame."""
+	header = bytearray(header[:3])
+	return header.startswith(b'ID3') or (len(header) > 1 and header[0] == 0xff and header[1] & 0xe0 == 0xe0)
+
+# Checks of the first bytes of a file for each audio format, by extension
+AUDIO_HEADERS = {
+	'flac': lambda header: header.startswith(b'fLaC'),
+	'm4a':  lambda header: header[4:8] == b'ftyp',
+	'mp3':  _is_mp3_header,
+}
+
+# The number of bytes the checks in AUDIO_HEADERS need
+HEADER_SIZE = 8
+
+class UploadError(Exception):
+	"""
+	Raised when a chunk of an upload can't be accepted.
+
+	Properties:
+		status (int): The HTTP status code for the error.
+		offset (int): The number of bytes of the file which have been received,
+		              so the client knows where to resume from.
+	"""
+
+	def __init__(self, message, status=400, offset=0):
+		super(UploadError, self).__init__(message)
+		self.status = status
+		self.offset = offset
+
+class ChunkedUploads(object):
+	"""
+	Receives files in chunks, streaming each chunk straight into a partial file in
+	the upload directory without buffering it. The partial file is renamed into place
+	once the last chunk is received, so it's never copied.
+
+	An interrupted upload is resumed by asking for the number of bytes received
+	with `get_offset`, and sending the remaining chunks from there.
+	Different files can be uploaded at the same time.
+
+	Properties:
+		stats (dict): The total `bytes` received, and the `seconds` spent receiving them.
+	"""
+
+	PART_SUFFIX = '.part'
+
+	# The number of bytes read from the request at a time
+	BUFFER_SIZE = 64 * 1024
+
+	def __init__(self, upload_dir, extensions):
+		"""
+		Arguments:
+			upload_dir (str): The directory to save uploaded files to.
+			extensions (set): The allowed file extensions. Files with an extension in
+			                  AUDIO_HEADERS must also start with that format's header.
+		"""
+		self._upload_dir = upload_dir
+		self._extensions = extensions
+		self._lock = Lock()
+		self._writing = set()
+
+		self.stats = {'bytes': 0, 'seconds': 0}
+
+	def get_offset(self, filename):
+		"""
+		Returns the number of bytes of the given file which have been received.
+
+		Arguments:
+			filename (str): A secure filename relative to the upload directory.
+		"""
+		part_file = self._get_part_file(filename)
+		return path.getsize(part_file) if path.isfile(part_file) else 0
+
+	def write(self, filename, start, total, stream):
+		"""
+		Writes a chunk of a file from a stream.
+
+		Arguments:
+			filename (str): A secure filename relative to the upload directory.
+			start (int): The position of the chunk in the file, which must be the current offset.
+			total (int): The size of the complete file.
+			stream (file): A file-like object to read the chunk from.
+
+		Returns:
+			A dict containing the following keys:
+			offset:           The number of bytes of the file which have been received.
+			complete:         Whether the whole file has been received and moved into place.
+			bytes_per_second: The rate the chunk was received at.
+		"""
+		extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+		if extension not in self._extensions:
+			raise UploadError('{} is not an allowed file type.'.format(filename), 415)
+
+		if path.exists(path.join(self._upload_dir, filename)):
+			raise UploadError('{} already exists.'.format(filename), 409)
+
+		with self._lock:
+			if filename in self._writing:
+				raise UploadError('{} is already being uploaded.'.format(filename), 409, self.get_offset(filename))
+			self._writing.add(filename)
+
+		try:
+			return self._write(filename, extension, start, total, stream)
+		finally:
+			with self._lock:
+				self._writing.discard(filename)
+
+	def _write(self, filename, extension, start, total, stream):
+		"""Writes a chunk of a file, once the file is reserved for this request."""
+		part_file = self._get_part_file(filename)
+		offset = self.get_offset(filename)
+
+		if start != offset:
+			raise UploadError('Expected the chunk at {} of {}.'.format(offset, filename), 409, offset)
+
+		started_at = time.time()
+
+		# The header is checked once all of it has arrived, however it's split into reads and chunks
+		check_header = AUDIO_HEADERS.get(extension) if offset < HEADER_SIZE else None
+
+		with open(part_file, 'r+b' if offset else 'wb') as out_file:
+			header = out_file.read(offset) if check_header and offset else b''
+			out_file.seek(offset)
+
+			while True:
+				data = stream.read(self.BUFFER_SIZE)
+
+				if check_header:
+					header += data[:HEADER_SIZE]
+					if len(header) >= HEADER_SIZE or (not data and offset == total):
+						if not check_header(header):
+							out_file.close()
+							remove(part_file)
+							raise UploadError('{} is not a valid {} file.'.format(filename, extension), 415)
+						check_header = None
+
+				if not data:
+					break
+
+				if offset + len(data) > total:
+					raise UploadError('{} is larger than {} bytes.'.format(filename, total), 400, offset)
+
+				out_file.write(data)
+				offset += len(data)
+
+		seconds = time.time() - started_at
+		self.stats['bytes'] += offset - start
+		self.stats['seconds'] += seconds
+		metrics.observe('upload_chunk_seconds', seconds)
+
+		complete = offset == total
+		if complete:
+			rename(part_file, path.join(self._upload_dir, filename))
+
+		return {
+			'offset':           offset,
+			'complete':         complete,
+			'bytes_per_second': (offset - start) / seconds if seconds else 0,
+		}
+
+	def _get_part_file(self, filename):
+		"""Returns the path of the hidden partial file for an upload."""
+		return path.join(self._upload_dir, '.' + filename + self.PART_SUFFIX)